@@ -1,7 +1,7 @@
 """
 Simplified Data Loading
 """
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
 from torch.utils.data.sampler import Sampler
 from torch.utils.data.distributed import DistributedSampler
 import torch
@@ -20,13 +20,61 @@ from munch import Munch
 from trn_utils import DataWrap
 
 import ast
+import os
 import pickle
 from contrastive_sampling import create_similar_list, create_random_list
 from mdl_srl_utils import combine_first_ax
-from trn_utils import get_dataloader
+from box_utils import bbox_overlaps_batch
+from trn_utils import get_dataloader, synchronize, is_main_process
 
 torch.multiprocessing.set_sharing_strategy('file_system')
 
+# keys whose size(-2) differs across samples,
+# padded with -1 when stacked
+RAGGED_KEYS = ['iou_pairs']
+
+
+def concat_iou_pairs(iou_pairs, num_box, max_proposals, max_gt_box,
+                     nppf=None):
+    """
+    iou_pairs of each video: n x num_pairs x 2 (-1 padded)
+    are remapped to the concatenated video.
+    Proposals are n x max_proposals (TEMP), or nfrm x n x nppf
+    if nppf is given (SPAT). gt boxes are stacked
+    one after another (see process_gt_boxs)
+    output: num_valid_pairs x 2
+    """
+    n = iou_pairs.size(0)
+    prop_ix = iou_pairs[..., 0]
+    gt_ix = iou_pairs[..., 1]
+    vid_ix = torch.arange(n).view(n, 1).expand_as(prop_ix)
+    if nppf is not None:
+        new_prop_ix = (
+            (prop_ix // nppf) * n * nppf + vid_ix * nppf +
+            prop_ix % nppf
+        )
+    else:
+        new_prop_ix = vid_ix * max_proposals + prop_ix
+
+    nboxes = torch.tensor(
+        [0] + num_box.cumsum(dim=0).tolist()[:-1]).long()
+    new_gt_ix = nboxes.view(n, 1) + gt_ix
+    # gt boxes beyond max_gt_box are dropped
+    valid = (prop_ix >= 0) & (new_gt_ix < max_gt_box)
+    return torch.stack([new_prop_ix, new_gt_ix], dim=-1)[valid]
+
+
+def stack_ragged(tensor_list, pad_value=-1):
+    """
+    Stack tensors which differ in size(-2)
+    by padding them with pad_value
+    """
+    max_len = max(max([t.size(-2) for t in tensor_list]), 1)
+    return torch.stack([
+        F.pad(t, (0, 0, 0, max_len - t.size(-2)), value=pad_value)
+        for t in tensor_list
+    ])
+
 
 class AnetEntDataset(Dataset):
     """
@@ -62,6 +110,7 @@ class AnetEntDataset(Dataset):
 
         self.itemgetter = getattr(self, 'simple_item_getter')
         self.test_mode = (split_type != 'test')
+        self.load_iou_cache()
         self.after_init()
 
     def after_init(self):
@@ -119,6 +168,10 @@ class AnetEntDataset(Dataset):
         # Sequence length
         self.seq_length = self.cfg.ds.max_seq_length
 
+        # Whether to output the (proposal, gt box) pairs
+        # with iou > 0.5 used as targets in the loss
+        self.use_cached_targets = self.cfg.loss.use_cached_targets
+
     def load_annotations(self):
         """
         Process the annotation file.
@@ -254,6 +307,95 @@ class AnetEntDataset(Dataset):
         return (np.tile(proposals.reshape(-1, 1), (1, num_box)) != np.tile(
             gt_bboxs, (num_pps, 1)))
 
+    def get_iou_pairs(self, idx: int, padded_props, pad_pnt_mask,
+                      num_props: int, pad_gt_bboxs, num_box: int):
+        """
+        Sparse (proposal index, gt box index) pairs with iou > 0.5.
+        Same overlaps as in the loss (depends on loss.iou_engine),
+        but only depend on the video, so are memoized per idx
+        """
+        if idx in self.iou_pairs_cache:
+            return self.iou_pairs_cache[idx]
+
+        num_box = min(num_box, self.max_gt_box)
+        if num_props == 0 or num_box == 0:
+            iou_pairs = np.zeros((0, 2), dtype=np.int64)
+        else:
+            props = torch.tensor(padded_props[:num_props, :5]).float()
+            gt_bboxs = torch.tensor(pad_gt_bboxs[:num_box, :5]).float()
+            frm_mask = torch.from_numpy(self.get_frm_mask(
+                props[:, 4].numpy(), gt_bboxs[:, 4].numpy()
+            ).astype(np.uint8))
+            if self.cfg.loss.iou_engine == 'frm':
+                # only same frame
+                msk = 1 - frm_mask
+            else:
+                pnt_mask = torch.tensor(
+                    np.asarray(pad_pnt_mask[:num_props])).view(
+                        num_props, 1).to(frm_mask.dtype)
+                msk = frm_mask | pnt_mask
+            overlaps = bbox_overlaps_batch(
+                props.unsqueeze(0), gt_bboxs.unsqueeze(0), msk.unsqueeze(0)
+            )[0]
+            iou_pairs = (overlaps > 0.5).nonzero().numpy().astype(np.int64)
+
+        self.iou_pairs_cache[idx] = iou_pairs
+        return iou_pairs
+
+    def get_iou_cache_file(self):
+        iou_cache_dir = self.cfg.ds.iou_cache_dir
+        if iou_cache_dir == '':
+            return None
+        # everything the pairs depend on
+        return Path(iou_cache_dir) / (
+            f'iou_pairs_{self.cfg.ds.exp_setting}_{self.ann_file.stem}_'
+            f'{self.cfg.loss.iou_engine}_{self.prop_thresh}_'
+            f'bgd{int(self.exclude_bgd_det)}_gtb{self.max_gt_box}.pkl'
+        )
+
+    def compute_iou_cache(self):
+        "iou pairs for every video of the split"
+        for idx in range(len(self.annots)):
+            row = self.annots.iloc[idx]
+            padded_props, pad_pnt_mask, num_props = self.get_props(
+                row['Index'])
+            caption_dct = self.anet_ent_captions[row['vid_id']][
+                'segments'][str(row['seg_id'])]
+            gt_annot_dict = self.get_gt_annots(caption_dct, idx)
+            self.get_iou_pairs(
+                idx, padded_props, pad_pnt_mask, num_props,
+                gt_annot_dict['padded_gt_bboxs'], gt_annot_dict['num_box']
+            )
+
+    def load_iou_cache(self):
+        """
+        iou pairs for every video are computed here, in the
+        main process, so the dataloader workers inherit them
+        (a memo filled in the workers is lost every epoch).
+        If ds.iou_cache_dir is given, they are computed by
+        rank 0, saved there and loaded by the other ranks.
+        """
+        self.iou_pairs_cache = {}
+        if not self.use_cached_targets:
+            return
+        cache_file = self.get_iou_cache_file()
+        if cache_file is None:
+            self.compute_iou_cache()
+            return
+
+        if is_main_process() and not cache_file.exists():
+            self.compute_iou_cache()
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write and rename, other processes may be reading
+            tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self.iou_pairs_cache, f)
+            tmp_file.rename(cache_file)
+        synchronize()
+        if len(self.iou_pairs_cache) == 0:
+            with open(cache_file, 'rb') as f:
+                self.iou_pairs_cache = pickle.load(f)
+
     def get_seg_feat_for_frms(self, seg_feats, timestamps, duration, idx=None):
         """
         Given seg features of shape num_frms x 3072
@@ -417,6 +559,16 @@ class AnetEntDataset(Dataset):
 
         pad_pnt_mask = torch.tensor(pad_pnt_mask).long()
 
+        # 1 for the proposals which are not padding
+        pad_props_msk = torch.zeros(self.max_proposals).long()
+        pad_props_msk[:num_props] = 1
+
+        if self.use_cached_targets:
+            iou_pairs = self.get_iou_pairs(
+                idx, padded_props, pad_pnt_mask, num_props,
+                pad_gt_bboxs, num_box
+            )
+
         # pad region features
         pad_region_feature = np.zeros(
             (self.max_proposals, region_feature.shape[1]))
@@ -454,9 +606,14 @@ class AnetEntDataset(Dataset):
             'pad_frm_mask': torch.tensor(pad_frm_mask).byte(),
             # padded proposal mask
             'pad_pnt_mask': pad_pnt_mask.byte(),
+            # padded proposals are 0
+            'pad_props_msk': pad_props_msk.byte(),
             # sample number, not used, legacy
             'sample_idx': torch.tensor(sample_idx).long(),
         }
+        if self.use_cached_targets:
+            # num_pairs x 2, (proposal idx, gt box idx) with iou > 0.5
+            out_dict['iou_pairs'] = torch.from_numpy(iou_pairs).long()
 
         return out_dict
 
@@ -795,7 +952,10 @@ class AnetVerbDataset(AnetEntDataset):
             dl_list_pad = self.pad_words_with_vocab(
                 dl_list,
                 pad_len=pad_len, defm=[dl_list[0]])
-            out_dict[k] = torch.stack(dl_list_pad)
+            if k in RAGGED_KEYS:
+                out_dict[k] = stack_ragged(dl_list_pad)
+            else:
+                out_dict[k] = torch.stack(dl_list_pad)
         return out_dict, num_dl
 
     def sent_item_getter(self, idx):
@@ -845,6 +1005,17 @@ class AnetVerbDataset(AnetEntDataset):
         return out
 
 
+def append_to_every_dict(dct_list, new_dct):
+    "append a dict to every dict in a list of dicts"
+    for dct in dct_list:
+        dct.update(new_dct)
+    return
+
+
+def shuffle_list_from_perm(lst, perm):
+    return [lst[ix] for ix in perm]
+
+
 class AV_CS:
     """
     Basically performs CS with SEP/TEMP/SPAT
@@ -931,18 +1102,24 @@ class AV_CS:
         # this makes the code cleaner
         # if svsq, then do same as sep,
         # and set nvids_sample = 1
+        # if batched_layout, SPAT/TEMP return separate videos
+        # and the BatchCollator concatenates them
         if self.cfg.ds.conc_type == 'spat':
             self.itemgetter = getattr(
-                self, 'verb_item_getter_SPAT')
+                self, 'verb_item_getter_SEP' if self.cfg.ds.batched_layout
+                else 'verb_item_getter_SPAT')
             self.append_everywhere = False
         elif self.cfg.ds.conc_type == 'temp':
             self.itemgetter = getattr(
-                self, 'verb_item_getter_TEMP')
+                self, 'verb_item_getter_SEP' if self.cfg.ds.batched_layout
+                else 'verb_item_getter_TEMP')
             self.append_everywhere = False
         elif self.cfg.ds.conc_type == 'sep':
             self.itemgetter = getattr(
                 self, 'verb_item_getter_SEP')
-            self.append_everywhere = True
+            # if sep_share_lang, the query is kept once
+            # and broadcast over the videos in the model
+            self.append_everywhere = not self.cfg.ds.sep_share_lang
         elif self.cfg.ds.conc_type == 'svsq':
             self.itemgetter = getattr(
                 self, 'verb_item_getter_SEP')
@@ -1179,6 +1356,13 @@ class AV_CS:
         x2 = out_dict['srl_boxes_lens']
         x1[x2 > 0] += new_pos
 
+        if 'iou_pairs' in out_dict:
+            out_dict['iou_pairs'] = concat_iou_pairs(
+                out_dict['iou_pairs'], out_dict['num_box'],
+                self.max_proposals, self.max_gt_box,
+                nppf=self.num_prop_per_frm
+            )
+
         out_dict['num_box2'] = out_dict['num_box'].clone()
 
         out_dict['num_box'] = num_box
@@ -1198,6 +1382,9 @@ class AV_CS:
         out_dict['pad_pnt_mask'] = reshuffle_boxes(
             out_dict['pad_pnt_mask']
         )
+        out_dict['pad_props_msk'] = reshuffle_boxes(
+            out_dict['pad_props_msk']
+        )
         # region features have to be reshuffled
         out_dict['pad_region_feature'] = reshuffle_boxes(
             out_dict['pad_region_feature']
@@ -1310,6 +1497,12 @@ class AV_CS:
         x2 = out_dict['srl_boxes_lens']
         x1[x2 > 0] += new_pos
 
+        if 'iou_pairs' in out_dict:
+            out_dict['iou_pairs'] = concat_iou_pairs(
+                out_dict['iou_pairs'], out_dict['num_box'],
+                self.max_proposals, self.max_gt_box
+            )
+
         out_dict['num_box2'] = out_dict['num_box'].clone()
         out_dict['num_box'] = num_box
 
@@ -1326,6 +1519,8 @@ class AV_CS:
         out_dict['pad_frm_mask'] = torch.from_numpy(pad_frm_mask).byte()
         out_dict['pad_pnt_mask'] = combine_first_ax(
             out_dict['pad_pnt_mask'], keepdim=False)
+        out_dict['pad_props_msk'] = combine_first_ax(
+            out_dict['pad_props_msk'], keepdim=False)
 
         out_dict['seg_feature'] = combine_first_ax(
             out_dict['seg_feature'], keepdim=False)
@@ -1352,15 +1547,6 @@ class AV_CS:
         SPAT/TEMP concat the videos in their
         own functions.
         """
-        def append_to_every_dict(dct_list, new_dct):
-            "append a dict to every dict in a list of dicts"
-            for dct in dct_list:
-                dct.update(new_dct)
-            return
-
-        def shuffle_list_from_perm(lst, perm):
-            return [lst[ix] for ix in perm]
-
         # sample idxs
         more_idxs = self.more_idx_collector(idx)
 
@@ -1416,10 +1602,46 @@ class AV_CS:
         verb_list = shuffle_list_from_perm(verb_list, simple_permute)
 
         ann_id_list = [self.srl_annots.loc[ix].ann_ind for ix in new_idxs]
-        new_out_dicts = [self.simple_item_getter(ann_ix) for ann_ix
+        # features of a video repeated in the sample are read once,
+        # dicts are copied as the query is appended to them
+        vid_out_dicts = {ann_ix: self.simple_item_getter(ann_ix)
+                         for ann_ix in set(ann_id_list)}
+        new_out_dicts = [dict(vid_out_dicts[ann_ix]) for ann_ix
                          in ann_id_list]
 
         srl_row = self.srl_annots.loc[idx]
+        return self.collate_nvid_item(
+            srl_row, new_out_dicts, new_idxs, verb_cmp, verb_list,
+            simple_permute, simple_permute_inv, targ_cmp
+        )
+
+    def query_item_getter(self, srl_row, vid_out_dicts):
+        """
+        SEP sample for a query (srl_row) against the given
+        videos (outputs of simple_item_getter), used for serving.
+        The correct video is not known, so the targets
+        (target_cmp, verb_cmp) are placeholders.
+        """
+        num_vids = len(vid_out_dicts)
+        assert num_vids <= self.cs_nvids_sample
+        return self.collate_nvid_item(
+            srl_row, vid_out_dicts,
+            new_idxs=[srl_row.name] * num_vids,
+            verb_cmp=[1] * num_vids,
+            verb_list=[srl_row.lemma_verb] * num_vids,
+            simple_permute=list(range(num_vids)),
+            simple_permute_inv=list(range(num_vids)),
+            targ_cmp=0
+        )
+
+    def collate_nvid_item(self, srl_row, new_out_dicts, new_idxs,
+                          verb_cmp, verb_list, simple_permute,
+                          simple_permute_inv, targ_cmp):
+        """
+        Collate the per-video outputs with the query
+        (srl_row) into one sample padded to cs_nvids_sample
+        """
+        idx = srl_row.name
         out_dict_verb_for_idx = self.get_srl_anns(srl_row, new_out_dicts[0])
 
         # Append to every dict
@@ -1525,7 +1747,179 @@ class BatchCollator:
         self.after_init()
 
     def after_init(self):
-        pass
+        # only SEP has separate videos per sample
+        self.dedup_vids = (
+            self.cfg.ds.dedup_vids and
+            self.cfg.ds.conc_type in ['sep', 'svsq']
+        )
+        # SPAT/TEMP layout is done for the whole batch
+        self.batched_layout = (
+            self.cfg.ds.batched_layout and
+            self.cfg.ds.conc_type in ['spat', 'temp']
+        )
+        self.num_frms = self.cfg.ds.num_sampled_frm
+        self.num_prop_per_frm = self.cfg.ds[
+            self.cfg.ds.exp_setting]['num_prop_per_frm']
+        self.max_gt_box = self.cfg.ds.max_gt_box
+
+    def concat_gt_boxs(self, gt_boxs, num_box):
+        """
+        Batched process_gt_boxs. The first num_box gt boxes
+        of each video are stacked, and padded (or truncated)
+        to max_gt_box. As in process_gt_boxs, a sample without
+        gt boxes keeps the first (padded) box of its first video
+        gt_boxs: B x n x G x ...
+        num_box: B x n
+        output: B x G x ...
+        """
+        B, n, G = gt_boxs.shape[:3]
+        rest = gt_boxs.shape[3:]
+        nb = num_box.clamp(max=G)
+        cum_nb = nb.cumsum(dim=1)
+        rows = torch.arange(G).view(1, G)
+        # video for each output row
+        vid_ix = (rows.view(1, G, 1) >= cum_nb.view(B, 1, n)).long().sum(
+            dim=-1)
+        valid = vid_ix < n
+        vid_ix = vid_ix.clamp(max=n-1)
+        box_ix = vid_ix * G + rows - (cum_nb - nb).gather(1, vid_ix)
+        out = gt_boxs.view(B, n*G, *rest)[
+            torch.arange(B).view(B, 1), box_ix.clamp(min=0)
+        ]
+        out = out * valid.view(B, G, *[1]*len(rest)).to(out.dtype)
+        no_box = nb.sum(dim=1) == 0
+        out[no_box, 0] = gt_boxs[no_box, 0, 0]
+        return out
+
+    def batched_layout_SPAT_TEMP(self, out_dict):
+        """
+        Batched and vectorized verb_item_getter_SPAT/TEMP
+        input: separate videos, B x n x ...
+        """
+        is_spat = self.cfg.ds.conc_type == 'spat'
+        B, n, N, pdim = out_dict['pad_proposals'].shape
+        nfrm = self.num_frms
+        nppf = self.num_prop_per_frm
+
+        def reshuffle_boxes(inp_t):
+            """
+            B x n x nfrm*nppf x ... -> B x nfrm*n*nppf x ...
+            """
+            return inp_t.view(
+                B, n, nfrm, nppf, *inp_t.shape[3:]
+            ).transpose(1, 2).contiguous().view(
+                B, nfrm * n * nppf, *inp_t.shape[3:]
+            )
+
+        def combine_vids(inp_t):
+            return inp_t.view(B, n * inp_t.size(2), *inp_t.shape[3:])
+
+        def process_props(props):
+            # SPAT: x axis shifted by 720 per video
+            # TEMP: frame index shifted by 10 per video
+            delta_msk = props.new_zeros(props.size(-1))
+            if is_spat:
+                shift = 720
+                delta_msk[[0, 2]] = 1
+            else:
+                shift = 10
+                delta_msk[[4]] = 1
+            delta = (torch.arange(n) * shift).float().view(1, n, 1, 1)
+            return props + delta * delta_msk
+
+        layout_fn = reshuffle_boxes if is_spat else combine_vids
+
+        num_box = out_dict['num_box']
+        tot_num_box = num_box.sum(dim=-1)
+        out_dict['num_props'] = out_dict['num_props'].sum(dim=-1)
+        out_dict['num_cmp'] = torch.ones(B).long()
+
+        out_dict['pad_proposals'] = layout_fn(
+            process_props(out_dict['pad_proposals']))
+        out_dict['pad_gt_bboxs'] = self.concat_gt_boxs(
+            process_props(out_dict['pad_gt_bboxs']), num_box)
+        pad_gt_box_mask = self.concat_gt_boxs(
+            out_dict['pad_gt_box_mask'], num_box)
+        if not is_spat:
+            pad_gt_box_mask = pad_gt_box_mask.unsqueeze(1)
+        out_dict['pad_gt_box_mask'] = pad_gt_box_mask
+
+        # srl boxes now point to the gt boxes of target video
+        new_pos = (num_box.cumsum(dim=1) - num_box).gather(
+            1, out_dict['target_cmp'].view(B, 1))
+        srl_boxes = out_dict['srl_boxes']
+        out_dict['srl_boxes'] = srl_boxes + new_pos.view(
+            B, *[1]*(srl_boxes.dim()-1)) * (
+                out_dict['srl_boxes_lens'] > 0).long()
+
+        if 'iou_pairs' in out_dict:
+            out_dict['iou_pairs'] = stack_ragged([
+                concat_iou_pairs(
+                    out_dict['iou_pairs'][b], num_box[b], N, self.max_gt_box,
+                    nppf=nppf if is_spat else None)
+                for b in range(B)
+            ])
+
+        out_dict['num_box2'] = num_box.clone()
+        out_dict['num_box'] = tot_num_box
+
+        # 1 where proposal and gt box are in different frames
+        # and for padded gt boxes
+        G = self.max_gt_box
+        frm_mask = (
+            out_dict['pad_proposals'][..., 4].unsqueeze(-1) !=
+            out_dict['pad_gt_bboxs'][..., 4].unsqueeze(1)
+        ) | (
+            torch.arange(G).view(1, 1, G) >=
+            tot_num_box.clamp(max=G).view(B, 1, 1)
+        )
+        out_dict['pad_frm_mask'] = frm_mask.byte()
+
+        for k in ['pad_pnt_mask', 'pad_props_msk', 'pad_region_feature']:
+            out_dict[k] = layout_fn(out_dict[k])
+
+        out_dict['seg_feature'] = combine_vids(out_dict['seg_feature'])
+        seg_feature_for_frms = out_dict['seg_feature_for_frms']
+        if is_spat:
+            seg_feature_for_frms = seg_feature_for_frms.transpose(
+                1, 2).contiguous()
+        out_dict['seg_feature_for_frms'] = combine_vids(seg_feature_for_frms)
+        out_dict['sample_idx'] = out_dict['sample_idx'].view(B, -1)
+        return out_dict
+
+    def dedup_vid_feats(self, out_dict):
+        """
+        The same video (ann_idx) can occur many times
+        in a batch (negatives, padded videos).
+        Keep the visual inputs once per unique video as
+        uniq_* (num_uniq x ...) and the index of each slot
+        as uniq_vid_idx (B x num_cmp).
+        The dense features are dropped.
+        This saves memory and visual encoder FLOPs, the workers
+        have already read the features of every slot
+        (only repeats within a sample are read once).
+        """
+        ann_list = out_dict['ann_idx'].view(-1).tolist()
+        first_pos = {}
+        for pos, ann in enumerate(ann_list):
+            first_pos.setdefault(ann, pos)
+        uniq_pos = torch.tensor(list(first_pos.values())).long()
+        ann_to_uniq = {ann: ix for ix, ann in enumerate(first_pos)}
+
+        out_dict['uniq_vid_idx'] = torch.tensor(
+            [ann_to_uniq[ann] for ann in ann_list]
+        ).long().view(*out_dict['ann_idx'].shape)
+
+        for k in ['pad_region_feature', 'seg_feature_for_frms',
+                  'pad_proposals', 'pad_props_msk']:
+            if k in out_dict:
+                out_dict['uniq_' + k] = combine_first_ax(
+                    out_dict[k])[uniq_pos]
+
+        # only needed by the visual encoders
+        for k in ['pad_region_feature', 'seg_feature_for_frms']:
+            del out_dict[k]
+        return out_dict
 
     def __call__(self, batch):
         out_dict = {}
@@ -1534,6 +1928,9 @@ class BatchCollator:
         all_keys = list(batch[0].keys())
         batch_size = len(batch)
         for k in all_keys:
+            if k in RAGGED_KEYS:
+                out_dict[k] = stack_ragged([b[k] for b in batch])
+                continue
             shape = batch[0][k].shape
             if not all([b[k].shape == shape for b in batch]):
                 ForkedPdb().set_trace()
@@ -1541,6 +1938,11 @@ class BatchCollator:
                     [b[k] for b in batch])
         assert all([len(v) == batch_size for k, v in out_dict.items()])
 
+        if self.dedup_vids:
+            out_dict = self.dedup_vid_feats(out_dict)
+        if self.batched_layout:
+            out_dict = self.batched_layout_SPAT_TEMP(out_dict)
+
         return out_dict
 
 
@@ -1564,11 +1966,202 @@ def get_data(cfg):
     val_dl = get_dataloader(cfg, val_ds, is_train=False,
                             collate_fn=collate_fn)
 
+    # Fixed subset evaluated every epoch
+    val_subset_dl = None
+    if cfg.train.val_subset_size > 0:
+        val_subset_inds = get_stratified_inds(
+            val_ds.srl_annots, cfg.train.val_subset_size)
+        val_subset_dl = get_dataloader(
+            cfg, Subset(val_ds, val_subset_inds), is_train=False,
+            collate_fn=collate_fn)
+
     data = DataWrap(path=cfg.misc.tmp_path, train_dl=trn_dl, valid_dl=val_dl,
-                    test_dl=None)
+                    test_dl=None, valid_subset_dl=val_subset_dl)
     return data
 
 
+def get_stratified_inds(srl_annots, num_items, seed=0):
+    """
+    Deterministic subset of about num_items rows of srl_annots,
+    stratified by lemma_verb: each verb keeps the same fraction
+    of its queries (at least one). Positional indices, sorted.
+    """
+    frac = min(num_items / len(srl_annots), 1.)
+    rng = np.random.RandomState(seed)
+    inds = []
+    verb_groups = srl_annots.groupby('lemma_verb', sort=True).indices
+    for verb in sorted(verb_groups):
+        verb_inds = verb_groups[verb]
+        num_keep = max(int(round(frac * len(verb_inds))), 1)
+        inds += rng.choice(verb_inds, num_keep, replace=False).tolist()
+    return sorted(inds)
+
+
+def check_batched_layout(cfg, num_samples=8):
+    """
+    Check the batch from ds.batched_layout is identical
+    to the one from verb_item_getter_SPAT/TEMP
+    """
+    def get_batch(batched_layout):
+        cfg1 = cfg.clone()
+        cfg1.defrost()
+        cfg1.ds.batched_layout = batched_layout
+        ds = Anet_SRL(cfg=cfg1, ann_file=cfg1.ds['val_ann_file'],
+                      split_type='valid')
+        items = []
+        for ix in range(num_samples):
+            # same sampled videos and shuffling
+            torch.manual_seed(ix)
+            np.random.seed(ix)
+            items.append(ds[ix])
+        return BatchCollator(cfg1)(items)
+
+    batch = get_batch(False)
+    batch_new = get_batch(True)
+    assert set(batch.keys()) == set(batch_new.keys())
+    for k in batch:
+        assert batch[k].dtype == batch_new[k].dtype, k
+        assert torch.equal(batch[k], batch_new[k]), k
+    print('Batched layout is identical')
+
+
+def get_synthetic_nvid_item(num_box, nfrm, nppf, max_gt_box,
+                            nsrl=3, fdim=8, seed=0):
+    """
+    Random sample in the layout of verb_item_getter_nvid
+    (separate videos, query collated once), one video
+    per entry of num_box. Padded gt boxes are random
+    (not 0) so that the padding is not relied upon.
+    """
+    g = torch.Generator().manual_seed(seed)
+    n = len(num_box)
+    N = nfrm * nppf
+    G = max_gt_box
+    frms = torch.arange(nfrm).repeat_interleave(nppf).float()
+    xy = torch.rand(n, N, 2, generator=g) * 600
+    pad_proposals = torch.cat([
+        xy, xy + torch.rand(n, N, 2, generator=g) * 100 + 1,
+        frms.view(1, N, 1).expand(n, N, 1),
+        torch.rand(n, N, 2, generator=g)], dim=-1)
+
+    xy = torch.rand(n, G, 2, generator=g) * 600
+    pad_gt_bboxs = torch.cat([
+        xy, xy + torch.rand(n, G, 2, generator=g) * 100 + 1,
+        torch.randint(0, nfrm, (n, G, 1), generator=g).float()], dim=-1)
+    pad_gt_box_mask = torch.zeros(n, G).byte()
+    for vix, nb in enumerate(num_box):
+        pad_gt_box_mask[vix, :nb] = 1
+
+    targ_cmp = int(torch.randint(0, n, (1,), generator=g))
+    nb_targ = min(num_box[targ_cmp], G)
+    srl_boxes_lens = torch.randint(
+        0, 2, (1, nsrl, 4), generator=g) * int(nb_targ > 0)
+    srl_boxes = torch.randint(
+        0, max(nb_targ, 1), (1, nsrl, 4), generator=g) * srl_boxes_lens
+
+    # (proposal, gt box) pairs of each video, -1 padded
+    iou_pairs = torch.full((n, 2 * G, 2), -1).long()
+    for vix, nb in enumerate(num_box):
+        num_pairs = 2 * min(nb, G)
+        iou_pairs[vix, :num_pairs, 0] = torch.randint(
+            0, N, (num_pairs,), generator=g)
+        iou_pairs[vix, :num_pairs, 1] = torch.randint(
+            0, max(min(nb, G), 1), (num_pairs,), generator=g)
+
+    return {
+        'seg_feature': torch.rand(n, 4, fdim, generator=g),
+        'seg_feature_for_frms': torch.rand(n, nfrm, fdim, generator=g),
+        'num_props': torch.full((n,), N).long(),
+        'num_box': torch.tensor(num_box).long(),
+        'pad_proposals': pad_proposals,
+        'pad_gt_bboxs': pad_gt_bboxs,
+        'pad_gt_box_mask': pad_gt_box_mask,
+        'pad_region_feature': torch.rand(n, N, fdim, generator=g),
+        'pad_pnt_mask': torch.randint(0, 2, (n, N), generator=g).byte(),
+        'pad_props_msk': torch.ones(n, N).byte(),
+        'sample_idx': torch.randint(0, 100, (n, nfrm), generator=g),
+        'iou_pairs': iou_pairs,
+        'srl_boxes': srl_boxes.long(),
+        'srl_boxes_lens': srl_boxes_lens.long(),
+        'target_cmp': torch.tensor(targ_cmp).long(),
+        'new_srl_idxs': torch.arange(n).long(),
+    }
+
+
+def check_batched_layout_synthetic(
+        cfg, num_box=((3, 5, 1), (0, 2, 4), (0, 0, 0), (6, 4, 3)),
+        nfrm=4, nppf=5, max_gt_box=8):
+    """
+    Same as check_batched_layout on synthetic samples
+    (get_synthetic_nvid_item), no data needed. num_box has
+    uneven videos, a video without gt boxes, a sample without
+    any and one with more than max_gt_box.
+    The per-sample getters only use the sizes of the dataset,
+    so they are called on an uninitialized Anet_SRL.
+    """
+    for conc_type in ['spat', 'temp']:
+        cfg1 = cfg.clone()
+        cfg1.defrost()
+        cfg1.ds.conc_type = conc_type
+        cfg1.ds.num_sampled_frm = nfrm
+        cfg1.ds[cfg1.ds.exp_setting]['num_prop_per_frm'] = nppf
+        cfg1.ds.max_gt_box = max_gt_box
+        items = [
+            get_synthetic_nvid_item(nb, nfrm, nppf, max_gt_box, seed=ix)
+            for ix, nb in enumerate(num_box)
+        ]
+
+        ds = Anet_SRL.__new__(Anet_SRL)
+        ds.num_frms = nfrm
+        ds.num_prop_per_frm = nppf
+        ds.max_proposals = nfrm * nppf
+        ds.max_gt_box = max_gt_box
+        ds.itemcollector = lambda ix: {
+            k: v.clone() for k, v in items[ix].items()}
+        item_getter = (ds.verb_item_getter_SPAT if conc_type == 'spat'
+                       else ds.verb_item_getter_TEMP)
+
+        batches = []
+        for batched_layout in [False, True]:
+            cfg1.ds.batched_layout = batched_layout
+            if batched_layout:
+                batch_items = [ds.itemcollector(ix)
+                               for ix in range(len(items))]
+            else:
+                batch_items = [item_getter(ix) for ix in range(len(items))]
+            batches.append(BatchCollator(cfg1)(batch_items))
+
+        batch, batch_new = batches
+        assert set(batch.keys()) == set(batch_new.keys()), conc_type
+        for k in batch:
+            assert batch[k].dtype == batch_new[k].dtype, (conc_type, k)
+            assert torch.equal(batch[k], batch_new[k]), (conc_type, k)
+    print('Batched layout is identical on synthetic samples')
+
+
+def check_nvid_item(cfg, num_samples=4):
+    """
+    Build SEP samples (verb_item_getter_nvid and query_item_getter)
+    with the query appended to every video (sep_share_lang False)
+    and kept once (sep_share_lang True)
+    """
+    for sep_share_lang in [False, True]:
+        cfg1 = cfg.clone()
+        cfg1.defrost()
+        cfg1.ds.conc_type = 'sep'
+        cfg1.ds.sep_share_lang = sep_share_lang
+        ds = Anet_SRL(cfg=cfg1, ann_file=cfg1.ds['val_ann_file'],
+                      split_type='valid')
+        assert ds.append_everywhere == (not sep_share_lang)
+        items = [ds[ix] for ix in range(num_samples)]
+        BatchCollator(cfg1)(items)
+        srl_row = ds.srl_annots.iloc[0]
+        query_item = ds.query_item_getter(
+            srl_row, [ds.simple_item_getter(srl_row.ann_ind)])
+        assert set(query_item.keys()) == set(items[0].keys())
+    print('SEP items built for both append_everywhere')
+
+
 if __name__ == '__main__':
     cfg = CN(yaml.safe_load(open('./configs/anet_srl_cfg.yml')))
     data = get_data(cfg)
@@ -0,0 +1,105 @@
+"""
+Smoke benchmark of distributed training on cpu (gloo).
+For 1, 2, 4, ... max_procs processes, each process trains
+num_its iterations of Learner.train_step on its shard of
+train_dl, reporting samples/sec and the scaling w.r.t.
+one process. Each process gets cpu_count / num_procs threads
+unless threads_per_proc is given.
+"""
+import os
+import time
+import torch
+import torch.multiprocessing as mp
+import fire
+
+from main_dist import learner_init
+from trn_utils import synchronize, is_main_process
+from extended_config import (
+    cfg as conf,
+    key_maps,
+    update_from_dict,
+    post_proc_config
+)
+
+
+def bench_worker(local_rank, num_procs, num_its, num_warmup,
+                 threads_per_proc, port, kwargs, out_q):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads_per_proc)
+    torch.distributed.init_process_group(
+        backend='gloo', init_method='env://',
+        world_size=num_procs, rank=local_rank)
+
+    cfg = conf.clone()
+    cfg.uid = 'cpu_bench'
+    cfg.device = 'cpu'
+    cfg.do_dist = True
+    cfg.local_rank = local_rank
+    cfg.train.resume = False
+    cfg = update_from_dict(cfg, dict(kwargs), key_maps)
+    cfg = post_proc_config(cfg)
+    cfg.freeze()
+    learn = learner_init(cfg.uid, cfg)
+    learn.optimizer = learn.prepare_optimizer()
+    learn.mdl.train()
+
+    dl_iter = iter(learn.data.train_dl)
+    for it in range(num_warmup + num_its):
+        if it == num_warmup:
+            synchronize()
+            st_time = time.time()
+        learn.train_step(next(dl_iter))
+    synchronize()
+    tot_time = time.time() - st_time
+    if is_main_process():
+        num_samples = num_its * cfg.train.bs * num_procs
+        out_q.put(num_samples / tot_time)
+
+
+def bench_cpu_dist(max_procs: int = 4, num_its: int = 20,
+                   num_warmup: int = 3, threads_per_proc: int = 0,
+                   port: int = 29512, **kwargs):
+    """
+    max_procs: largest number of processes
+    Each result is printed when its run ends, a run that
+    fails is skipped and the others still run
+    **kwargs: cfg args (same as main_dist), e.g. train.bs
+    """
+    num_procs_list = []
+    num_procs = 1
+    while num_procs < max_procs:
+        num_procs_list.append(num_procs)
+        num_procs *= 2
+    num_procs_list.append(max_procs)
+
+    ctx = mp.get_context('spawn')
+    samples_per_sec = {}
+    for ix, num_procs in enumerate(num_procs_list):
+        num_threads = threads_per_proc
+        if num_threads == 0:
+            num_threads = max(os.cpu_count() // num_procs, 1)
+        out_q = ctx.SimpleQueue()
+        # a failed run (e.g. out of memory) is reported and
+        # skipped, the results so far are already printed
+        try:
+            # new port per run, the previous one may be in TIME_WAIT
+            mp.spawn(bench_worker, nprocs=num_procs,
+                     args=(num_procs, num_its, num_warmup, num_threads,
+                           port + ix, kwargs, out_q))
+        except Exception as e:
+            print(f'{num_procs} procs x {num_threads} threads | '
+                  f'failed: {e}', flush=True)
+            continue
+        samples_per_sec[num_procs] = out_q.get()
+        out_str = (f'{num_procs} procs x {num_threads} threads | '
+                   f'{samples_per_sec[num_procs]:.2f} samples/s')
+        if 1 in samples_per_sec:
+            scaling = samples_per_sec[num_procs] / samples_per_sec[1]
+            out_str += f' | scaling {scaling:.2f}x'
+        print(out_str, flush=True)
+    return samples_per_sec
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_cpu_dist)
@@ -33,6 +33,11 @@ from box_utils import box_iou
 import numpy as np
 import fire
 from collections import Counter
+import multiprocessing as mp
+
+# GroundEval and predictions of eval_sharded, set in
+# each worker by _init_shard
+_shard_ctx = {}
 
 
 def list_of_dicts_avg(lst_dict):
@@ -45,13 +50,18 @@ class GroundEval_Corr:
         self.comm = comm
         self.res_dicts = ['res_dict']
         self.prob_thresh = self.cfg.train.prob_thresh
+        self.load_gt_files()
         self.prepare_gt(split_type='valid')
         self.after_init()
 
     def after_init(self):
         return
 
-    def prepare_gt(self, split_type='valid'):
+    def load_gt_files(self):
+        """
+        Read the annotation files, done once per instance
+        (prepare_gt only selects the split)
+        """
         # self.srl_annots1 = pd.read_csv(self.cfg.ds.val_verb_ent_file)
         self.srl_annots1 = pd.read_csv(self.cfg.ds.val_ds4_inds)
         assert hasattr(self, 'srl_annots1')
@@ -61,11 +71,12 @@ class GroundEval_Corr:
                 self.srl_annots1[k] = self.srl_annots1[k].apply(
                     lambda x: ast.literal_eval(x))
 
-        if split_type == 'valid' or split_type == 'test':
-            self.annots = pd.read_csv(self.cfg.ds.val_ann_file)
-            with open(self.cfg.ds.anet_ent_annot_file) as f:
-                self.anet_annots = json.load(f)
+        self.annots = pd.read_csv(self.cfg.ds.val_ann_file)
+        with open(self.cfg.ds.anet_ent_annot_file) as f:
+            self.anet_annots = json.load(f)
 
+    def prepare_gt(self, split_type='valid'):
+        if split_type == 'valid' or split_type == 'test':
             vt_split = 'val' if split_type == 'valid' else 'test'
             self.srl_annots = self.srl_annots1[
                 self.srl_annots1.vt_split == vt_split]
@@ -73,8 +84,14 @@ class GroundEval_Corr:
             raise NotImplementedError
 
     def prepare_preds(self, predict_file):
-        with open(predict_file, 'rb') as f:
-            out_df = pd.DataFrame(pickle.load(f))
+        if str(predict_file).endswith('.npz'):
+            # columnar predictions (PredStore), one ndarray per cell
+            with np.load(predict_file) as pred_cols:
+                out_df = pd.DataFrame(
+                    {k: list(pred_cols[k]) for k in pred_cols.files})
+        else:
+            with open(predict_file, 'rb') as f:
+                out_df = pd.DataFrame(pickle.load(f))
         return out_df.drop_duplicates(subset='idx_sent')
 
     def get_req_pred_from_row(self, pred_row, gt_row,
@@ -119,7 +136,8 @@ class GroundEval_Corr:
         pred_boxes_for_verb = self.get_req_pred_from_row(
             pred_row, gt_row, gt_row_ind
         )
-        if pred_boxes_for_verb == -1:
+        # -1 if verb was never passed
+        if isinstance(pred_boxes_for_verb, int):
             return -1
 
         for srl_ind, (
@@ -195,26 +213,17 @@ class GroundEval_Corr:
     def post_proc_final(self, out_dict):
         return out_dict
 
-    def eval_ground_acc(self, predict_file, split_type='valid'):
+    def eval_sent_inds(self, pred_df, gt_df, verbose=True):
         """
-        predictions: List[Dict] / DataFrame
-        groundtruths: List[Dict] / DataFrame
+        Per sentence results (res_dicts, tot_dict)
+        for the rows of gt_df (progress bar if verbose)
         """
-        self.prepare_gt(split_type)
-        pred_df = self.prepare_preds(predict_file)
-        gt_df = self.srl_annots
-        res_dicts = {k: {} for k in self.res_dicts}
-
-        tot_dict = {}
-        tot = 0
-
-        classwise_dict = {}
+        res_dicts, tot_dict = self.init_res_dicts()
 
         pred_df1 = pred_df.set_index('idx_sent')
 
-        for gt_row_ind, gt_row in tqdm(gt_df.iterrows(), total=len(gt_df)):
-            tot += 1
-            ann_ind = gt_row.ann_ind
+        for gt_row_ind, gt_row in tqdm(gt_df.iterrows(), total=len(gt_df),
+                                      disable=not verbose):
             pred_row = pred_df1.loc[gt_row_ind]
 
             targ_cmp = pred_row.targ_cmp
@@ -226,15 +235,66 @@ class GroundEval_Corr:
                 if gt_row_ind in out['tot_dict']:
                     # Update the default res_dict
                     self.update_res_dicts(res_dicts, tot_dict, out, gt_row_ind)
-                    lemma_verb = gt_row.lemma_verb
-                    if lemma_verb not in classwise_dict:
-                        classwise_dict[lemma_verb] = self.init_res_dicts()
-                    # Update for each class
-                    self.update_res_dicts(
-                        classwise_dict[lemma_verb][0],
-                        classwise_dict[lemma_verb][1],
-                        out, gt_row_ind
-                    )
+        return res_dicts, tot_dict
+
+    def eval_sharded(self, pred_df, gt_df, nproc):
+        """
+        Same as eval_sent_inds, with the gt rows sharded by
+        ann_ind over a pool of nproc processes. The shards
+        have disjoint sentences, so merging is exact.
+        The workers are spawned (not forked), the caller may
+        hold cuda/nccl state during training.
+        """
+        ann_inds = gt_df.ann_ind.unique()
+        shards = [
+            gt_df.index[gt_df.ann_ind.isin(ann_shard)]
+            for ann_shard in np.array_split(ann_inds, nproc * 4)
+        ]
+        with mp.get_context('spawn').Pool(
+                nproc, initializer=_init_shard,
+                initargs=(self, pred_df, gt_df)) as pool:
+            shard_outs = pool.map(_eval_shard, shards)
+            pool.close()
+            pool.join()
+
+        res_dicts, tot_dict = self.init_res_dicts()
+        for shard_res_dicts, shard_tot_dict in shard_outs:
+            for res_dc_name in self.res_dicts:
+                res_dicts[res_dc_name].update(shard_res_dicts[res_dc_name])
+            tot_dict.update(shard_tot_dict)
+        return res_dicts, tot_dict
+
+    def eval_ground_acc(self, predict_file, split_type='valid', nproc=1,
+                        subset=False):
+        """
+        predictions: List[Dict] / DataFrame
+        groundtruths: List[Dict] / DataFrame
+        nproc: number of processes to shard the gt rows
+        subset: only the gt rows with a prediction are used
+        """
+        self.prepare_gt(split_type)
+        pred_df = self.prepare_preds(predict_file)
+        gt_df = self.srl_annots
+        if subset:
+            gt_df = gt_df[gt_df.index.isin(pred_df.idx_sent)]
+
+        if nproc > 1:
+            res_dicts, tot_dict = self.eval_sharded(pred_df, gt_df, nproc)
+        else:
+            res_dicts, tot_dict = self.eval_sent_inds(pred_df, gt_df)
+
+        # Update for each class, in order of the gt rows
+        classwise_dict = {}
+        for gt_row_ind, lemma_verb in zip(gt_df.index, gt_df.lemma_verb):
+            if gt_row_ind not in tot_dict:
+                continue
+            if lemma_verb not in classwise_dict:
+                classwise_dict[lemma_verb] = self.init_res_dicts()
+            cls_res_dicts, cls_tot_dict = classwise_dict[lemma_verb]
+            for res_dc_name in self.res_dicts:
+                cls_res_dicts[res_dc_name][gt_row_ind] = (
+                    res_dicts[res_dc_name][gt_row_ind])
+            cls_tot_dict[gt_row_ind] = tot_dict[gt_row_ind]
 
         res_dicts_avg1, res_dicts_avg2 = self.compute_avgs_using_res(
             res_dicts, tot_dict
@@ -269,6 +329,17 @@ class GroundEval_Corr:
         return self.post_proc_final(out_dict)
 
 
+def _init_shard(grnd_eval, pred_df, gt_df):
+    torch.set_num_threads(1)
+    _shard_ctx.update(grnd_eval=grnd_eval, pred_df=pred_df, gt_df=gt_df)
+
+
+def _eval_shard(gt_inds):
+    return _shard_ctx['grnd_eval'].eval_sent_inds(
+        _shard_ctx['pred_df'], _shard_ctx['gt_df'].loc[gt_inds],
+        verbose=False)
+
+
 class GroundEval_SEP(GroundEval_Corr):
     def after_init(self):
         self.res_dicts = ['res_dict', 'cons_dict',
@@ -396,7 +467,7 @@ class GroundEval_SEP(GroundEval_Corr):
         ]
         # num_srl_args x num_cmp x num_frms x num_prop_per_frm
         pred_boxes_for_verb = pred_row.pred_boxes
-        if pred_boxes_for_verb == -1:
+        if isinstance(pred_boxes_for_verb, int):
             print('oh no')
             return -1
 
@@ -747,7 +818,23 @@ class GroundEval_SPAT(GroundEval_SEP):
         }
 
 
-def main(pred_file, split_type='valid', **kwargs):
+def get_comm(cfg):
+    comm = Munch()
+    exp = cfg.ds.exp_setting
+    if exp == 'gt5':
+        comm.num_prop_per_frm = 5
+    elif exp == 'p100':
+        comm.num_prop_per_frm = 100
+    else:
+        raise NotImplementedError
+    return comm
+
+
+def main(pred_file, split_type='valid', nproc=1, **kwargs):
+    """
+    pred_file: predictions (pkl/npz), or a list of them
+    nproc: processes to shard the evaluation over
+    """
     if 'cfg' not in kwargs:
         from extended_config import (
             cfg as conf,
@@ -763,14 +850,7 @@ def main(pred_file, split_type='valid', **kwargs):
         cfg.freeze()
     # grnd_eval = GroundEval_Corr(cfg)
     # grnd_eval = GroundEvalDS4(cfg)
-    comm = Munch()
-    exp = cfg.ds.exp_setting
-    if exp == 'gt5':
-        comm.num_prop_per_frm = 5
-    elif exp == 'p100':
-        comm.num_prop_per_frm = 100
-    else:
-        raise NotImplementedError
+    comm = get_comm(cfg)
 
     conc_type = cfg.ds.conc_type
     if conc_type == 'sep' or conc_type == 'svsq':
@@ -781,12 +861,16 @@ def main(pred_file, split_type='valid', **kwargs):
         grnd_eval = GroundEval_SPAT(cfg, comm)
     else:
         raise NotImplementedError
-    out = grnd_eval.eval_ground_acc(pred_file, split_type=split_type)
+    pred_files = pred_file if isinstance(
+        pred_file, (list, tuple)) else [pred_file]
     # to_print = ['avg1', 'avg2']
     # print(Counter(grnd_eval.pcs))
     met_keys = ['avg1', 'avg1_cons',
                 'avg1_vidf', 'avg1_strict']
-    print({k: out[k] for k in met_keys})
+    for pred_file in pred_files:
+        out = grnd_eval.eval_ground_acc(
+            pred_file, split_type=split_type, nproc=nproc)
+        print(pred_file, {k: out[k] for k in met_keys})
     # print(Counter(grnd_eval.stuff))
     # return out
     return
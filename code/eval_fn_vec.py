@@ -0,0 +1,813 @@
+"""
+Vectorized version of eval_fn_corr.
+The groundable srl-args of the split and their gt boxes are
+flattened into arrays, the predictions are stacked, and the
+per-frame IoUs are computed in a single box_iou_aligned call.
+avg1, avg1_cons, avg1_vidf, avg1_strict (and the classwise
+dicts) are then array reductions. Results are the same as
+GroundEval_SEP/TEMP/SPAT, check with check_vec_parity.
+"""
+import _init_stuff
+import time
+import pickle
+import hashlib
+from pathlib import Path
+import numpy as np
+import torch
+import fire
+from munch import Munch
+from box_utils import box_iou_aligned
+from eval_fn_corr import (
+    GroundEval_SEP,
+    GroundEval_TEMP,
+    GroundEval_SPAT,
+    get_comm,
+    list_of_dicts_avg
+)
+
+# rank of a frame with no gt box
+NO_FRM = 1 << 30
+# prediction columns used for scoring
+PRED_KEYS = ['pred_boxes', 'pred_scores', 'pred_cmp',
+             'targ_cmp', 'idx_verbs', 'cmp_msk']
+
+
+def ranges_to_inds(starts, ends):
+    """
+    Concatenation of np.arange(st, en) for each (st, en)
+    """
+    lens = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+    return offsets + np.arange(lens.sum())
+
+
+def most_common(vals, num_vals):
+    """
+    vals: S x N ints in [0, num_vals)
+    Most common value per row, ties go to the value
+    seen first (same as Counter.most_common)
+    """
+    N = vals.shape[1]
+    # S x N x num_vals
+    one_hot = vals[..., None] == np.arange(num_vals)
+    counts = one_hot.sum(1)
+    first_pos = np.where(one_hot.any(1), one_hot.argmax(1), N)
+    return (counts * (N + 1) - first_pos).argmax(1)
+
+
+def get_files_hash(files):
+    md5 = hashlib.md5()
+    for fname in files:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+class GroundEvalVec_SEP(GroundEval_SEP):
+    def after_init(self):
+        super().after_init()
+        # split_type -> gt arrays
+        self.gt_arrays = {}
+
+    def get_gt_cache_file(self, split_type):
+        gt_cache_dir = self.cfg.ds.gt_cache_dir
+        if gt_cache_dir == '':
+            return None
+        files_hash = get_files_hash(
+            [self.cfg.ds.val_ds4_inds, self.cfg.ds.anet_ent_annot_file])
+        return Path(gt_cache_dir) / (
+            f'gt_arrays_{split_type}_{files_hash[:16]}.pkl')
+
+    def get_gt_arrays(self, split_type):
+        """
+        gt arrays are built once per split. If ds.gt_cache_dir
+        is given, they are saved there keyed by the hash of the
+        annotation files (and loaded if present).
+        """
+        if split_type in self.gt_arrays:
+            return self.gt_arrays[split_type]
+        cache_file = self.get_gt_cache_file(split_type)
+        if cache_file is not None and cache_file.exists():
+            with open(cache_file, 'rb') as f:
+                gt = Munch(pickle.load(f))
+        else:
+            gt = self.prepare_gt_arrays()
+            if cache_file is not None:
+                cache_file.parent.mkdir(exist_ok=True, parents=True)
+                with open(cache_file, 'wb') as f:
+                    pickle.dump(dict(gt), f)
+        self.add_gt_lookups(gt)
+        self.gt_arrays[split_type] = gt
+        return gt
+
+    def add_gt_lookups(self, gt):
+        """
+        Position of each sentence, offsets of the srl-args of
+        each sentence (arg_ptr) and of the boxes of each srl-arg
+        (box_ptr), and the class (lemma_verb) ids, in order of
+        first appearance
+        """
+        gt.sent_pos = {sent_ind: ix for ix, sent_ind in enumerate(
+            gt.sent_inds.tolist())}
+        gt.arg_ptr = np.concatenate([[0], np.cumsum(np.bincount(
+            gt.arg_sent, minlength=len(gt.sent_inds)))])
+        gt.box_ptr = np.concatenate([[0], np.cumsum(np.bincount(
+            gt.box_arg, minlength=len(gt.arg_sent)))])
+        gt.cls_names = list(dict.fromkeys(gt.lemmas))
+        cls_ids = {lemma: ix for ix, lemma in enumerate(gt.cls_names)}
+        gt.sent_cls = np.array([cls_ids[lemma] for lemma in gt.lemmas])
+
+    def select_gt(self, gt, sent_pos):
+        """
+        gt arrays of the sentences at sent_pos (in that order)
+        """
+        arg_inds = ranges_to_inds(
+            gt.arg_ptr[sent_pos], gt.arg_ptr[sent_pos + 1])
+        box_inds = ranges_to_inds(
+            gt.box_ptr[arg_inds], gt.box_ptr[arg_inds + 1])
+        return Munch({
+            'sent_inds': gt.sent_inds[sent_pos],
+            'lemmas': [gt.lemmas[ix] for ix in sent_pos],
+            'arg_sent': np.repeat(
+                np.arange(len(sent_pos)),
+                gt.arg_ptr[sent_pos + 1] - gt.arg_ptr[sent_pos]),
+            'arg_srl': gt.arg_srl[arg_inds],
+            'arg_names': gt.arg_names[arg_inds],
+            'box_arg': np.repeat(
+                np.arange(len(arg_inds)),
+                gt.box_ptr[arg_inds + 1] - gt.box_ptr[arg_inds]),
+            'box_frm': gt.box_frm[box_inds],
+            'box_xyxy': gt.box_xyxy[box_inds],
+        })
+
+    def get_anet_ann_row(self, vid_seg):
+        vid, seg = vid_seg.split('_segment_')
+        seg = str(int(seg))
+        return self.anet_annots[vid]['segments'][seg]
+
+    def prepare_gt_arrays(self):
+        """
+        Sentences with at least one groundable srl-arg,
+        the srl-args (arg_*) and their gt boxes (box_*)
+        """
+        sent_inds, lemmas = [], []
+        arg_sent, arg_srl, arg_names = [], [], []
+        box_arg, box_frm, box_xyxy = [], [], []
+        for gt_row_ind, req_cls_pats_mask, vid_seg, lemma_verb in zip(
+                self.srl_annots.index,
+                self.srl_annots.req_cls_pats_mask,
+                self.srl_annots.vid_seg,
+                self.srl_annots.lemma_verb
+        ):
+            anet_ann_row = None
+            for srl_ind, (
+                    srl_arg,
+                    srl_arg_box_indicator,
+                    srl_arg_box_ind
+            ) in enumerate(req_cls_pats_mask):
+                if srl_arg_box_indicator != 1:
+                    continue
+                if anet_ann_row is None:
+                    anet_ann_row = self.get_anet_ann_row(vid_seg)
+                arg_sent.append(len(sent_inds))
+                arg_srl.append(srl_ind)
+                arg_names.append(srl_arg)
+                for box_ind in srl_arg_box_ind:
+                    box_arg.append(len(arg_srl) - 1)
+                    box_xyxy.append(anet_ann_row['bbox'][box_ind][:4])
+                    box_frm.append(anet_ann_row['frm_idx'][box_ind])
+            if anet_ann_row is not None:
+                sent_inds.append(gt_row_ind)
+                lemmas.append(lemma_verb)
+
+        return Munch({
+            'sent_inds': np.array(sent_inds),
+            'lemmas': lemmas,
+            'arg_sent': np.array(arg_sent, dtype=np.int64),
+            'arg_srl': np.array(arg_srl, dtype=np.int64),
+            'arg_names': np.array(arg_names),
+            'box_arg': np.array(box_arg, dtype=np.int64),
+            'box_frm': np.array(box_frm, dtype=np.int64),
+            'box_xyxy': torch.tensor(box_xyxy).float().numpy(),
+        })
+
+    def prepare_pred_arrays(self, pred_df, sent_inds):
+        """
+        Predictions stacked in the order of sent_inds
+        """
+        pred_df1 = pred_df.set_index('idx_sent').loc[sent_inds]
+        return self.stack_pred_cols(
+            {k: np.array(pred_df1[k].tolist()) for k in PRED_KEYS})
+
+    def stack_pred_cols(self, pred_cols):
+        """
+        pred_cols: Dict[str, ndarray], each of size S x ...
+        """
+        def stack_col(k, dtype):
+            return np.asarray(pred_cols[k]).astype(dtype)
+
+        return Munch({
+            # S x num_srl_args x num_cmp x num_frms x prop_dim
+            'pred_boxes': stack_col('pred_boxes', np.float32)[..., :4],
+            # S x num_srl_args x num_cmp x num_frms
+            'pred_scores': stack_col('pred_scores', np.float64),
+            # S x num_srl_args x num_frms
+            'pred_cmp': stack_col('pred_cmp', np.int64),
+            'targ_cmp': stack_col('targ_cmp', np.int64),
+            # S x num_cmp
+            'idx_verbs': stack_col('idx_verbs', np.int64),
+            'cmp_msk': stack_col('cmp_msk', np.int64),
+        })
+
+    def box_hits(self, pred_boxes, pred_scores, gt_boxes):
+        """
+        pred_boxes, gt_boxes: N x 4, pred_scores: N
+        """
+        ious = box_iou_aligned(
+            torch.from_numpy(pred_boxes), torch.from_numpy(gt_boxes)
+        ).numpy()
+        return (ious > 0.5) & (pred_scores > self.prob_thresh)
+
+    def compute_arg_outs(self, gt, pred, arg_srl):
+        """
+        Returns for each srl-arg if it is correct
+        and its pred_cmp (as in compute_one_srl)
+        """
+        S = len(gt.sent_inds)
+        num_cmp = pred.pred_scores.shape[2]
+        p0_fixed = most_common(pred.pred_cmp.reshape(S, -1), num_cmp)
+
+        box_sent = gt.arg_sent[gt.box_arg]
+        box_srl = arg_srl[gt.box_arg]
+        box_cmp = p0_fixed[box_sent]
+        hit = self.box_hits(
+            pred.pred_boxes[box_sent, box_srl, box_cmp, gt.box_frm],
+            pred.pred_scores[box_sent, box_srl, box_cmp, gt.box_frm],
+            gt.box_xyxy
+        )
+        hit_arg = np.bincount(
+            gt.box_arg, weights=hit, minlength=len(gt.arg_sent)) > 0
+
+        vid_cor = p0_fixed == pred.targ_cmp
+        return hit_arg & vid_cor[gt.arg_sent], p0_fixed[gt.arg_sent]
+
+    def compute_cons_vidf_vec(self, num_valid, all_same, first_pcmp, targ_cmp):
+        """
+        num_valid: number of considered srl-args per sentence
+        all_same: if all of them have the same pred_cmp
+        first_pcmp: pred_cmp of the first one
+        """
+        cons = num_valid > 0
+        vid_cor = cons & (first_pcmp == targ_cmp)
+        return cons, vid_cor
+
+    def get_avgs_for_inds(self, res_arrs, tot, inds):
+        """
+        Same as compute_avgs_using_res on the sentences inds
+        (sorted by sentence index)
+        """
+        tot_np = tot[inds]
+        avg1 = {k: res_arrs[k][inds].sum() / tot_np.sum()
+                for k in self.res_dicts}
+        avg2 = {k: np.divide(res_arrs[k][inds], tot_np).mean()
+                for k in self.res_dicts}
+        return avg1, avg2
+
+    def compute_sent_arrs(self, gt, pred):
+        """
+        Per sentence results (res_arrs, tot) and
+        per srl-arg correctness, for the sentences of gt
+        """
+        S = len(gt.sent_inds)
+        num_srl_args = pred.pred_boxes.shape[1]
+        assert (pred.idx_verbs[np.arange(S), pred.targ_cmp] ==
+                gt.sent_inds).all()
+
+        # srl-args beyond num_srl_args are counted, never correct
+        valid = gt.arg_srl < num_srl_args
+        arg_srl = np.minimum(gt.arg_srl, num_srl_args - 1)
+        correct, arg_pcmp = self.compute_arg_outs(gt, pred, arg_srl)
+        correct = correct & valid
+
+        def sent_sum(arg_vals):
+            return np.bincount(
+                gt.arg_sent, weights=arg_vals, minlength=S
+            ).astype(np.int64)
+
+        tot = sent_sum(np.ones(len(gt.arg_sent)))
+        res = sent_sum(correct)
+        num_valid = sent_sum(valid)
+
+        uniq_sent, first_arg = np.unique(
+            gt.arg_sent[valid], return_index=True)
+        first_pcmp = np.full(S, NO_FRM, dtype=np.int64)
+        first_pcmp[uniq_sent] = arg_pcmp[valid][first_arg]
+        num_same = sent_sum(valid & (arg_pcmp == first_pcmp[gt.arg_sent]))
+        cons, vid_cor = self.compute_cons_vidf_vec(
+            num_valid, num_same == num_valid, first_pcmp, pred.targ_cmp)
+
+        res_arrs = {
+            'res_dict': res,
+            'cons_dict': tot * cons,
+            'vidf_dict': tot * vid_cor,
+            'strict_res_dict': (res == tot) * tot,
+        }
+        return res_arrs, tot, correct
+
+    def eval_ground_acc(self, predict_file, split_type='valid', nproc=1,
+                        subset=False):
+        """
+        Same as GroundEval_Corr.eval_ground_acc
+        nproc is not used, already vectorized
+        """
+        self.prepare_gt(split_type)
+        gt = self.get_gt_arrays(split_type)
+        pred_df = self.prepare_preds(predict_file)
+        if subset:
+            sent_pos = np.flatnonzero(
+                np.isin(gt.sent_inds, pred_df.idx_sent.values))
+            gt = self.select_gt(gt, sent_pos)
+            self.add_gt_lookups(gt)
+        pred = self.prepare_pred_arrays(pred_df, gt.sent_inds)
+        res_arrs, tot, correct = self.compute_sent_arrs(gt, pred)
+
+        sent_order = np.argsort(gt.sent_inds, kind='stable')
+        res_dicts_avg1, res_dicts_avg2 = self.get_avgs_for_inds(
+            res_arrs, tot, sent_order)
+        res_key_to_use = self.res_dicts[0]
+
+        # by class, then by sentence index
+        cls_order = np.lexsort((gt.sent_inds, gt.sent_cls))
+        cls_inds = np.split(
+            cls_order,
+            np.cumsum(np.bincount(
+                gt.sent_cls, minlength=len(gt.cls_names)))[:-1]
+        )
+        cls_avg = [self.get_avgs_for_inds(res_arrs, tot, inds)
+                   for inds in cls_inds]
+
+        macro_res1, macro_res2 = zip(*cls_avg)
+        macro_avg1 = list_of_dicts_avg(macro_res1)
+        macro_avg2 = list_of_dicts_avg(macro_res2)
+
+        sent_list = gt.sent_inds.tolist()
+        classwise_dict = {
+            lemma: (
+                {k: dict(zip(gt.sent_inds[inds].tolist(),
+                             res_arrs[k][inds].tolist()))
+                 for k in self.res_dicts},
+                dict(zip(gt.sent_inds[inds].tolist(), tot[inds].tolist()))
+            )
+            for lemma, inds in zip(gt.cls_names, cls_inds)
+        }
+
+        # accuracy per srl-arg type (ARG0, ARG1, ...)
+        arg_types, arg_type_ids = np.unique(
+            gt.arg_names, return_inverse=True)
+        arg_type_avg1 = dict(zip(
+            arg_types.tolist(),
+            (np.bincount(arg_type_ids, weights=correct) /
+             np.bincount(arg_type_ids)).tolist()
+        ))
+
+        out_dict = {
+            'avg1': res_dicts_avg1[res_key_to_use],
+            'avg2': res_dicts_avg2[res_key_to_use],
+            'macro_avg1': macro_avg1[res_key_to_use],
+            'macro_avg2': macro_avg2[res_key_to_use],
+            'res_dicts_avg1': res_dicts_avg1,
+            'res_dicts_macro_avg1': macro_avg1,
+            'classwise_dict': classwise_dict,
+            'arg_type_avg1': arg_type_avg1,
+            'sent_inds': sent_list,
+            'gt_df': self.srl_annots
+        }
+        return self.post_proc_final(out_dict)
+
+    def init_stream_stats(self, split_type='valid'):
+        """
+        Running sums for streaming evaluation, per class:
+        res (per res_dict), res / tot (per res_dict), tot, #sentences
+        """
+        self.prepare_gt(split_type)
+        gt = self.get_gt_arrays(split_type)
+        self.stream_gt = gt
+        return np.zeros((len(gt.cls_names), 2 * len(self.res_dicts) + 2))
+
+    def update_stream_stats(self, stats, pred_cols):
+        """
+        Score a batch of predictions (columns as in
+        PredStore) and add it to stats
+        """
+        gt_all = self.stream_gt
+        keep = [ix for ix, sent_ind in enumerate(pred_cols['idx_sent'])
+                if sent_ind in gt_all.sent_pos]
+        if len(keep) == 0:
+            return stats
+        sent_pos = np.array([gt_all.sent_pos[sent_ind]
+                             for sent_ind in pred_cols['idx_sent'][keep]])
+        gt = self.select_gt(gt_all, sent_pos)
+        pred = self.stack_pred_cols({k: v[keep] for k, v in pred_cols.items()})
+        res_arrs, tot, _ = self.compute_sent_arrs(gt, pred)
+
+        sent_cls = gt_all.sent_cls[sent_pos]
+        num_keys = len(self.res_dicts)
+        for kix, k in enumerate(self.res_dicts):
+            np.add.at(stats[:, kix], sent_cls, res_arrs[k])
+            np.add.at(stats[:, num_keys + kix], sent_cls, res_arrs[k] / tot)
+        np.add.at(stats[:, -2], sent_cls, tot)
+        np.add.at(stats[:, -1], sent_cls, 1)
+        return stats
+
+    def stream_stats_to_acc(self, stats):
+        """
+        Same averages as eval_ground_acc from the summed stats.
+        avg1 (and macro_avg1) are exact, avg2 are up to
+        the order of summation.
+        """
+        num_keys = len(self.res_dicts)
+        res_sum = stats[:, :num_keys]
+        ratio_sum = stats[:, num_keys:2 * num_keys]
+        tot_sum = stats[:, -2]
+        num_sents = stats[:, -1]
+        # classes seen
+        cls_msk = num_sents > 0
+
+        res_dicts_avg1 = dict(zip(
+            self.res_dicts, res_sum.sum(0) / tot_sum.sum()))
+        res_dicts_avg2 = dict(zip(
+            self.res_dicts, ratio_sum.sum(0) / num_sents.sum()))
+        macro_avg1 = dict(zip(self.res_dicts, (
+            res_sum[cls_msk] / tot_sum[cls_msk, None]).mean(0)))
+        macro_avg2 = dict(zip(self.res_dicts, (
+            ratio_sum[cls_msk] / num_sents[cls_msk, None]).mean(0)))
+
+        res_key_to_use = self.res_dicts[0]
+        out_dict = {
+            'avg1': res_dicts_avg1[res_key_to_use],
+            'avg2': res_dicts_avg2[res_key_to_use],
+            'macro_avg1': macro_avg1[res_key_to_use],
+            'macro_avg2': macro_avg2[res_key_to_use],
+            'res_dicts_avg1': res_dicts_avg1,
+            'res_dicts_macro_avg1': macro_avg1,
+            'num_sents': int(num_sents.sum())
+        }
+        return self.post_proc_final(out_dict)
+
+
+class GroundEvalVec_TEMP(GroundEvalVec_SEP, GroundEval_TEMP):
+    def get_frm_ranks(self, idx_verbs, num_frms):
+        """
+        S x num_cmp x num_frms, position of the first gt box
+        in each frame of the video of idx_verbs (NO_FRM if none)
+        """
+        vid_segs = self.srl_annots1.vid_seg.loc[
+            idx_verbs.reshape(-1)].tolist()
+        frm_ranks_for_vid = {}
+        for vid_seg in set(vid_segs):
+            frm_ranks = np.full(num_frms, NO_FRM, dtype=np.int64)
+            gt_frms = self.get_anet_ann_row(vid_seg)['frm_idx']
+            for pos, frm_idx in reversed(list(enumerate(gt_frms))):
+                frm_ranks[frm_idx] = pos
+            frm_ranks_for_vid[vid_seg] = frm_ranks
+        return np.stack(
+            [frm_ranks_for_vid[vid_seg] for vid_seg in vid_segs]
+        ).reshape(*idx_verbs.shape, num_frms)
+
+    def compute_arg_outs(self, gt, pred, arg_srl):
+        """
+        Correct if a box in the target video is correct and no
+        other video has a confident box in its annotated frames.
+        Otherwise pred_cmp is the other video with the most confident
+        box (in its first such frame), -1 if none.
+        """
+        num_cmp, num_frms = pred.pred_scores.shape[2:]
+        arg_targ = pred.targ_cmp[gt.arg_sent]
+
+        box_sent = gt.arg_sent[gt.box_arg]
+        box_srl = arg_srl[gt.box_arg]
+        box_cmp = arg_targ[gt.box_arg]
+        hit = self.box_hits(
+            pred.pred_boxes[box_sent, box_srl, box_cmp, gt.box_frm],
+            pred.pred_scores[box_sent, box_srl, box_cmp, gt.box_frm],
+            gt.box_xyxy
+        )
+        hit_arg = np.bincount(
+            gt.box_arg, weights=hit, minlength=len(gt.arg_sent)) > 0
+
+        # num_args x num_cmp x num_frms
+        arg_scores = pred.pred_scores[gt.arg_sent, arg_srl]
+        frm_ranks = self.get_frm_ranks(pred.idx_verbs, num_frms)[gt.arg_sent]
+        offend = (arg_scores > self.prob_thresh) & (frm_ranks < NO_FRM)
+        other_vid = (
+            (np.arange(num_cmp) != arg_targ[:, None]) &
+            (pred.cmp_msk[gt.arg_sent] == 1)
+        )
+        # num_args x num_cmp
+        viol = offend.any(-1) & other_vid
+        first_frm = np.where(offend, frm_ranks, NO_FRM).argmin(-1)
+        first_score = np.take_along_axis(
+            arg_scores, first_frm[..., None], axis=-1)[..., 0]
+        viol_vid = np.where(viol, first_score, -np.inf).argmax(-1)
+
+        correct = hit_arg & ~viol.any(-1)
+        arg_pcmp = np.where(
+            correct, arg_targ, np.where(viol.any(-1), viol_vid, -1))
+        return correct, arg_pcmp
+
+    def compute_cons_vidf_vec(self, num_valid, all_same, first_pcmp, targ_cmp):
+        cons = (num_valid > 0) & all_same & (first_pcmp >= 0)
+        vid_cor = cons & (first_pcmp == targ_cmp)
+        return cons, vid_cor
+
+
+class GroundEvalVec_SPAT(GroundEvalVec_SEP, GroundEval_SPAT):
+    def compute_arg_outs(self, gt, pred, arg_srl):
+        """
+        Correct if in every gt frame the chosen video is the target
+        with a correct box, and in the other frames no other video
+        is confident. Otherwise pred_cmp is -(most confident frame
+        without gt), -5 if none.
+        """
+        num_args = len(gt.arg_sent)
+        num_frms = pred.pred_scores.shape[-1]
+        frms = np.arange(num_frms)
+        arg_targ = pred.targ_cmp[gt.arg_sent]
+
+        # num_args x num_frms, video chosen in each frame
+        arg_pcmp = pred.pred_cmp[gt.arg_sent, arg_srl]
+        arg_scores = pred.pred_scores[
+            gt.arg_sent[:, None], arg_srl[:, None], arg_pcmp, frms]
+        # num_args x num_frms x 4
+        arg_boxes = pred.pred_boxes[
+            gt.arg_sent[:, None], arg_srl[:, None], arg_pcmp, frms]
+
+        # gt boxes in the frames concatenated side by side
+        gt_boxes = gt.box_xyxy.copy()
+        gt_boxes[:, [0, 2]] += 720 * arg_targ[gt.box_arg, None]
+        hit = self.box_hits(
+            arg_boxes[gt.box_arg, gt.box_frm],
+            arg_scores[gt.box_arg, gt.box_frm],
+            gt_boxes
+        ) & (arg_pcmp[gt.box_arg, gt.box_frm] == arg_targ[gt.box_arg])
+
+        gt_frm_msk = np.zeros((num_args, num_frms), dtype=bool)
+        gt_frm_msk[gt.box_arg, gt.box_frm] = True
+        frm_ok_gt = np.zeros((num_args, num_frms), dtype=bool)
+        np.logical_or.at(frm_ok_gt, (gt.box_arg, gt.box_frm), hit)
+        frm_ok_nogt = ~(
+            (arg_pcmp != arg_targ[:, None]) &
+            (arg_scores > self.prob_thresh)
+        )
+        correct = np.where(gt_frm_msk, frm_ok_gt, frm_ok_nogt).all(-1)
+
+        nogt_frm = np.where(gt_frm_msk, -np.inf, arg_scores).argmax(-1)
+        arg_pcmp = np.where(
+            correct, arg_targ,
+            np.where(gt_frm_msk.all(-1), -5, -nogt_frm)
+        )
+        return correct, arg_pcmp
+
+    def compute_cons_vidf_vec(self, num_valid, all_same, first_pcmp, targ_cmp):
+        cons = (num_valid > 0) & all_same
+        vid_cor = cons & (first_pcmp == targ_cmp) & (first_pcmp >= 0)
+        return cons, vid_cor
+
+
+def get_grnd_eval(cfg, comm, vec=True):
+    conc_type = cfg.ds.conc_type
+    if conc_type == 'sep' or conc_type == 'svsq':
+        grnd_cls = GroundEvalVec_SEP if vec else GroundEval_SEP
+    elif conc_type == 'temp':
+        grnd_cls = GroundEvalVec_TEMP if vec else GroundEval_TEMP
+    elif conc_type == 'spat':
+        grnd_cls = GroundEvalVec_SPAT if vec else GroundEval_SPAT
+    else:
+        raise NotImplementedError
+    return grnd_cls(cfg, comm)
+
+
+def assert_same_results(out_corr, out_vec, tol=1e-9):
+    """
+    Metrics and classwise_dict of eval_fn_corr (out_corr)
+    and of the vectorized evaluator (out_vec) agree within tol
+    """
+    met_keys = ['avg1', 'avg2', 'macro_avg1', 'macro_avg2',
+                'avg1_cons', 'avg1_vidf', 'avg1_strict',
+                'macro_avg1_cons', 'macro_avg1_vidf', 'macro_avg1_strict']
+    for k in met_keys:
+        print(k, out_corr[k], out_vec[k])
+        assert np.isclose(out_corr[k], out_vec[k], rtol=0, atol=tol), k
+
+    cls_corr = out_corr['classwise_dict']
+    cls_vec = out_vec['classwise_dict']
+    assert list(cls_corr.keys()) == list(cls_vec.keys())
+    for lemma in cls_corr:
+        (res_corr, tot_corr), (res_vec, tot_vec) = (
+            cls_corr[lemma], cls_vec[lemma])
+        assert tot_corr == tot_vec, lemma
+        assert res_corr.keys() == res_vec.keys(), lemma
+        for k in res_corr:
+            assert res_corr[k].keys() == res_vec[k].keys(), (lemma, k)
+            for sent_ind, val in res_corr[k].items():
+                assert np.isclose(
+                    val, res_vec[k][sent_ind], rtol=0, atol=tol
+                ), (lemma, k, sent_ind)
+
+
+def check_vec_parity(pred_file, split_type='valid', tol=1e-9, **kwargs):
+    """
+    Compare the vectorized evaluator with eval_fn_corr
+    on a predictions file (pkl or npz)
+    """
+    from extended_config import (
+        cfg as conf,
+        key_maps,
+        update_from_dict,
+    )
+    cfg = conf
+    cfg = update_from_dict(cfg, kwargs, key_maps)
+    comm = get_comm(cfg)
+
+    outs = {}
+    for vec in [False, True]:
+        grnd_eval = get_grnd_eval(cfg, comm, vec=vec)
+        st_time = time.time()
+        outs[vec] = grnd_eval.eval_ground_acc(
+            pred_file, split_type=split_type)
+        print(f'vec={vec}: {time.time() - st_time:.2f}s')
+
+    assert_same_results(outs[False], outs[True], tol=tol)
+    print('Same results')
+
+
+# fixture for check_vec_fixture
+# vid_seg -> gt boxes (x1, y1, x2, y2) and their frames,
+# frames without a box are empty (e.g. frame 3 of v_a)
+FIX_VIDS = {
+    'v_a_segment_00': ([[10, 10, 50, 50], [60, 20, 120, 80],
+                        [15, 15, 55, 60], [200, 100, 260, 180]],
+                       [0, 1, 1, 2]),
+    'v_b_segment_00': ([[30, 40, 90, 100], [100, 100, 150, 160],
+                        [5, 5, 40, 30]],
+                       [0, 2, 2]),
+    'v_c_segment_01': ([[0, 0, 100, 100], [300, 200, 400, 300]],
+                       [1, 3]),
+    'v_d_segment_00': ([[50, 50, 90, 90], [20, 30, 60, 70]],
+                       [0, 2]),
+}
+# sentence index -> vid_seg, lemma_verb, req_cls_pats_mask
+FIX_SENTS = [
+    ('v_a_segment_00', 'cut',
+     [('ARG0', 1, [0]), ('V', 0, []), ('ARG1', 1, [1, 2])]),
+    ('v_b_segment_00', 'cut', [('ARG0', 1, [0]), ('ARG1', 1, [1, 2])]),
+    ('v_c_segment_01', 'pour', [('ARG0', 1, [0]), ('ARG1', 1, [1])]),
+    # more srl-args than num_srl_args in the predictions
+    ('v_d_segment_00', 'pour',
+     [('ARG0', 1, [0]), ('ARG1', 1, [1]), ('ARG2', 1, [0]),
+      ('ARGM-LOC', 1, [1])]),
+    ('v_a_segment_00', 'wash', [('ARG0', 1, [3]), ('ARG1', 1, [0])]),
+    # nothing to ground
+    ('v_b_segment_00', 'wash', [('ARG0', 0, []), ('V', 0, [])]),
+    ('v_c_segment_01', 'cut', [('ARG1', 1, [1])]),
+    ('v_d_segment_00', 'open', [('ARG0', 1, [1])]),
+]
+# sentence index -> idx_verbs, targ_cmp, cmp_msk and per groundable
+# srl-arg (chosen video: 't' target / 'o' other, box on the gt or
+# off, score)
+# 'leak': the other video is confident in frame 0
+FIX_PREDS = {
+    0: ([0, 2], 0, [1, 1], [('t', 'gt', 0.9), ('t', 'gt', 0.9)]),
+    1: ([3, 1], 1, [1, 1], [('t', 'gt', 0.9), ('t', 'off', 0.9)]),
+    2: ([2, 4], 0, [1, 1], [('o', 'gt', 0.9), ('o', 'gt', 0.9)]),
+    3: ([6, 3], 1, [1, 1],
+        [('t', 'gt', 0.9), ('o', 'gt', 0.9), ('t', 'gt', 0.9)]),
+    4: ([4, 7], 0, [1, 0], [('t', 'gt', 0.1), ('t', 'gt', 0.9)]),
+    5: ([5, 1], 0, [1, 1], []),
+    6: ([0, 6], 1, [1, 1], [('leak', 'gt', 0.9)]),
+    7: ([7, 5], 0, [1, 1], [('t', 'gt', 0.9)]),
+}
+
+
+def make_eval_fixture(out_dir, conc_type, num_frms=4, num_srl_args=3):
+    """
+    Writes the annotation files and the predictions (pkl)
+    of the fixture to out_dir. Returns the files as cfg keys.
+    """
+    import json
+    import pandas as pd
+    out_dir = Path(out_dir)
+    vid_inds = {vid_seg: ix for ix, vid_seg in enumerate(FIX_VIDS)}
+    pd.DataFrame([{
+        'vt_split': 'val',
+        'vid_seg': vid_seg,
+        'ann_ind': vid_inds[vid_seg],
+        'lemma_verb': lemma,
+        'req_args': [arg[0] for arg in req_cls_pats_mask],
+        'req_cls_pats_mask': req_cls_pats_mask,
+    } for vid_seg, lemma, req_cls_pats_mask in FIX_SENTS]).to_csv(
+        out_dir / 'val_ds4_inds.csv', index=False)
+    pd.DataFrame({'vid_seg': list(FIX_VIDS)}).to_csv(
+        out_dir / 'val_ann.csv', index=False)
+    anet_annots = {}
+    for vid_seg, (boxes, frms) in FIX_VIDS.items():
+        vid, seg = vid_seg.split('_segment_')
+        anet_annots.setdefault(vid, {'segments': {}})['segments'][
+            str(int(seg))] = {'bbox': boxes, 'frm_idx': frms}
+    with open(out_dir / 'anet_ent.json', 'w') as f:
+        json.dump(anet_annots, f)
+
+    off_box = [600, 400, 700, 470, 0]
+    delta = 720 if conc_type == 'spat' else 0
+    preds = []
+    for sent_ind, (idx_verbs, targ_cmp, cmp_msk, arg_specs) in (
+            FIX_PREDS.items()):
+        num_cmp = len(idx_verbs)
+        pred_boxes = np.tile(
+            np.array(off_box, dtype=np.float32),
+            (num_srl_args, num_cmp, num_frms, 1))
+        pred_scores = np.full((num_srl_args, num_cmp, num_frms), 0.05)
+        pred_cmp = np.full((num_srl_args, num_frms), targ_cmp)
+        gt_args = [(srl_ind, arg[2]) for srl_ind, arg in enumerate(
+            FIX_SENTS[sent_ind][2]) if arg[1] == 1]
+        boxes, frms = FIX_VIDS[FIX_SENTS[sent_ind][0]]
+        for (srl_ind, box_inds), (vid, box, score) in zip(
+                gt_args, arg_specs):
+            oth_cmp = 1 - targ_cmp
+            cmp1 = oth_cmp if vid == 'o' else targ_cmp
+            pred_cmp[srl_ind] = cmp1
+            pred_scores[srl_ind, cmp1] = score
+            if box == 'gt':
+                for box_ind in box_inds[::-1]:
+                    pred_boxes[srl_ind, cmp1, frms[box_ind]] = (
+                        boxes[box_ind][:4] + [0])
+                    pred_boxes[srl_ind, cmp1, frms[box_ind], [0, 2]] += (
+                        delta * cmp1)
+            if vid == 'leak':
+                pred_cmp[srl_ind, 0] = oth_cmp
+                pred_scores[srl_ind, oth_cmp, 0] = 0.9
+        preds.append({
+            'idx_sent': sent_ind,
+            'idx_verbs': np.array(idx_verbs),
+            'targ_cmp': targ_cmp,
+            'cmp_msk': np.array(cmp_msk),
+            'pred_boxes': pred_boxes,
+            'pred_scores': pred_scores,
+            'pred_cmp': pred_cmp,
+        })
+    with open(out_dir / 'preds.pkl', 'wb') as f:
+        pickle.dump(preds, f)
+
+    return {
+        'ds.val_ds4_inds': str(out_dir / 'val_ds4_inds.csv'),
+        'ds.val_ann_file': str(out_dir / 'val_ann.csv'),
+        'ds.anet_ent_annot_file': str(out_dir / 'anet_ent.json'),
+        'pred_file': str(out_dir / 'preds.pkl'),
+    }
+
+
+def check_vec_fixture(nproc=1, tol=1e-9):
+    """
+    Compare the vectorized evaluator with eval_fn_corr on
+    the hand-built fixture (FIX_*) for sep, temp and spat.
+    It has correct, wrong box, wrong video, mixed video, low
+    score and leaking (other video confident) srl-args, empty
+    frames, a sentence with nothing to ground and one with more
+    srl-args than predicted, so cons, vidf and strict differ.
+    nproc: processes for eval_fn_corr (eval_sharded)
+    """
+    import tempfile
+    from extended_config import cfg as conf
+    for conc_type in ['sep', 'temp', 'spat']:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fix_files = make_eval_fixture(tmp_dir, conc_type)
+            cfg = conf.clone()
+            cfg.ds.conc_type = conc_type
+            cfg.ds.num_sampled_frm = 4
+            cfg.ds.exp_setting = 'gt5'
+            cfg.ds.gt_cache_dir = ''
+            cfg.train.prob_thresh = 0.2
+            for k in ['val_ds4_inds', 'val_ann_file', 'anet_ent_annot_file']:
+                cfg.ds[k] = fix_files[f'ds.{k}']
+            comm = get_comm(cfg)
+            outs = {}
+            for vec in [False, True]:
+                grnd_eval = get_grnd_eval(cfg, comm, vec=vec)
+                outs[vec] = grnd_eval.eval_ground_acc(
+                    fix_files['pred_file'], nproc=nproc)
+        print(conc_type)
+        assert_same_results(outs[False], outs[True], tol=tol)
+        # the fixture is not trivial (cons is always 1 for sep)
+        for k in ['avg1', 'avg1_cons', 'avg1_vidf', 'avg1_strict']:
+            if k == 'avg1_cons' and conc_type == 'sep':
+                continue
+            assert 0 < outs[True][k] < 1, (conc_type, k)
+    print('Same results')
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'parity': check_vec_parity,
+        'fixture': check_vec_fixture
+    })
@@ -8,28 +8,145 @@ from eval_fn_corr import (
     GroundEval_TEMP,
     GroundEval_SPAT
 )
+from eval_fn_vec import (
+    GroundEvalVec_SEP,
+    GroundEvalVec_TEMP,
+    GroundEvalVec_SPAT
+)
 import pickle
 from fastprogress import progress_bar
 from pathlib import Path
+import numpy as np
 import torch
+import torch.distributed as dist
+from torch.utils.data import Subset
 from trn_utils import (
-    compute_avg_dict,
     is_main_process,
     synchronize,
-    get_world_size
+    get_world_size,
+    get_autocast,
+    all_gather,
+    NewDistributedSampler
 )
 
 
+def pred_cols_to_numpy(pred_cols):
+    """
+    float32 for floating point columns, int32 otherwise
+    """
+    return {
+        k: (v.detach().float() if v.is_floating_point()
+            else v.detach().int()).cpu().numpy()
+        for k, v in pred_cols.items()
+    }
+
+
+def get_num_real_items(dl, rank):
+    """
+    Number of items of this rank which are not padding.
+    NewDistributedSampler gives rank r the items
+    [r * num_samples, (r + 1) * num_samples) of the
+    dataset indices padded with the first ones.
+    Other samplers (EvalDistributedSampler) don't pad.
+    """
+    num_items = len(dl.sampler)
+    if not isinstance(dl.sampler, NewDistributedSampler):
+        return num_items
+    return min(max(len(dl.dataset) - rank * num_items, 0), num_items)
+
+
+class PredStore:
+    """
+    Columnar predictions of one rank.
+    Each column (pred_boxes, idx_sent, ...) is a numpy array
+    preallocated for num_items rows, filled batch by batch.
+    Saved as a single npz, read by GroundEval.prepare_preds
+    """
+
+    def __init__(self, num_items):
+        self.num_items = num_items
+        self.num_filled = 0
+        self.cols = None
+
+    def add(self, pred_cols):
+        """
+        pred_cols: Dict[str, tensor], each of size B x ...
+        """
+        pred_cols = pred_cols_to_numpy(pred_cols)
+        B = len(next(iter(pred_cols.values())))
+        if self.cols is None:
+            self.cols = {
+                k: np.empty((self.num_items, *v.shape[1:]), dtype=v.dtype)
+                for k, v in pred_cols.items()
+            }
+        if self.num_filled + B > self.num_items:
+            # sampler shorter than expected, grow the columns
+            self.num_items = max(2 * self.num_items, self.num_filled + B)
+            self.cols = {
+                k: np.resize(v, (self.num_items, *v.shape[1:]))
+                for k, v in self.cols.items()
+            }
+        for k, v in pred_cols.items():
+            self.cols[k][self.num_filled:self.num_filled + B] = v
+        self.num_filled += B
+
+    def get_cols(self):
+        # a rank can have no items (EvalDistributedSampler)
+        if self.cols is None:
+            return {}
+        return {k: v[:self.num_filled] for k, v in self.cols.items()}
+
+    def truncate(self, num_items):
+        """
+        Drop the rows after num_items (sampler padding)
+        """
+        self.num_filled = min(self.num_filled, num_items)
+
+    def extend_cols(self, other_cols):
+        """
+        Append the columns other_cols, which
+        are empty for a rank without items
+        """
+        if len(other_cols) == 0:
+            return
+        if self.cols is None:
+            self.cols = {k: np.asarray(v) for k, v in other_cols.items()}
+            self.num_filled = self.num_items = len(
+                next(iter(self.cols.values())))
+            return
+        self.cols = {
+            k: np.concatenate([v[:self.num_filled], other_cols[k]])
+            for k, v in self.cols.items()
+        }
+        self.num_filled = self.num_items = len(
+            next(iter(self.cols.values())))
+
+    def extend(self, pred_file):
+        """
+        Append the predictions saved in pred_file
+        """
+        with np.load(pred_file) as other_cols:
+            self.extend_cols(dict(other_cols))
+
+    def save(self, pred_file):
+        with open(pred_file, 'wb') as f:
+            np.savez(f, **self.get_cols())
+
+
 class Evaluator(torch.nn.Module):
     def __init__(self, cfg, comm, device):
         super().__init__()
         self.cfg = cfg
         self.comm = comm
         self.met_keys = ['avg1', 'macro_avg1']
+        # Model outputs used by forward_one_batch
+        self.mdl_out_keys = ['mdl_outs']
         self.num_prop_per_frm = self.comm.num_prop_per_frm
         self.num_frms = self.cfg.ds.num_sampled_frm
         self.num_props = self.num_prop_per_frm * self.num_frms
         self.device = device
+        # autocast dtype, None for fp32 (set by the Learner)
+        self.amp_dtype = None
         self.after_init()
 
     def after_init(self):
@@ -41,14 +158,10 @@ class Evaluator(torch.nn.Module):
         else:
             return out_result['mdl_outs']
 
-    def forward_one_batch(self, out_result, inp):
+    def get_pred_cols(self, out_result, inp):
         """
-        The following should be returned:
-        List[Dict]
-        Dict = {
-            'idx(video)', 'idx(srl)', 'idx(arg)',
-            'pred_boxes', 'pred_scores'
-        }
+        Predictions of the batch as columns
+        Dict[str, tensor], each of size B x ...
         """
         out_result = out_result
         # B x num_verbs x num_srl_args x 1000
@@ -79,66 +192,159 @@ class Evaluator(torch.nn.Module):
                 *out_result_frame_index.shape, 1, prop_dim))
 
         pred_boxes = out_result_boxes.squeeze(-2)
-        out_dict_list = [
-            {
-                'pred_boxes': pb,
-                'pred_scores': ps,
-                'idx_vid': an_ind,
-                'idx_sent': srl_ann,
-                'idx_verb': srl_verb,
-                'num_verbs': nv
-
-            } for pb, ps, an_ind, srl_ann, srl_verb, nv in zip(
-                pred_boxes.detach().cpu().tolist(),
-                out_result_frame_score.detach().cpu().tolist(),
-                inp['ann_idx'].detach().cpu().tolist(),
-                inp['sent_idx'].detach().cpu().tolist(),
-                inp['srl_verb_idxs'].detach().cpu().tolist(),
-                inp['num_verbs'].detach().cpu().tolist()
-            )]
-        return out_dict_list
-
-    def forward(self, model, loss_fn, dl, dl_name,
-                rank=0, pred_path=None, mb=None):
-        fname = Path(pred_path) / f'{dl_name}_{rank}.pkl'
-        # comm = self.comm
-        # cfg = self.cfg
-        model.eval()
-        loss_keys = loss_fn.loss_keys
-        val_losses = {k: [] for k in loss_keys}
-        nums = []
-        results = []
-        for batch in progress_bar(dl, parent=mb):
-            for b in batch.keys():
-                batch[b] = batch[b].to(self.device)
-            b = next(iter(batch.keys()))
-            nums.append(batch[b].size(0))
-            torch.cuda.empty_cache()
-            with torch.no_grad():
-                out = model(batch)
-                out_loss = loss_fn(out, batch)
+        return {
+            'pred_boxes': pred_boxes,
+            'pred_scores': out_result_frame_score,
+            'idx_vid': inp['ann_idx'],
+            'idx_sent': inp['sent_idx'],
+            'idx_verb': inp['srl_verb_idxs'],
+            'num_verbs': inp['num_verbs']
+        }
 
-            for k in out_loss:
-                val_losses[k].append(out_loss[k].detach().cpu())
-            results += self.forward_one_batch(out, batch)
+    def forward_one_batch(self, out_result, inp):
+        """
+        The following should be returned:
+        List[Dict]
+        Dict = {
+            'idx(video)', 'idx(srl)', 'idx(arg)',
+            'pred_boxes', 'pred_scores'
+        }
+        """
+        pred_cols = {
+            k: v.detach().cpu().tolist()
+            for k, v in self.get_pred_cols(out_result, inp).items()
+        }
+        return [dict(zip(pred_cols.keys(), vals))
+                for vals in zip(*pred_cols.values())]
 
-        pickle.dump(results, open(fname, 'wb'))
-        nums = torch.tensor(nums).float()
-        val_loss = compute_avg_dict(val_losses, nums)
+    def save_preds(self, results, fname):
+        if isinstance(results, PredStore):
+            results.save(fname)
+        else:
+            with open(fname, 'wb') as f:
+                pickle.dump(results, f)
 
+    def reduce_val_loss(self, val_losses, nums):
+        """
+        Average of the losses over the items of all ranks,
+        weighted by the batch sizes. Ranks can have a different
+        number of batches (or none at all).
+        """
+        loss_keys = list(val_losses.keys())
+        loss_sums = [(torch.stack(val_losses[k]) * nums).sum()
+                     if len(nums) > 0 else torch.tensor(0.)
+                     for k in loss_keys]
+        # last one is the number of items
+        loss_sums = torch.stack(loss_sums + [nums.sum()]).to(self.device)
+        if get_world_size() > 1:
+            dist.reduce(loss_sums, dst=0)
+        return {k: loss_sums[ix] / loss_sums[-1].clamp(min=1)
+                for ix, k in enumerate(loss_keys)}
+
+    def merge_files(self, results, fname, pred_path, dl_name):
+        """
+        Each rank saves its predictions, rank 0 reads
+        and merges them into fname
+        """
+        pred_fmt = self.cfg.train.pred_fmt
+        self.save_preds(results, fname)
         synchronize()
         if is_main_process():
             curr_results = results
             world_size = get_world_size()
             for w in range(1, world_size):
-                tmp_file = Path(pred_path) / f'{dl_name}_{w}.pkl'
-                with open(tmp_file, 'rb') as f:
-                    tmp_results = pickle.load(f)
-                curr_results += tmp_results
-                tmp_file.unlink
-            with open(fname, 'wb') as f:
-                pickle.dump(curr_results, f)
-            out_acc = self.grnd_eval.eval_ground_acc(fname)
+                tmp_file = Path(pred_path) / f'{dl_name}_{w}.{pred_fmt}'
+                if pred_fmt == 'npz':
+                    curr_results.extend(tmp_file)
+                else:
+                    with open(tmp_file, 'rb') as f:
+                        tmp_results = pickle.load(f)
+                    curr_results += tmp_results
+                tmp_file.unlink()
+            self.save_preds(curr_results, fname)
+
+    def merge_collective(self, results, fname):
+        """
+        Predictions are gathered with all_gather (nccl or gloo),
+        rank 0 saves the merged ones into fname
+        """
+        if isinstance(results, PredStore):
+            all_results = all_gather(results.get_cols())
+        else:
+            all_results = all_gather(results)
+        if is_main_process():
+            curr_results = results
+            for other_results in all_results[1:]:
+                if isinstance(curr_results, PredStore):
+                    curr_results.extend_cols(other_results)
+                else:
+                    curr_results += other_results
+            self.save_preds(curr_results, fname)
+
+    def init_results(self, dl):
+        if self.cfg.train.stream_eval:
+            # scored per batch, only the stats are kept
+            return self.grnd_eval.init_stream_stats()
+        elif self.cfg.train.pred_fmt == 'npz':
+            return PredStore(len(dl.sampler))
+        return []
+
+    def add_results(self, results, out, batch, num_keep):
+        """
+        Add the predictions of a batch, only the first
+        num_keep items are scored for stream_eval
+        """
+        if self.cfg.train.stream_eval:
+            if num_keep > 0:
+                pred_cols = pred_cols_to_numpy(
+                    self.get_pred_cols(out, batch))
+                self.grnd_eval.update_stream_stats(
+                    results, {k: v[:num_keep]
+                              for k, v in pred_cols.items()})
+        elif self.cfg.train.pred_fmt == 'npz':
+            results.add(self.get_pred_cols(out, batch))
+        else:
+            results += self.forward_one_batch(out, batch)
+        return results
+
+    def finish_results(self, results, val_losses, nums, dl,
+                       rank, pred_path, pred_name):
+        """
+        Reduce the losses, merge the predictions of
+        all ranks and compute the metrics on rank 0
+        """
+        pred_fmt = self.cfg.train.pred_fmt
+        stream_eval = self.cfg.train.stream_eval
+        fname = Path(pred_path) / f'{pred_name}_{rank}.{pred_fmt}'
+        val_loss = self.reduce_val_loss(val_losses, nums)
+
+        if stream_eval:
+            stream_stats = torch.from_numpy(results).to(self.device)
+            if get_world_size() > 1:
+                dist.reduce(stream_stats, dst=0)
+            if is_main_process():
+                out_acc = self.grnd_eval.stream_stats_to_acc(
+                    stream_stats.cpu().numpy())
+                val_acc = {k: torch.tensor(v).to(self.device)
+                           for k, v in out_acc.items()
+                           if k in self.met_keys}
+        else:
+            # padding of the sampler repeats the first items
+            num_real_items = get_num_real_items(dl, rank)
+            if pred_fmt == 'npz':
+                results.truncate(num_real_items)
+            else:
+                results = results[:num_real_items]
+            if self.cfg.train.eval_merge == 'collective':
+                self.merge_collective(results, fname)
+            else:
+                self.merge_files(results, fname, pred_path, pred_name)
+
+        if is_main_process() and not stream_eval:
+            # only the gt of the subset queries is scored
+            out_acc = self.grnd_eval.eval_ground_acc(
+                fname, nproc=self.cfg.train.eval_nproc,
+                subset=isinstance(dl.dataset, Subset))
             val_acc = {k: torch.tensor(v).to(self.device)
                        for k, v in out_acc.items() if k in self.met_keys}
             # return val_loss, val_acc
@@ -146,16 +352,77 @@ class Evaluator(torch.nn.Module):
         if is_main_process():
             return val_loss, val_acc
         else:
-            return {k: torch.tensor(0.).to(self.device) for k in loss_keys}, {
+            return {k: torch.tensor(0.).to(self.device)
+                    for k in val_losses}, {
                 k: torch.tensor(0.).to(self.device) for k in self.met_keys}
 
+    def forward_multi(self, models, loss_fn, dl, dl_name,
+                      rank=0, pred_path=None, mb=None, mdl_names=None):
+        """
+        Evaluate several models in one pass over dl, each batch
+        is loaded once and given to all models.
+        Predictions of models[i] are saved as {dl_name}_{mdl_names[i]}
+        Returns a list of (val_loss, val_acc), one per model
+        """
+        if mdl_names is None:
+            assert len(models) == 1
+            pred_names = [dl_name]
+        else:
+            assert len(mdl_names) == len(models)
+            pred_names = [f'{dl_name}_{name}' for name in mdl_names]
+        # comm = self.comm
+        # cfg = self.cfg
+        for model in models:
+            model.eval()
+        loss_keys = loss_fn.loss_keys
+        val_losses = [{k: [] for k in loss_keys} for _ in models]
+        results = [self.init_results(dl) for _ in models]
+        num_real_items = get_num_real_items(dl, rank)
+        num_seen = 0
+        nums = []
+        for batch in progress_bar(dl, parent=mb):
+            for b in batch.keys():
+                batch[b] = batch[b].to(self.device)
+            b = next(iter(batch.keys()))
+            nums.append(batch[b].size(0))
+            num_keep = min(num_real_items - num_seen, nums[-1])
+            num_seen += nums[-1]
+            torch.cuda.empty_cache()
+            for mix, model in enumerate(models):
+                with torch.no_grad(), get_autocast(
+                        self.device, self.amp_dtype):
+                    out = model(batch)
+                    out_loss = loss_fn(out, batch)
+
+                for k in out_loss:
+                    val_losses[mix][k].append(out_loss[k].detach().cpu())
+                results[mix] = self.add_results(
+                    results[mix], out, batch, num_keep)
+
+        nums = torch.tensor(nums).float()
+        return [
+            self.finish_results(results[mix], val_losses[mix], nums, dl,
+                                rank, pred_path, pred_names[mix])
+            for mix in range(len(models))
+        ]
+
+    def forward(self, model, loss_fn, dl, dl_name,
+                rank=0, pred_path=None, mb=None):
+        return self.forward_multi(
+            [model], loss_fn, dl, dl_name,
+            rank=rank, pred_path=pred_path, mb=mb)[0]
+
 
 class EvaluatorSEP(Evaluator):
     def after_init(self):
 
         self.met_keys = ['avg1', 'avg1_cons',
                          'avg1_vidf', 'avg1_strict']
-        self.grnd_eval = GroundEval_SEP(self.cfg, self.comm)
+        self.mdl_out_keys = ['mdl_outs_eval', 'fin_scores']
+        # streaming evaluation needs the vectorized evaluator
+        use_vec = self.cfg.train.vec_eval or self.cfg.train.stream_eval
+        grnd_cls = GroundEvalVec_SEP if use_vec else GroundEval_SEP
+        self.grnd_eval = grnd_cls(self.cfg, self.comm)
 
         self.num_sampled_frm = self.num_frms
 
@@ -219,58 +486,32 @@ class EvaluatorSEP(Evaluator):
             'indexs': vidf_outs
         }
 
-    def forward_one_batch(self, out_result, inp):
+    def get_pred_cols(self, out_result, inp):
         """
-        The following should be returned:
-        List[Dict]
-        Dict = {
-            'idx(video)', 'idx(srl)', 'idx(arg)',
-            'pred_boxes', 'pred_scores'
-        }
+        Predictions of the batch as columns
+        Dict[str, tensor], each of size B x ...
         """
         out_results = self.get_out_results_boxes(out_result, inp)
 
-        out_result_boxes = out_results['boxes']
-        out_result_frame_score = out_results['scores']
-        out_result_frame_index = out_results['indexs']
-
-        # B x num_srl_args x num_cmp x num_frms x num_props
-        pred_boxes = out_result_boxes
+        # B x num_srl_args x num_cmp x num_frms x prop_dim
+        pred_boxes = out_results['boxes']
         # B x num_srl_args x num_frms
-        pred_cmp = out_result_frame_index
+        pred_cmp = out_results['indexs']
         # B x num_srl_args x num_cmp x num_frms
-        pred_score = out_result_frame_score
-        targ_cmp = inp['target_cmp'].detach().cpu().tolist()
-        perm_list = inp['permute'].detach().cpu().tolist()
-        perm_inv_list = inp['permute_inv'].detach().cpu().tolist()
-
-        out_dict_list = [
-            {
-                'pred_boxes': pb,
-                'pred_scores': ps,
-                'pred_cmp': pc,
-                'idx_vid': an_ind,
-                'idx_verbs': srl_idxs,
-                'idx_sent': srl_ann,
-                'cmp_msk': cmp_msk,
-                'targ_cmp': tcmp,
-                'perm': perm,
-                'perm_inv': perm_inv,
-
-            } for pb, ps, pc, an_ind, srl_idxs, srl_ann, cmp_msk,
-            tcmp, perm, perm_inv in zip(
-                pred_boxes.detach().cpu().tolist(),
-                pred_score.detach().cpu().tolist(),
-                pred_cmp.detach().cpu().tolist(),
-                inp['ann_idx'].detach().cpu().tolist(),
-                inp['new_srl_idxs'].detach().cpu().tolist(),
-                inp['sent_idx'].detach().cpu().tolist(),
-                inp['num_cmp_msk'].detach().cpu().tolist(),
-                targ_cmp,
-                perm_list,
-                perm_inv_list
-            )]
-        return out_dict_list
+        pred_score = out_results['scores']
+
+        return {
+            'pred_boxes': pred_boxes,
+            'pred_scores': pred_score,
+            'pred_cmp': pred_cmp,
+            'idx_vid': inp['ann_idx'],
+            'idx_verbs': inp['new_srl_idxs'],
+            'idx_sent': inp['sent_idx'],
+            'cmp_msk': inp['num_cmp_msk'],
+            'targ_cmp': inp['target_cmp'],
+            'perm': inp['permute'],
+            'perm_inv': inp['permute_inv'],
+        }
 
 
 class EvaluatorTEMP(EvaluatorSEP):
@@ -280,7 +521,10 @@ class EvaluatorTEMP(EvaluatorSEP):
 
         self.met_keys = ['avg1', 'avg1_cons',
                          'avg1_vidf', 'avg1_strict']
-        self.grnd_eval = GroundEval_TEMP(self.cfg, self.comm)
+        self.mdl_out_keys = ['mdl_outs_eval']
+        use_vec = self.cfg.train.vec_eval or self.cfg.train.stream_eval
+        grnd_cls = GroundEvalVec_TEMP if use_vec else GroundEval_TEMP
+        self.grnd_eval = grnd_cls(self.cfg, self.comm)
 
         # self.num_sampled_frm = self.cfg.misc.num_sampled_frm
         self.num_sampled_frm = self.num_frms
@@ -348,7 +592,10 @@ class EvaluatorTEMP(EvaluatorSEP):
 class EvaluatorSPAT(EvaluatorSEP):
     def after_init(self):
         self.met_keys = ['avg1', 'avg1_cons', 'avg1_vidf', 'avg1_strict']
-        self.grnd_eval = GroundEval_SPAT(self.cfg, self.comm)
+        self.mdl_out_keys = ['mdl_outs_eval']
+        use_vec = self.cfg.train.vec_eval or self.cfg.train.stream_eval
+        grnd_cls = GroundEvalVec_SPAT if use_vec else GroundEval_SPAT
+        self.grnd_eval = grnd_cls(self.cfg, self.comm)
 
         self.num_sampled_frm = self.num_frms
         # self.num_sampled_frm = self.cfg.misc.num_sampled_frm
@@ -0,0 +1,351 @@
+"""
+In-process grounding service for the SEP models.
+A request is a query (srl row of the ASRL file) and a list of
+vid_seg ids. Concurrent requests are merged into a batch of
+at most max_batch, waiting at most max_wait_ms after the first
+one. The visual encoding (prop_seg_feats, seg_feats) of each
+video is cached, so only new videos go through the visual
+encoders. Results are per-frame boxes/scores as given by
+EvaluatorSEP.get_out_results_boxes.
+"""
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+import torch
+import fire
+
+from dat_loader_simple import get_data, RAGGED_KEYS
+from mdl_selector import get_mdl_loss_eval
+from mdl_export import load_mdl_ckpt
+from extended_config import (
+    cfg as conf,
+    key_maps,
+    update_from_dict,
+    post_proc_config
+)
+
+# Inputs only needed by the visual encoders, not cached
+VIS_KEYS = ['pad_region_feature', 'seg_feature_for_frms']
+
+
+class GrndRequest:
+    def __init__(self, srl_row, vid_seg_ids):
+        self.srl_row = srl_row
+        self.vid_seg_ids = vid_seg_ids
+        self.arrival = time.time()
+        self.future = Future()
+
+
+class GrndService:
+    def __init__(self, cfg, mdl, ds, eval_fn, device,
+                 max_batch=8, max_wait_ms=20., cache_size=1024):
+        assert cfg.ds.conc_type == 'sep'
+        self.cfg = cfg
+        self.mdl = mdl
+        self.ds = ds
+        self.eval_fn = eval_fn
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+
+        self.vid_seg_to_ann = {
+            vid_seg: ix for ix, vid_seg in enumerate(ds.annots['id'])}
+        # ann_ind -> (item without VIS_KEYS, prop_seg_feats, seg_feats)
+        self.vid_cache = OrderedDict()
+        self.stats = {'num_hits': 0, 'num_miss': 0,
+                      'num_batches': 0, 'num_reqs': 0}
+
+        self.req_queue = queue.Queue()
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, srl_row, vid_seg_ids):
+        """
+        Returns a Future with the grounding output
+        """
+        req = GrndRequest(srl_row, vid_seg_ids)
+        self.req_queue.put(req)
+        return req.future
+
+    def stop(self):
+        self.req_queue.put(None)
+        self.worker.join()
+
+    def collect_batch(self):
+        """
+        Block for one request, then add requests until
+        max_batch or the deadline of the first one
+        """
+        req = self.req_queue.get()
+        if req is None:
+            return None
+        batch = [req]
+        deadline = req.arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                req = self.req_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if req is None:
+                # stop after this batch
+                self.req_queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def serve(self):
+        while True:
+            batch = self.collect_batch()
+            if batch is None:
+                return
+            try:
+                outs = self.process_batch(batch)
+            except Exception as e:
+                for req in batch:
+                    req.future.set_exception(e)
+                continue
+            for req, out in zip(batch, outs):
+                out['latency'] = time.time() - req.arrival
+                req.future.set_result(out)
+
+    def encode_new_vids(self, ann_inds):
+        """
+        Read and visually encode the videos not in the cache
+        """
+        new_anns = [ann for ann in OrderedDict.fromkeys(ann_inds)
+                    if ann not in self.vid_cache]
+        self.stats['num_miss'] += len(new_anns)
+        self.stats['num_hits'] += len(set(ann_inds)) - len(new_anns)
+        if len(new_anns) == 0:
+            return
+        vid_dicts = [self.ds.simple_item_getter(ann) for ann in new_anns]
+        # 1 x num_new x ...
+        inp = {
+            k: torch.stack([d[k] for d in vid_dicts]).unsqueeze(0).to(
+                self.device)
+            for k in VIS_KEYS + ['pad_proposals', 'pad_props_msk']
+        }
+        with torch.no_grad():
+            prop_seg_feats, seg_feats = self.mdl.vis_encode(inp)
+        for ix, (ann, vid_dict) in enumerate(zip(new_anns, vid_dicts)):
+            vid_dict = {k: v for k, v in vid_dict.items()
+                        if k not in VIS_KEYS}
+            self.vid_cache[ann] = (
+                vid_dict, prop_seg_feats[0, ix], seg_feats[0, ix])
+
+    def evict(self):
+        while len(self.vid_cache) > self.cache_size:
+            self.vid_cache.popitem(last=False)
+
+    def process_batch(self, batch):
+        ann_lists = [[self.vid_seg_to_ann[vid_seg]
+                      for vid_seg in req.vid_seg_ids] for req in batch]
+        self.encode_new_vids(sum(ann_lists, []))
+
+        # cached dicts are copied, the query is added to them
+        items = [
+            self.ds.query_item_getter(
+                req.srl_row, [dict(self.vid_cache[ann][0]) for ann in anns])
+            for req, anns in zip(batch, ann_lists)
+        ]
+        inp = {k: torch.stack([it[k] for it in items]).to(self.device)
+               for k in items[0] if k not in RAGGED_KEYS}
+
+        # padded videos repeat the first one
+        ann_list = inp['ann_idx'].view(-1).tolist()
+        uniq_anns = list(OrderedDict.fromkeys(ann_list))
+        ann_to_uniq = {ann: ix for ix, ann in enumerate(uniq_anns)}
+        inp['uniq_vid_idx'] = torch.tensor(
+            [ann_to_uniq[ann] for ann in ann_list]
+        ).long().view(*inp['ann_idx'].shape).to(self.device)
+        inp['uniq_prop_seg_feats'] = torch.stack(
+            [self.vid_cache[ann][1] for ann in uniq_anns])
+        inp['uniq_seg_feats'] = torch.stack(
+            [self.vid_cache[ann][2] for ann in uniq_anns])
+        for ann in uniq_anns:
+            self.vid_cache.move_to_end(ann)
+
+        with torch.no_grad():
+            out = self.mdl(inp)
+        res = self.eval_fn.get_out_results_boxes(out, inp)
+        self.evict()
+
+        self.stats['num_batches'] += 1
+        self.stats['num_reqs'] += len(batch)
+
+        outs = []
+        for b, req in enumerate(batch):
+            num_vids = len(req.vid_seg_ids)
+            outs.append({
+                'vid_seg_ids': req.vid_seg_ids,
+                # num_srl_args x num_vids x num_frms x prop_dim
+                'boxes': res['boxes'][b][:, :num_vids].cpu(),
+                # num_srl_args x num_vids x num_frms
+                'scores': res['scores'][b][:, :num_vids].cpu(),
+                # num_srl_args x num_frms, index of the chosen video
+                'pred_cmp': res['indexs'][b].cpu(),
+            })
+        return outs
+
+
+def get_service(ckpt_file: str, device: str = 'cuda', max_batch: int = 8,
+                max_wait_ms: float = 20., cache_size: int = 1024,
+                **kwargs):
+    """
+    Build the service for a checkpoint, on the validation split
+    (random weights if ckpt_file is empty)
+    **kwargs: cfg args (same as main_dist)
+    """
+    cfg = conf
+    cfg = update_from_dict(cfg, kwargs, key_maps)
+    cfg = post_proc_config(cfg)
+    cfg.freeze()
+    device = torch.device(device)
+
+    mdl_loss_eval = get_mdl_loss_eval(cfg)
+    data = get_data(cfg)
+    ds = data.valid_dl.dataset
+    comm = ds.comm
+    eval_fn = mdl_loss_eval['eval'](cfg, comm, device)
+    comm.mdl_out_keys = eval_fn.mdl_out_keys
+    mdl = mdl_loss_eval['mdl'](cfg=cfg, comm=comm)
+    if ckpt_file != '':
+        mdl = load_mdl_ckpt(mdl, ckpt_file)
+    mdl.to(device)
+    mdl.eval()
+    return GrndService(cfg, mdl, ds, eval_fn, device,
+                       max_batch=max_batch, max_wait_ms=max_wait_ms,
+                       cache_size=cache_size)
+
+
+def synthetic_requests(ds, num_requests, vid_pool=200, seed=0):
+    """
+    Random queries, each against its own video and
+    others from a pool of vid_pool videos
+    """
+    rng = np.random.RandomState(seed)
+    srl_inds = ds.srl_annots.index.tolist()
+    vid_seg_ids = ds.annots['id'].tolist()[:vid_pool]
+    for _ in range(num_requests):
+        srl_row = ds.srl_annots.loc[srl_inds[rng.randint(len(srl_inds))]]
+        own_vid = ds.annots.iloc[srl_row.ann_ind]['id']
+        num_vids = rng.randint(1, ds.cs_nvids_sample + 1)
+        others = rng.choice(
+            vid_seg_ids, num_vids - 1, replace=False).tolist()
+        yield srl_row, [own_vid] + others
+
+
+def bench_service(ckpt_file: str, num_requests: int = 200,
+                  req_rate: float = 20., **kwargs):
+    """
+    Poisson arrivals at req_rate requests/s, reports
+    p50/p99 latency, throughput and cache hit rate.
+    **kwargs: passed to get_service
+    """
+    service = get_service(ckpt_file, **kwargs)
+    rng = np.random.RandomState(0)
+    futs = []
+    st_time = time.time()
+    for srl_row, vid_seg_ids in synthetic_requests(
+            service.ds, num_requests):
+        futs.append(service.submit(srl_row, vid_seg_ids))
+        time.sleep(rng.exponential(1. / req_rate))
+    latencies = np.array([f.result()['latency'] for f in futs]) * 1000
+    tot_time = time.time() - st_time
+    service.stop()
+
+    stats = service.stats
+    num_vids = stats['num_hits'] + stats['num_miss']
+    print(f'p50 latency {np.percentile(latencies, 50):.1f} ms | '
+          f'p99 latency {np.percentile(latencies, 99):.1f} ms')
+    print(f'throughput {num_requests / tot_time:.1f} req/s | '
+          f'avg batch {stats["num_reqs"] / stats["num_batches"]:.2f} | '
+          f'cache hit rate {stats["num_hits"] / max(num_vids, 1):.2f}')
+
+
+def check_service(num_requests: int = 64, max_batch: int = 8,
+                  vid_pool: int = 20, enc_size: int = 16, **kwargs):
+    """
+    Service with a tiny random model (small encoders, no
+    checkpoint) on the validation split, all requests submitted
+    at once. Checks that requests are batched, videos hit the
+    cache, and the outputs have the shapes of
+    EvaluatorSEP.get_out_results_boxes and match the model
+    run without the service (no batching, no cache).
+    Latencies are reported but are those of the tiny model.
+    **kwargs: cfg args (same as main_dist)
+    """
+    kwargs = {
+        'ds.conc_type': 'sep',
+        'mdl.input_encoding_size': enc_size,
+        'mdl.rnn.rnn_size': enc_size,
+        'mdl.rnn.num_layers': 1,
+        'mdl.vsrl.prop_encode_size': enc_size,
+        'mdl.vsrl.seg_encode_size': enc_size,
+        'mdl.vsrl.lang_encode_size': enc_size,
+        **kwargs
+    }
+    torch.manual_seed(0)
+    service = get_service('', device='cpu', max_batch=max_batch,
+                          max_wait_ms=50., **kwargs)
+    reqs = list(synthetic_requests(service.ds, num_requests, vid_pool))
+    futs = [service.submit(srl_row, vid_seg_ids)
+            for srl_row, vid_seg_ids in reqs]
+    outs = [f.result() for f in futs]
+    service.stop()
+
+    stats = service.stats
+    avg_batch = stats['num_reqs'] / stats['num_batches']
+    assert stats['num_reqs'] == num_requests
+    assert avg_batch > 1, avg_batch
+    assert stats['num_hits'] > 0
+
+    cfg = service.cfg
+    num_srl_args = cfg.misc.srl_arg_length
+    num_frms = cfg.ds.num_sampled_frm
+    for (srl_row, vid_seg_ids), out in zip(reqs, outs):
+        num_vids = len(vid_seg_ids)
+        prop_dim = out['boxes'].size(-1)
+        assert out['boxes'].shape == (
+            num_srl_args, num_vids, num_frms, prop_dim)
+        assert out['scores'].shape == (num_srl_args, num_vids, num_frms)
+        assert out['pred_cmp'].shape == (num_srl_args, num_frms)
+
+    # one request at a time, visual encoding not cached
+    ds = service.ds
+    for (srl_row, vid_seg_ids), out in zip(reqs[:4], outs[:4]):
+        item = ds.query_item_getter(srl_row, [
+            ds.simple_item_getter(service.vid_seg_to_ann[vid_seg])
+            for vid_seg in vid_seg_ids])
+        inp = {k: v.unsqueeze(0) for k, v in item.items()
+               if k not in RAGGED_KEYS}
+        with torch.no_grad():
+            res = service.eval_fn.get_out_results_boxes(
+                service.mdl(inp), inp)
+        num_vids = len(vid_seg_ids)
+        assert torch.allclose(
+            res['scores'][0][:, :num_vids], out['scores'], atol=1e-5)
+        assert torch.equal(res['boxes'][0][:, :num_vids], out['boxes'])
+        assert torch.equal(res['indexs'][0], out['pred_cmp'])
+
+    latencies = np.array([out['latency'] for out in outs]) * 1000
+    num_vids = stats['num_hits'] + stats['num_miss']
+    print(f'p50 latency {np.percentile(latencies, 50):.1f} ms | '
+          f'p99 latency {np.percentile(latencies, 99):.1f} ms | '
+          f'avg batch {avg_batch:.2f} | '
+          f'cache hit rate {stats["num_hits"] / num_vids:.2f}')
+    print('Service outputs are batched, cached and correct')
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'bench': bench_service,
+        'check': check_service
+    })
@@ -5,6 +5,7 @@ import sys
 # from dat_loader import get_data
 from dat_loader_simple import get_data
 from mdl_selector import get_mdl_loss_eval
+from mdl_vog import quantize_mdl_dynamic
 from trn_utils import Learner, synchronize
 
 import torch
@@ -35,15 +36,14 @@ def learner_init(uid: str, cfg: CN) -> Learner:
     get_default_loss = mdl_loss_eval['loss']
     get_default_eval = mdl_loss_eval['eval']
 
-    device = torch.device('cuda')
+    if cfg.quant_parity or cfg.device == 'cpu':
+        # int8 dynamic quantization is for cpu inference
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda')
     # device = torch.device('cpu')
     data = get_data(cfg)
     comm = data.train_dl.dataset.comm
-    mdl = get_default_net(cfg=cfg, comm=comm)
-
-    # pretrained_state_dict = torch.load(cfg.pretrained_path)
-    # to_load_state_dict = pretrained_state_dict
-    # mdl.load_state_dict(to_load_state_dict)
 
     loss_fn = get_default_loss(cfg, comm)
     loss_fn.to(device)
@@ -52,6 +52,18 @@ def learner_init(uid: str, cfg: CN) -> Learner:
 
     eval_fn = get_default_eval(cfg, comm, device)
     eval_fn.to(device)
+
+    # Model only builds the heads whose outputs
+    # the loss or evaluator consume
+    comm.mdl_out_keys = loss_fn.mdl_out_keys + eval_fn.mdl_out_keys
+    mdl = get_default_net(cfg=cfg, comm=comm)
+    if hasattr(loss_fn, 'set_use_vidf'):
+        # verb_loss is not logged if the vidf head is skipped
+        loss_fn.set_use_vidf(mdl.use_vidf)
+
+    # pretrained_state_dict = torch.load(cfg.pretrained_path)
+    # to_load_state_dict = pretrained_state_dict
+    # mdl.load_state_dict(to_load_state_dict)
     opt_fn = partial(torch.optim.Adam, betas=(0.9, 0.99))
 
     # unfreeze cfg to save the names
@@ -69,21 +81,28 @@ def learner_init(uid: str, cfg: CN) -> Learner:
     })
     cfg.freeze()
 
-    learn = Learner(uid=uid, data=data, mdl=mdl, loss_fn=loss_fn,
-                    opt_fn=opt_fn, eval_fn=eval_fn, device=device, cfg=cfg)
-
+    # wrapped before the Learner so that it trains the wrapped model
     if cfg.do_dist:
         mdl.to(device)
-        mdl = torch.nn.parallel.DistributedDataParallel(
-            mdl, device_ids=[cfg.local_rank],
-            output_device=cfg.local_rank, broadcast_buffers=True,
-            find_unused_parameters=True)
+        if device.type == 'cuda':
+            mdl = torch.nn.parallel.DistributedDataParallel(
+                mdl, device_ids=[cfg.local_rank],
+                output_device=cfg.local_rank, broadcast_buffers=True,
+                find_unused_parameters=True)
+        else:
+            # gloo, gradients are all-reduced on cpu
+            mdl = torch.nn.parallel.DistributedDataParallel(
+                mdl, broadcast_buffers=True,
+                find_unused_parameters=True)
     elif cfg.do_dp:
         # Use data parallel
         mdl = torch.nn.DataParallel(mdl)
 
     mdl = mdl.to(device)
 
+    learn = Learner(uid=uid, data=data, mdl=mdl, loss_fn=loss_fn,
+                    opt_fn=opt_fn, eval_fn=eval_fn, device=device, cfg=cfg)
+
     return learn
 
 
@@ -99,13 +118,19 @@ def main_dist(uid: str, **kwargs):
     cfg.num_gpus = num_gpus
     cfg.uid = uid
     cfg.cmd = sys.argv
-    if num_gpus > 1:
+    # cpu processes are distributed over gloo
+    use_cpu = kwargs.get('device', cfg.device) == 'cpu'
+    if num_gpus > 1 or use_cpu:
         if 'local_rank' in kwargs:
             # We are doing distributed parallel
             cfg.do_dist = True
-            torch.cuda.set_device(kwargs['local_rank'])
+            if use_cpu:
+                backend = 'gloo'
+            else:
+                torch.cuda.set_device(kwargs['local_rank'])
+                backend = 'nccl'
             torch.distributed.init_process_group(
-                backend="nccl", init_method="env://"
+                backend=backend, init_method="env://"
             )
             synchronize()
         else:
@@ -121,6 +146,20 @@ def main_dist(uid: str, **kwargs):
     # Initialize learner
     learn = learner_init(uid, cfg)
     # Train or Test
+    if cfg.quant_parity:
+        # compare val metrics of the fp32 and int8 models
+        learn.check_quant_parity(
+            quantize_mdl_dynamic, db={'valid': learn.data.valid_dl})
+        return
+    if len(cfg.val_ckpts) > 0:
+        # compare checkpoints on one pass over the val data
+        learn.validate_ckpts(
+            cfg.val_ckpts, db={'valid': learn.data.valid_dl})
+        return
+    if cfg.amp_parity:
+        # compare val metrics of fp32 and train.amp_dtype
+        learn.check_amp_parity(db={'valid': learn.data.valid_dl})
+        return
     if not (cfg.only_val or cfg.only_test or cfg.overfit_batch):
         learn.fit(epochs=cfg.train.epochs, lr=cfg.train.lr)
         if cfg.run_final_val:
@@ -71,9 +71,45 @@ class AnetBaseMdl(nn.Module):
         # srl_arg_len
         self.srl_arg_len = self.cfg.misc.srl_arg_length
 
+        # Model outputs consumed by the loss and evaluator.
+        # Set in comm before the model is built so unused
+        # heads are not created; None means all outputs
+        mdl_out_keys = self.comm.get('mdl_out_keys', None)
+        self.set_out_keys_req(mdl_out_keys, mdl_out_keys)
+        # Submodules not built, whose checkpoint weights are dropped
+        self.pruned_modules = []
+        # Video-level verb head, only for SEP
+        self.use_vidf = False
+
         self.set_args_mdl()
         self.set_args_conc()
 
+    def set_out_keys_req(self, out_keys_trn=None, out_keys_eval=None):
+        """
+        Outputs required in train and eval mode respectively
+        """
+        self.out_keys_trn = out_keys_trn
+        self.out_keys_eval = out_keys_eval
+
+    def need_out(self, *keys):
+        """
+        True if any of the keys is required in the current mode
+        """
+        out_keys = self.out_keys_trn if self.training else self.out_keys_eval
+        if out_keys is None:
+            return True
+        return any(k in out_keys for k in keys)
+
+    def may_need_out(self, *keys):
+        """
+        True if any of the keys is required in either mode.
+        Decides which heads are built
+        """
+        for out_keys in [self.out_keys_trn, self.out_keys_eval]:
+            if out_keys is None or any(k in out_keys for k in keys):
+                return True
+        return False
+
     def set_args_mdl(self):
         """
         Mdl specific args
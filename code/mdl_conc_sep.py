@@ -6,8 +6,13 @@ from mdl_conc_single import ConcBase
 import torch
 from torch import nn
 from torch.nn import functional as F
-from mdl_srl_utils import combine_first_ax
-from box_utils import bbox_overlaps
+from mdl_srl_utils import (
+    combine_first_ax, pack_by_mask, unpack_by_mask, fp32_region
+)
+from box_utils import (
+    bbox_overlaps, bbox_overlaps_frm, get_targets_from_frm_overlaps,
+    get_targets_from_iou_pairs
+)
 
 
 class ConcSEP(ConcBase):
@@ -28,6 +33,26 @@ class ConcSEP(ConcBase):
     def set_args_conc(self):
         self.nfrms = self.num_sampled_frm
         self.nppf = self.num_prop_per_frm
+        # vidf head feeds the verb loss and fin_scores
+        self.use_vidf = self.may_need_out('vidf_outs', 'fin_scores')
+        self.reset_pack_stats()
+
+    def reset_pack_stats(self):
+        """
+        Count of rows computed in the visual and vis+lang
+        stages, dense vs packed. Only training batches are
+        counted, reset by Learner at the start of each epoch
+        """
+        self.pack_stats = {
+            'vis_dense': 0, 'vis_packed': 0,
+            'conc_dense': 0, 'conc_packed': 0
+        }
+
+    def update_pack_stats(self, stage, num_dense, num_packed):
+        if not self.training:
+            return
+        self.pack_stats[f'{stage}_dense'] += num_dense
+        self.pack_stats[f'{stage}_packed'] += num_packed
 
     def get_num_cmp_msk(self, inp, out_shape):
         num_cmp = inp['new_srl_idxs'].size(1)
@@ -68,6 +93,17 @@ class ConcSEP(ConcBase):
         prop_scores: B x num_cmp x num_srl_args x num_props
         """
         prop_scores1 = conc_out_dict['conc_feats_out'].clone().detach()
+        with fp32_region(prop_scores1):
+            return self.compute_fin_scores_fp32(
+                prop_scores1.float(), inp,
+                vidf_outs.float() if vidf_outs is not None else None
+            )
+
+    def compute_fin_scores_fp32(self, prop_scores1, inp, vidf_outs=None):
+        """
+        sigmoid + max of compute_fin_scores, kept
+        in fp32 under mixed precision
+        """
         prop_scores = torch.sigmoid(prop_scores1)
         # prop_scores = prop_scores1
         if self.cfg.mdl.use_vis_msk:
@@ -128,6 +164,168 @@ class ConcSEP(ConcBase):
             fin_scores = prop_scores_max_boxes.sum(dim=-1)
         return fin_scores
 
+    def vis_encode(self, inp):
+        """
+        Encode proposal and segment features,
+        followed by object interaction
+        """
+        # Get visual features
+        # B x num_cmp x 1000 x 512
+        prop_feats = self.prop_feats_encode(inp)
+        # B, num_cmp, num_props, pdim = prop_feats.shape
+
+        # Get seg features
+        # B x num_cmp x 10 x 512
+        seg_feats = self.seg_feats_encode(inp)
+
+        # B x num_cmp x nfrm*nppf x psdim
+        prop_seg_feats = self.concat_prop_seg_feats(prop_feats, seg_feats, inp)
+
+        prop_seg_feats = self.simple_obj_interact_input(
+            prop_seg_feats, inp
+        )
+        return prop_seg_feats, seg_feats
+
+    def vis_encode_packed(self, inp):
+        """
+        Same as vis_encode, but only the non-padded
+        videos (num_cmp_msk == 1) are encoded.
+        The valid videos are packed as 1 x num_valid
+        and scattered back to B x num_cmp with zeros.
+        """
+        vid_msk = inp['num_cmp_msk'] > 0
+        inp_packed = {
+            k: pack_by_mask(inp[k], vid_msk).unsqueeze(0)
+            for k in ['pad_region_feature', 'seg_feature_for_frms',
+                      'pad_proposals', 'pad_props_msk']
+            if k in inp
+        }
+        prop_seg_feats, seg_feats = self.vis_encode(inp_packed)
+
+        self.update_pack_stats(
+            'vis', vid_msk.numel(), prop_seg_feats.size(1))
+
+        return (
+            unpack_by_mask(prop_seg_feats.squeeze(0), vid_msk),
+            unpack_by_mask(seg_feats.squeeze(0), vid_msk)
+        )
+
+    def vis_encode_uniq(self, inp):
+        """
+        Same as vis_encode, but each unique video in the
+        batch is encoded once (see BatchCollator.dedup_vid_feats)
+        and gathered back to B x num_cmp.
+        If given, uniq_prop_seg_feats/uniq_seg_feats are used as is
+        """
+        uniq_vid_idx = inp['uniq_vid_idx']
+        B, num_cmp = uniq_vid_idx.shape
+        # 1 x num_uniq x ...
+        inp_uniq = {
+            k: inp['uniq_' + k].unsqueeze(0)
+            for k in ['pad_region_feature', 'seg_feature_for_frms',
+                      'pad_proposals', 'pad_props_msk']
+            if 'uniq_' + k in inp
+        }
+        if 'uniq_prop_seg_feats' in inp:
+            # visual encoding cached by the caller (grnd_service)
+            prop_seg_feats = inp['uniq_prop_seg_feats'].unsqueeze(0)
+            seg_feats = inp['uniq_seg_feats'].unsqueeze(0)
+        else:
+            prop_seg_feats, seg_feats = self.vis_encode(inp_uniq)
+
+        self.update_pack_stats(
+            'vis', B * num_cmp, prop_seg_feats.size(1))
+
+        def gather_uniq(inp_t):
+            inp_t = inp_t.squeeze(0)[uniq_vid_idx.view(-1)]
+            return inp_t.view(B, num_cmp, *inp_t.shape[1:])
+
+        return gather_uniq(prop_seg_feats), gather_uniq(seg_feats)
+
+    def conc_encode_packed(self, prop_seg_feats, srl_arg_lstm_encoded, inp):
+        """
+        Only the valid (video, srl-arg) pairs are passed
+        through conc_encode. The padded slots have logit 0.
+        If conc_encode mixes srl-args (like the multi-modal
+        transformer) only the valid videos are packed, so
+        the outputs are unchanged.
+        prop_seg_feats: B x num_cmp x num_props x psdim
+        srl_arg_lstm_encoded: B x num_cmp x num_srl_args x ldim
+        output: B x num_cmp x num_srl_args x num_props
+        """
+        B, num_cmp, num_props, psdim = prop_seg_feats.shape
+        num_srl_args, ldim = srl_arg_lstm_encoded.shape[2:]
+        vid_msk = inp['num_cmp_msk'] > 0
+        if self.conc_pointwise:
+            srl_msk = inp['srl_arg_inds_msk'] > 0
+            # B x num_cmp x num_srl_args
+            pair_msk = vid_msk.unsqueeze(-1) & srl_msk.expand(
+                B, num_cmp, num_srl_args)
+            # num_pairs x 1 x num_props x psdim
+            vis_packed = pack_by_mask(
+                prop_seg_feats.unsqueeze(2).expand(
+                    B, num_cmp, num_srl_args, num_props, psdim),
+                pair_msk
+            ).unsqueeze(1)
+            # num_pairs x 1 x 1 x ldim
+            lang_packed = pack_by_mask(
+                srl_arg_lstm_encoded, pair_msk).view(-1, 1, 1, ldim)
+            # num_pairs x 1 x 1 x num_props x vldim
+            conc_feats = self.concate_vis_lang_feats(
+                vis_packed, lang_packed)
+            npacked = conc_feats.size(0)
+            # 1 x num_pairs x 1 x num_props x vldim
+            conc_feats = conc_feats.view(
+                1, npacked, 1, num_props, conc_feats.size(-1))
+            out_msk = pair_msk
+        else:
+            vis_packed = pack_by_mask(prop_seg_feats, vid_msk)
+            lang_packed = pack_by_mask(srl_arg_lstm_encoded, vid_msk)
+            npacked = vis_packed.size(0)
+            # 1 x num_valid x num_srl_args x num_props x vldim
+            conc_feats = self.concate_vis_lang_feats(
+                vis_packed.unsqueeze(0), lang_packed.unsqueeze(0))
+            out_msk = vid_msk
+
+        inp_packed = {
+            k: pack_by_mask(inp[k], vid_msk).unsqueeze(0)
+            for k in ['pad_proposals', 'pad_props_msk'] if k in inp
+        }
+        conc_feats_out = self.conc_encode_item(
+            conc_feats, inp_packed, self.num_sampled_frm,
+            self.num_prop_per_frm, npacked
+        )['conc_feats_out']
+
+        self.update_pack_stats(
+            'conc', B * num_cmp * num_srl_args,
+            npacked if self.conc_pointwise else npacked * num_srl_args)
+
+        conc_feats_out = conc_feats_out.view(
+            npacked, -1, num_props
+        )
+        if self.conc_pointwise:
+            conc_feats_out = conc_feats_out.squeeze(1)
+        return {
+            'conc_feats_out': unpack_by_mask(conc_feats_out, out_msk)
+        }
+
+    def packed_flop_savings(self):
+        """
+        Fraction of the rows (and hence FLOPs) skipped
+        by the packed mode in the visual and vis+lang stages
+        """
+        def frac_saved(dense, packed):
+            if dense == 0:
+                return 0.
+            return 1. - packed / dense
+
+        return {
+            'vis': frac_saved(
+                self.pack_stats['vis_dense'], self.pack_stats['vis_packed']),
+            'conc': frac_saved(
+                self.pack_stats['conc_dense'], self.pack_stats['conc_packed'])
+        }
+
     def forward(self, inp):
         """
         Main difference is that prop feats/seg features
@@ -137,6 +335,9 @@ class ConcSEP(ConcBase):
         # 6 is num_cmp for a sent
         # 5 is num args in a sent
         # 40 is seq length for each arg
+        # num_verbs is 1 when the query is shared among
+        # the videos (ds.sep_share_lang), it is then
+        # encoded once and broadcast to num_cmp
         B, num_verbs, num_srl_args, seq_len = inp['srl_arg_words_ind'].shape
         # B*num_cmp x seq_len
         src_toks = self.get_srl_arg_seq_to_sent_seq(inp)
@@ -151,21 +352,14 @@ class ConcSEP(ConcBase):
             lstm_encoded, inp
         )
 
-        # Get visual features
-        # B x num_cmp x 1000 x 512
-        prop_feats = self.prop_feats_encode(inp)
-        # B, num_cmp, num_props, pdim = prop_feats.shape
-
-        # Get seg features
-        # B x num_cmp x 10 x 512
-        seg_feats = self.seg_feats_encode(inp)
-
-        # B x num_cmp x nfrm*nppf x psdim
-        prop_seg_feats = self.concat_prop_seg_feats(prop_feats, seg_feats, inp)
-
-        prop_seg_feats = self.simple_obj_interact_input(
-            prop_seg_feats, inp
-        )
+        if 'uniq_vid_idx' in inp:
+            # B x num_cmp x nfrm*nppf x psdim, B x num_cmp x 10 x 512
+            prop_seg_feats, seg_feats = self.vis_encode_uniq(inp)
+        elif self.cfg.mdl.packed:
+            # B x num_cmp x nfrm*nppf x psdim, B x num_cmp x 10 x 512
+            prop_seg_feats, seg_feats = self.vis_encode_packed(inp)
+        else:
+            prop_seg_feats, seg_feats = self.vis_encode(inp)
 
         num_cmp = inp['new_srl_idxs'].size(1)
         if srl_arg_lstm_encoded.size(1) == 1 and num_cmp > 1:
@@ -173,48 +367,66 @@ class ConcSEP(ConcBase):
                 -1, num_cmp, -1, -1
             )
 
-        conc_feats = self.concate_vis_lang_feats(
-            prop_seg_feats, srl_arg_lstm_encoded
-        )
-
         # B x num_cmp x num_srl_args x num_props
-        conc_feats_out_dict = self.conc_encode(conc_feats, inp)
+        if self.use_chunked_conc():
+            conc_feats_out_dict = self.conc_encode_chunked(
+                prop_seg_feats, srl_arg_lstm_encoded, inp
+            )
+        elif self.cfg.mdl.packed:
+            conc_feats_out_dict = self.conc_encode_packed(
+                prop_seg_feats, srl_arg_lstm_encoded, inp
+            )
+        else:
+            conc_feats = self.concate_vis_lang_feats(
+                prop_seg_feats, srl_arg_lstm_encoded
+            )
+            conc_feats_out_dict = self.conc_encode(conc_feats, inp)
         conc_feats_out = conc_feats_out_dict['conc_feats_out']
 
-        seg_feats_for_verb, verb_feats = self.get_seg_verb_feats_to_process(
-            seg_feats, srl_arg_lstm_encoded, lstm_outs, inp
-        )
+        out_dict = {'mdl_outs': conc_feats_out}
+
+        # Only compute the heads the loss/evaluator consume
+        vidf_outs = None
+        if self.use_vidf and self.need_out('vidf_outs', 'fin_scores'):
+            seg_feats_for_verb, verb_feats = \
+                self.get_seg_verb_feats_to_process(
+                    seg_feats, srl_arg_lstm_encoded, lstm_outs, inp
+                )
 
-        if verb_feats.size(1) == 1 and num_cmp > 1:
-            verb_feats = verb_feats.expand(-1, num_cmp, -1)
+            if verb_feats.size(1) == 1 and num_cmp > 1:
+                verb_feats = verb_feats.expand(-1, num_cmp, -1)
 
-        # B x num_cmp
-        vidf_outs = self.compute_seg_verb_feats_out(
-            seg_feats_for_verb, verb_feats
-        )
-        fin_scores = self.compute_fin_scores(
-            conc_feats_out_dict, inp, vidf_outs
-        )
+            # B x num_cmp
+            vidf_outs = self.compute_seg_verb_feats_out(
+                seg_feats_for_verb, verb_feats
+            )
+            out_dict['vidf_outs'] = vidf_outs
+
+        if self.need_out('fin_scores', 'fin_scores_loss'):
+            fin_scores = self.compute_fin_scores(
+                conc_feats_out_dict, inp, vidf_outs
+            )
+            out_dict['fin_scores_loss'] = fin_scores['fin_scores_loss']
+            out_dict['fin_scores'] = fin_scores['fin_scores_eval']
+
+        if not self.need_out('mdl_outs_eval'):
+            return out_dict
 
         num_cmp_msk = self.get_num_cmp_msk(inp, conc_feats_out.shape)
 
         srl_ind_msk = inp['srl_arg_inds_msk']
         if srl_ind_msk.size(1) == 1 and num_cmp > 1:
             srl_ind_msk = srl_ind_msk.expand(
-                -1, num_cmp, -1, -1
+                -1, num_cmp, -1
             )
         srl_ind_msk = srl_ind_msk.unsqueeze(-1).expand(
             *conc_feats_out.shape)
         mdl_outs_eval = torch.sigmoid(
-            conc_feats_out) * srl_ind_msk.float() * num_cmp_msk.float()
+            conc_feats_out.float()
+        ) * srl_ind_msk.float() * num_cmp_msk.float()
+        out_dict['mdl_outs_eval'] = mdl_outs_eval
 
-        return {
-            'mdl_outs': conc_feats_out,
-            'mdl_outs_eval': mdl_outs_eval,
-            'vidf_outs': vidf_outs,
-            'fin_scores_loss': fin_scores['fin_scores_loss'],
-            'fin_scores': fin_scores['fin_scores_eval']
-        }
+        return out_dict
 
 
 class LossB_SEP(nn.Module):
@@ -230,9 +442,20 @@ class LossB_SEP(nn.Module):
         self.cfg = cfg
         self.comm = comm
         self.loss_keys = ['loss', 'mdl_out_loss', 'verb_loss']
+        # verb_loss is only logged, so vidf_outs is not required
+        self.mdl_out_keys = ['mdl_outs']
         self.loss_lambda = self.cfg.loss.loss_lambda
         self.after_init()
 
+    def set_use_vidf(self, use_vidf):
+        """
+        verb_loss is logged only if the model
+        computes vidf_outs (see mdl.use_vidf)
+        """
+        self.loss_keys = ['loss', 'mdl_out_loss']
+        if use_vidf:
+            self.loss_keys.append('verb_loss')
+
     def after_init(self):
         pass
 
@@ -297,11 +520,58 @@ class LossB_SEP(nn.Module):
 
         return overlaps
 
+    def compute_loss_targets_sparse(self, inp):
+        """
+        Same as compute_loss_targets, but from the
+        precomputed iou pairs (loss.use_cached_targets)
+        or with overlaps computed only within the same
+        frame (loss.iou_engine == 'frm')
+        """
+        B, num_cmp, num_props = inp['pad_proposals'].shape[:3]
+
+        srl_boxes = inp['srl_boxes']
+        srl_boxes_lens = inp['srl_boxes_lens']
+        num_srl_args, num_box_per_srl = srl_boxes.shape[2:]
+        # each video is matched with its own srl boxes
+        srl_boxes, srl_boxes_lens = [
+            x.expand(B, num_cmp, num_srl_args, num_box_per_srl).contiguous(
+            ).view(B*num_cmp, 1, num_srl_args, num_box_per_srl)
+            for x in [srl_boxes, srl_boxes_lens]
+        ]
+        if self.cfg.loss.use_cached_targets:
+            targets_all = get_targets_from_iou_pairs(
+                combine_first_ax(inp['iou_pairs']),
+                srl_boxes, srl_boxes_lens, num_props
+            )
+        else:
+            # B*num_cmp x num_props x M
+            overlaps, gt_inds = bbox_overlaps_frm(
+                combine_first_ax(inp['pad_proposals']),
+                combine_first_ax(inp['pad_gt_bboxs'])
+            )
+            targets_all = get_targets_from_frm_overlaps(
+                overlaps, gt_inds, srl_boxes, srl_boxes_lens
+            )
+        targets_all = targets_all.view(B, num_cmp, num_srl_args, num_props)
+
+        targ_cmp = inp['target_cmp']
+        targ_msk = torch.arange(
+            num_cmp, device=targ_cmp.device
+        ).view(1, num_cmp) == targ_cmp.view(B, 1)
+        targets_one = targets_all & targ_msk.view(B, num_cmp, 1, 1)
+        return {
+            'targets_one': targets_one,
+            'targets_all': targets_all
+        }
+
     def compute_loss_targets(self, inp):
         """
         Compute the targets, based on iou
         overlaps
         """
+        if (self.cfg.loss.use_cached_targets or
+                self.cfg.loss.iou_engine == 'frm'):
+            return self.compute_loss_targets_sparse(inp)
         overlaps = self.compute_overlaps(inp)
         B, ncmp, nprop, ngt = overlaps.shape
         overlaps_msk = overlaps.new_zeros(*overlaps.shape)
@@ -341,8 +611,12 @@ class LossB_SEP(nn.Module):
 
         B, num_cmp, num_srl_args = srl_arg_boxes_mask.shape
 
+        # padded srl-args are not scored (packed mode gives them
+        # a constant logit), so dense and packed optimise the same
+        srl_arg_inds_msk = inp['srl_arg_inds_msk'].expand(
+            B, num_cmp, num_srl_args).float()
         boxes_msk = num_cmp_msk.unsqueeze(
-            -1).expand(*srl_arg_boxes_mask.shape).float()
+            -1).expand(*srl_arg_boxes_mask.shape).float() * srl_arg_inds_msk
 
         # B x num_cmp x num_srl_args -> B x num_cmp x num_srl x 1000
         boxes_msk = boxes_msk.unsqueeze(
@@ -351,7 +625,7 @@ class LossB_SEP(nn.Module):
         tot_loss = tot_loss * boxes_msk
 
         multiplier = tot_loss.size(-1)
-        if srl_arg_boxes_mask.max() > 0:
+        if srl_arg_boxes_mask.max() > 0 and boxes_msk.max() > 0:
             out_loss = torch.masked_select(tot_loss, boxes_msk.byte())
         else:
             # TODO: NEED TO check what is wrong here
@@ -377,7 +651,9 @@ class LossB_SEP(nn.Module):
         )
 
         # B x ncmp x nfrms
-        out_loss = F.binary_cross_entropy(vidf_outs, targs, reduction='none')
+        with fp32_region(vidf_outs):
+            out_loss = F.binary_cross_entropy(
+                vidf_outs.float(), targs.float(), reduction='none')
 
         mult = 1. / nfrm
 
@@ -403,10 +679,11 @@ class LossB_SEP(nn.Module):
             src=vidf_targs.new_ones(*vidf_targs.shape)
         )
 
-        vidf_loss = F.binary_cross_entropy(  #
-            vidf_outs, vidf_targs,
-            reduction='none'
-        )
+        with fp32_region(vidf_outs):
+            vidf_loss = F.binary_cross_entropy(  #
+                vidf_outs.float(), vidf_targs.float(),
+                reduction='none'
+            )
         msk = inp['num_cmp_msk']
         vidf_loss = vidf_loss * msk.float()
         vidf_loss = torch.masked_select(vidf_loss, msk.byte())
@@ -420,28 +697,29 @@ class LossB_SEP(nn.Module):
 
         mdl_out_loss = self.compute_mdl_loss(mdl_outs, targets_n, inp)
 
-        verb_outs = out['vidf_outs']
-
-        verb_loss = F.binary_cross_entropy_with_logits(
-            verb_outs,
-            inp['verb_cmp'].float(),
-            reduction='none'
-        )
-
-        vcc_msk = inp['verb_cross_cmp_msk'].float()
-        vcc_msk = (vcc_msk.sum(dim=-1) > 0).float()
-
-        verb_loss = verb_loss * vcc_msk
-        verb_loss = torch.masked_select(
-            verb_loss, vcc_msk.byte()).mean()
-
         # out_loss = mdl_out_loss + verb_loss
         out_loss = mdl_out_loss
 
         out_loss_dict = {
             'loss': out_loss,
             'mdl_out_loss': mdl_out_loss,
-            'verb_loss': verb_loss
         }
 
+        if 'verb_loss' in self.loss_keys:
+            verb_outs = out['vidf_outs']
+
+            verb_loss = F.binary_cross_entropy_with_logits(
+                verb_outs,
+                inp['verb_cmp'].float(),
+                reduction='none'
+            )
+
+            vcc_msk = inp['verb_cross_cmp_msk'].float()
+            vcc_msk = (vcc_msk.sum(dim=-1) > 0).float()
+
+            verb_loss = verb_loss * vcc_msk
+            verb_loss = torch.masked_select(
+                verb_loss, vcc_msk.byte()).mean()
+            out_loss_dict['verb_loss'] = verb_loss
+
         return {k: v * self.loss_lambda for k, v in out_loss_dict.items()}
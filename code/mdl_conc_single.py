@@ -4,7 +4,10 @@ Concatenate to a Single Video
 import torch
 from torch import nn
 from torch.nn import functional as F
-from box_utils import bbox_overlaps
+from box_utils import (
+    bbox_overlaps, bbox_overlaps_frm, get_targets_from_frm_overlaps,
+    get_targets_from_iou_pairs
+)
 
 
 class ConcBase(nn.Module):
@@ -106,20 +109,29 @@ class ConcTEMP(ConcBase):
             prop_seg_feats, inp
         )
 
-        # B x 1 x num_srl_args x 4*num_props x vf+lf dim
-        conc_feats = self.concate_vis_lang_feats(
-            prop_seg_feats, srl_arg_lstm_encoded
-        )
+        if self.use_chunked_conc():
+            conc_feats_out_dict = self.conc_encode_chunked(
+                prop_seg_feats, srl_arg_lstm_encoded, inp
+            )
+        else:
+            # B x 1 x num_srl_args x 4*num_props x vf+lf dim
+            conc_feats = self.concate_vis_lang_feats(
+                prop_seg_feats, srl_arg_lstm_encoded
+            )
 
-        # B x num_cmp x num_srl_args x 4*num_props x vf+lf dim
-        conc_feats_out_dict = self.conc_encode(conc_feats, inp)
+            # B x num_cmp x num_srl_args x 4*num_props x vf+lf dim
+            conc_feats_out_dict = self.conc_encode(conc_feats, inp)
         conc_feats_out = conc_feats_out_dict['conc_feats_out']
 
+        if not self.need_out('mdl_outs_eval'):
+            return {'mdl_outs': conc_feats_out}
+
         num_cmp_msk = self.get_num_cmp_msk(inp, conc_feats_out.shape)
         srl_ind_msk = inp['srl_arg_inds_msk'].unsqueeze(-1).expand(
             *conc_feats_out.shape)
         conc_feats_out_eval = torch.sigmoid(
-            conc_feats_out) * srl_ind_msk.float() * num_cmp_msk.float()
+            conc_feats_out.float()
+        ) * srl_ind_msk.float() * num_cmp_msk.float()
 
         return {
             'mdl_outs': conc_feats_out,
@@ -183,6 +195,7 @@ class LossB_TEMP(nn.Module):
         self.cfg = cfg
         self.comm = comm
         self.loss_keys = ['loss', 'mdl_out_loss']
+        self.mdl_out_keys = ['mdl_outs']
         self.loss_lambda = self.cfg.loss.loss_lambda
         self.after_init()
 
@@ -246,29 +259,67 @@ class LossB_TEMP(nn.Module):
 
         return overlaps
 
-    def compute_loss_targets(self, inp):
+    def get_targ_props_msk(self, inp, num_tot_props):
         """
-        Compute the targets, based on iou
-        overlaps
+        B x num_tot_props, 1 for proposals of the target video
+        For TEMP videos are stacked one after another
         """
         num_cmp = inp['new_srl_idxs'].size(1)
-        overlaps = self.compute_overlaps(inp)
-        B, num_tot_props, num_gt = overlaps.shape
         assert num_tot_props % num_cmp == 0
         num_props = num_tot_props // num_cmp
-        overlaps_msk = overlaps.new_zeros(B, num_cmp, num_props, num_gt)
-
         targ_cmp = inp['target_cmp']
+        B = targ_cmp.size(0)
+        props_msk = inp['pad_proposals'].new_zeros(B, num_cmp, num_props)
 
-        overlaps_msk.scatter_(
+        props_msk.scatter_(
             dim=1,
-            index=targ_cmp.view(B, 1, 1, 1).expand(
-                B, num_cmp, num_props, num_gt),
-            src=overlaps_msk.new_ones(*overlaps_msk.shape)
+            index=targ_cmp.view(B, 1, 1).expand(
+                B, num_cmp, num_props),
+            src=props_msk.new_ones(*props_msk.shape)
         )
+        return props_msk.view(B, num_tot_props)
 
-        overlaps_msk = overlaps_msk.view(B, num_tot_props, num_gt)
-        overlaps_one_targ = overlaps * overlaps_msk
+    def compute_loss_targets_sparse(self, inp):
+        """
+        Same as compute_loss_targets, but from the
+        precomputed iou pairs (loss.use_cached_targets)
+        or with overlaps computed only within the same
+        frame (loss.iou_engine == 'frm')
+        """
+        B, num_tot_props = inp['pad_proposals'].shape[:2]
+        if self.cfg.loss.use_cached_targets:
+            targets_all = get_targets_from_iou_pairs(
+                inp['iou_pairs'], inp['srl_boxes'],
+                inp['srl_boxes_lens'], num_tot_props
+            )
+        else:
+            # B x num_tot_props x M
+            overlaps, gt_inds = bbox_overlaps_frm(
+                inp['pad_proposals'], inp['pad_gt_bboxs']
+            )
+            targets_all = get_targets_from_frm_overlaps(
+                overlaps, gt_inds,
+                inp['srl_boxes'], inp['srl_boxes_lens']
+            )
+        props_msk = self.get_targ_props_msk(inp, num_tot_props) > 0
+        targets_one = targets_all & props_msk.view(B, 1, 1, num_tot_props)
+        return {
+            'targets_one': targets_one,
+        }
+
+    def compute_loss_targets(self, inp):
+        """
+        Compute the targets, based on iou
+        overlaps
+        """
+        if (self.cfg.loss.use_cached_targets or
+                self.cfg.loss.iou_engine == 'frm'):
+            return self.compute_loss_targets_sparse(inp)
+        overlaps = self.compute_overlaps(inp)
+        B, num_tot_props, num_gt = overlaps.shape
+        props_msk = self.get_targ_props_msk(inp, num_tot_props)
+
+        overlaps_one_targ = overlaps * props_msk.unsqueeze(-1)
         targets_one = self.get_targets_from_overlaps(overlaps_one_targ, inp)
         return {
             'targets_one': targets_one,
@@ -339,36 +390,28 @@ class LossB_SPAT(LossB_TEMP):
         self.num_sampled_frm = self.cfg.ds.num_sampled_frm
         self.num_prop_per_frm = self.comm.num_prop_per_frm
 
-    def compute_loss_targets(self, inp):
+    def get_targ_props_msk(self, inp, num_tot_props):
         """
-        Compute the targets, based on iou
-        overlaps
+        B x num_tot_props, 1 for proposals of the target video
+        For SPAT proposals are nfrm x num_cmp x nppf
         """
         num_cmp = inp['new_srl_idxs'].size(1)
-        overlaps = self.compute_overlaps(inp)
-        B, num_tot_props, num_gt = overlaps.shape
         assert num_tot_props % num_cmp == 0
+        targ_cmp = inp['target_cmp']
+        B = targ_cmp.size(0)
 
-        overlaps_msk = overlaps.new_zeros(
+        props_msk = inp['pad_proposals'].new_zeros(
             B, self.num_sampled_frm, num_cmp,
-            self.num_prop_per_frm, num_gt
+            self.num_prop_per_frm
         )
-
-        targ_cmp = inp['target_cmp']
-        overlaps_msk.scatter_(
+        props_msk.scatter_(
             dim=2,
-            index=targ_cmp.view(B, 1, 1, 1, 1).expand(
-                B, self.num_sampled_frm, num_cmp, self.num_prop_per_frm, num_gt
+            index=targ_cmp.view(B, 1, 1, 1).expand(
+                B, self.num_sampled_frm, num_cmp, self.num_prop_per_frm
             ),
-            src=overlaps_msk.new_ones(*overlaps_msk.shape)
+            src=props_msk.new_ones(*props_msk.shape)
         )
-
-        overlaps_msk = overlaps_msk.view(B, num_tot_props, num_gt)
-        overlaps_one_targ = overlaps * overlaps_msk
-        targets_one = self.get_targets_from_overlaps(overlaps_one_targ, inp)
-        return {
-            'targets_one': targets_one,
-        }
+        return props_msk.view(B, num_tot_props)
 
     def compute_mdl_loss(self, mdl_outs, targets_one, inp):
         weights = None
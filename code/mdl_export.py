@@ -0,0 +1,147 @@
+"""
+Export a trained grounding model to a TorchScript file.
+The model is traced on an example validation batch, so the
+shape bookkeeping of ConcSEP/ConcTEMP/ConcSPAT and cfg branches
+are resolved at export time. Serving only needs torch:
+
+    mdl = torch.jit.load(out_file, _extra_files=extra)
+    outs = mdl(*[batch[k] for k in meta['inp_keys']])
+"""
+import json
+from pathlib import Path
+import torch
+from torch import nn
+import fire
+
+from dat_loader_simple import get_data
+from mdl_selector import get_mdl_loss_eval
+from extended_config import (
+    cfg as conf,
+    key_maps,
+    update_from_dict,
+    post_proc_config
+)
+
+
+class KeyRecorder(dict):
+    """
+    Records the input keys read by the model
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.used_keys = []
+
+    def __getitem__(self, key):
+        if key not in self.used_keys:
+            self.used_keys.append(key)
+        return super().__getitem__(key)
+
+
+class ExportWrapper(nn.Module):
+    """
+    Takes the input tensors positionally (in inp_keys order)
+    and returns the required outputs (out_keys) as a tuple
+    """
+
+    def __init__(self, mdl, inp_keys, out_keys):
+        super().__init__()
+        self.mdl = mdl
+        self.inp_keys = inp_keys
+        self.out_keys = out_keys
+
+    def forward(self, *inps):
+        inp = {k: v for k, v in zip(self.inp_keys, inps)}
+        out = self.mdl(inp)
+        return tuple(out[k] for k in self.out_keys)
+
+
+def load_mdl_ckpt(mdl, ckpt_file):
+    """
+    Load model weights from a Learner checkpoint
+    """
+    checkpoint = torch.load(open(ckpt_file, 'rb'), map_location='cpu')
+    state_dict = checkpoint['model_state_dict']
+    state_dict = {
+        (k[len('module.'):] if k.startswith('module.') else k): v
+        for k, v in state_dict.items()
+    }
+    state_dict = {
+        k: v for k, v in state_dict.items()
+        if k.split('.')[0] not in mdl.pruned_modules
+    }
+    mdl.load_state_dict(state_dict)
+    return mdl
+
+
+def export_mdl(uid: str, ckpt_file: str, out_file: str = '',
+               device: str = 'cpu', **kwargs):
+    """
+    uid: experiment name, the artifact is tmp/exported/{uid}.pt by default
+    ckpt_file: checkpoint saved by Learner.save_model_dict
+    **kwargs: cfg args (same as main_dist), e.g. ds.conc_type
+    Shapes (batch size bsv, num_cmp, proposals) are those of the
+    validation batches, the last batch needs padding to bsv.
+    """
+    cfg = conf
+    cfg.uid = uid
+    cfg = update_from_dict(cfg, kwargs, key_maps)
+    cfg = post_proc_config(cfg)
+    # data dependent shapes cannot be traced
+    assert not cfg.mdl.packed and not cfg.ds.dedup_vids
+    assert cfg.mdl.obj_tx.n_buckets == 0 and cfg.mdl.mul_tx.n_buckets == 0
+    cfg.freeze()
+    device = torch.device(device)
+
+    mdl_loss_eval = get_mdl_loss_eval(cfg)
+    data = get_data(cfg)
+    comm = data.valid_dl.dataset.comm
+    eval_fn = mdl_loss_eval['eval'](cfg, comm, device)
+    # Only the outputs used for evaluation are exported
+    out_keys = eval_fn.mdl_out_keys
+    comm.mdl_out_keys = out_keys
+    mdl = mdl_loss_eval['mdl'](cfg=cfg, comm=comm)
+    mdl = load_mdl_ckpt(mdl, ckpt_file)
+    mdl.to(device)
+    mdl.eval()
+
+    batch = next(iter(data.valid_dl))
+    batch = KeyRecorder({k: v.to(device) for k, v in batch.items()})
+    with torch.no_grad():
+        mdl(batch)
+    inp_keys = batch.used_keys
+    example_inps = tuple(batch[k] for k in inp_keys)
+
+    wrapped_mdl = ExportWrapper(mdl, inp_keys, out_keys)
+    with torch.no_grad():
+        traced_mdl = torch.jit.trace(wrapped_mdl, example_inps)
+
+    meta = {
+        'inp_keys': inp_keys,
+        'out_keys': out_keys,
+        'inp_shapes': {k: list(batch[k].shape) for k in inp_keys},
+        'conc_type': cfg.ds.conc_type,
+        'exp_setting': cfg.ds.exp_setting,
+        'mdl_name': cfg.mdl.name,
+    }
+    if out_file == '':
+        out_file = Path('./tmp/exported') / f'{uid}.pt'
+    out_file = Path(out_file)
+    out_file.parent.mkdir(exist_ok=True, parents=True)
+    torch.jit.save(traced_mdl, str(out_file),
+                   _extra_files={'meta.json': json.dumps(meta)})
+    print(f'Exported to {out_file}')
+    return out_file
+
+
+def load_exported(out_file: str):
+    """
+    Load an exported model and its input/output keys
+    """
+    extra = {'meta.json': ''}
+    traced_mdl = torch.jit.load(str(out_file), _extra_files=extra)
+    return traced_mdl, json.loads(extra['meta.json'])
+
+
+if __name__ == '__main__':
+    fire.Fire(export_mdl)
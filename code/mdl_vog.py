@@ -13,6 +13,7 @@ Assume:
 - each frame with 5 proposals
 """
 
+import copy
 import torch
 from torch import nn
 from mdl_base import AnetBaseMdl
@@ -21,8 +22,8 @@ from mdl_conc_single import (
     ConcTEMP, LossB_TEMP,
     ConcSPAT, LossB_SPAT
 )
-from mdl_srl_utils import do_cross
-from transformer_code import Transformer, RelTransformer
+from mdl_srl_utils import do_cross, is_tracing
+from transformer_code import Transformer, RelTransformer, bucketed_forward
 from mdl_srl_utils import LSTMEncoder
 
 
@@ -63,6 +64,12 @@ class ImgGrnd(AnetBaseMdl):
         self.vis_lang_feat_dim = self.prop_seg_feat_dim + self.lang_encode_dim
 
         self.conc_encode_item = getattr(self, 'conc_encode_simple')
+        # conc_encode_simple treats each srl-arg independently
+        # used to decide the packing granularity
+        self.conc_pointwise = True
+        # Rough peak activation of conc_encode_item in
+        # units of its input, used for chunked inference
+        self.conc_mem_mult = 2
 
     def get_srl_arg_seq_to_sent_seq(self, inp):
         """
@@ -208,14 +215,17 @@ class ImgGrnd(AnetBaseMdl):
 
         # Only used for SEP
         # Not for others
-        self.seg_verb_classf = nn.Sequential(
-            *[
-                nn.Linear(self.seg_feat_encode_dim+self.lang_encode_dim,
-                          256),
-                nn.ReLU(),
-                nn.Linear(256, 1)
-            ]
-        )
+        if self.use_vidf:
+            self.seg_verb_classf = nn.Sequential(
+                *[
+                    nn.Linear(self.seg_feat_encode_dim+self.lang_encode_dim,
+                              256),
+                    nn.ReLU(),
+                    nn.Linear(256, 1)
+                ]
+            )
+        else:
+            self.pruned_modules.append('seg_verb_classf')
 
     def build_conc_model(self):
         """
@@ -228,13 +238,9 @@ class ImgGrnd(AnetBaseMdl):
                 nn.Linear(256, 1)
             ]
         )
-        self.lin_tmp = nn.Sequential(
-            *[
-                nn.Linear(self.vis_lang_feat_dim, 256),
-                nn.ReLU(),
-                nn.Linear(256, 1)
-            ]
-        )
+        # lin_tmp (per-frame temporal head) is not
+        # consumed by any loss or evaluator
+        self.pruned_modules.append('lin_tmp')
 
     def simple_srl_attn(self, q0_srl, q0, q0_verb, inp):
         B, nv, nsrl, qdim = q0_srl.shape
@@ -254,7 +260,9 @@ class ImgGrnd(AnetBaseMdl):
         src_lens = src_lens.squeeze(-1)
         src_tokens = src_tokens_tags['src_tokens']
         # src_tags = src_tokens_tags['src_tags']
-        src_tokens = src_tokens[:, :src_lens.max().item()].contiguous()
+        if not is_tracing():
+            # the max length would be a constant in a traced graph
+            src_tokens = src_tokens[:, :src_lens.max().item()].contiguous()
         # if self.cfg.mdl.lang_use_tags:
         # src_tags = src_tags[:, :src_lens.max().item()].contiguous()
         # else:
@@ -351,17 +359,77 @@ class ImgGrnd(AnetBaseMdl):
         B, ncmp1, nsrl, nprop, vldim = conc_feats.shape
         assert ncmp1 == ncmp
         conc_feats_out = self.lin2(conc_feats)
-        conc_feats_temp = conc_feats.view(
-            B, ncmp, nsrl, nfrm,
-            nppf, vldim
-        ).sum(dim=-2)
-        # B x ncmp x nsrl x nfrms x (vldim->1)
-        conc_temp_out = self.lin_tmp(conc_feats_temp)
         return {
             'conc_feats_out': conc_feats_out.squeeze(-1),
-            'conc_temp_out': conc_temp_out.squeeze(-1)
         }
 
+    def use_chunked_conc(self):
+        """
+        Chunked conc_encode is only for inference
+        and when a memory budget is given
+        """
+        return (not self.training and
+                self.cfg.train.eval_mem_budget_mb > 0)
+
+    def get_conc_chunk_sizes(self, B, ncmp, nsrl, nprop, vldim):
+        """
+        Number of videos (B, ncmp) and srl-args processed
+        together so that the concatenated features and
+        the conc_encode activations fit the memory budget
+        """
+        budget = self.cfg.train.eval_mem_budget_mb * 2**20
+        # bytes for one (video, srl-arg) pair
+        pair_bytes = nprop * vldim * 4 * self.conc_mem_mult
+        npairs = max(1, int(budget // pair_bytes))
+        if self.conc_pointwise:
+            csrl = min(nsrl, npairs)
+        else:
+            # srl-args interact, cannot be split
+            csrl = nsrl
+        nvids = max(1, npairs // csrl)
+        ccmp = min(ncmp, nvids)
+        cb = min(B, max(1, nvids // ccmp))
+        return cb, ccmp, csrl
+
+    def conc_encode_chunked(self, prop_seg_feats, srl_arg_lstm_encoded, inp):
+        """
+        Bounded-memory conc_encode for inference.
+        Streams the concatenation and conc_encode (incl. lin2)
+        over chunks of videos and srl-args so that the
+        B x ncmp x nsrl x nprops x vldim tensor is never
+        created in full.
+        prop_seg_feats: B x ncmp x nprops x psdim
+        srl_arg_lstm_encoded: B x ncmp x nsrl x ldim
+        output: conc_feats_out B x ncmp x nsrl x nprops
+        """
+        B, ncmp, nprop, psdim = prop_seg_feats.shape
+        nsrl, ldim = srl_arg_lstm_encoded.shape[2:]
+        cb, ccmp, csrl = self.get_conc_chunk_sizes(
+            B, ncmp, nsrl, nprop, psdim + ldim)
+
+        # inputs read by conc_encode
+        inp_keys = [k for k in ['new_srl_idxs', 'pad_proposals',
+                                'pad_props_msk'] if k in inp]
+        conc_feats_out = prop_seg_feats.new_zeros(B, ncmp, nsrl, nprop)
+        for b0 in range(0, B, cb):
+            b1 = min(B, b0 + cb)
+            for c0 in range(0, ncmp, ccmp):
+                c1 = min(ncmp, c0 + ccmp)
+                # ncmp is 1 for temp/spat, only sep is split here
+                inp_chunk = {
+                    k: inp[k][b0:b1, c0:c1] if ccmp < ncmp else inp[k][b0:b1]
+                    for k in inp_keys
+                }
+                for s0 in range(0, nsrl, csrl):
+                    s1 = min(nsrl, s0 + csrl)
+                    conc_feats = self.concate_vis_lang_feats(
+                        prop_seg_feats[b0:b1, c0:c1],
+                        srl_arg_lstm_encoded[b0:b1, c0:c1, s0:s1]
+                    )
+                    conc_feats_out[b0:b1, c0:c1, s0:s1] = self.conc_encode(
+                        conc_feats, inp_chunk)['conc_feats_out']
+        return {'conc_feats_out': conc_feats_out}
+
     def get_seg_verb_feats_to_process(
             self,
             seg_feats, srl_arg_lstm_encoded,
@@ -397,6 +465,89 @@ class ImgGrnd(AnetBaseMdl):
         return seg_verb_feats_outs.squeeze(-1)
 
 
+def quantize_mdl_dynamic(mdl):
+    """
+    Dynamic int8 quantized copy of the model for cpu inference.
+    Linear/LSTM layers of the proposal/segment encoders,
+    the lstm_encoder, the transformers and lin2 are quantized,
+    weights are taken from the given (fp32) model, so regular
+    checkpoints can be loaded before calling this.
+    """
+    if not hasattr(getattr(torch, 'quantization', None),
+                   'quantize_dynamic'):
+        raise NotImplementedError(
+            'Dynamic quantization requires torch>=1.3')
+    mdl = getattr(mdl, 'module', mdl)
+    quant_names = ['prop_encoder', 'seg_encoder', 'lstm_encoder',
+                   'obj_txf', 'mult_txf', 'lin2']
+    qconfig_spec = {n for n in quant_names if hasattr(mdl, n)}
+    qmdl = copy.deepcopy(mdl).cpu().eval()
+    return torch.quantization.quantize_dynamic(
+        qmdl, qconfig_spec=qconfig_spec, dtype=torch.qint8)
+
+
+class TinyQuantMdl(nn.Module):
+    """
+    Tiny model with some of the submodule names of ImgGrnd,
+    for check_quantize_dynamic
+    """
+    def __init__(self, hdim=16):
+        super().__init__()
+        self.prop_encoder = nn.Sequential(nn.Linear(hdim, hdim), nn.ReLU())
+        self.lstm_encoder = nn.LSTM(hdim, hdim, batch_first=True)
+        self.lin2 = nn.Linear(2 * hdim, 1)
+        # not quantized
+        self.seg_verb_classf = nn.Linear(hdim, 1)
+
+    def forward(self, props, words):
+        prop_feats = self.prop_encoder(props)
+        lang_feats = self.lstm_encoder(words)[0][:, -1:]
+        out = self.lin2(torch.cat(
+            [prop_feats, lang_feats.expand_as(prop_feats)], dim=-1))
+        return (out + self.seg_verb_classf(lang_feats)).squeeze(-1)
+
+
+def check_quantize_dynamic(hdim=16, seed=0):
+    """
+    quantize_mdl_dynamic on a tiny random model: a regular
+    fp32 checkpoint (as saved by Learner.save_model_dict)
+    is loaded, then the quantized copy runs forward
+    """
+    import io
+    torch.manual_seed(seed)
+    mdl_trained = TinyQuantMdl(hdim)
+    ckpt = io.BytesIO()
+    torch.save({'model_state_dict': mdl_trained.state_dict()}, ckpt)
+    ckpt.seek(0)
+
+    mdl = TinyQuantMdl(hdim)
+    mdl.load_state_dict(
+        torch.load(ckpt, map_location='cpu')['model_state_dict'])
+    mdl.eval()
+    qmdl = quantize_mdl_dynamic(mdl)
+
+    # only the named submodules are quantized, mdl is unchanged
+    assert 'quantized' in type(qmdl.lin2).__module__
+    assert 'quantized' in type(qmdl.lstm_encoder).__module__
+    assert 'quantized' in type(qmdl.prop_encoder[0]).__module__
+    assert type(qmdl.seg_verb_classf) is nn.Linear
+    assert type(mdl.lin2) is nn.Linear
+
+    props = torch.randn(2, 10, hdim)
+    words = torch.randn(2, 5, hdim)
+    with torch.no_grad():
+        out = mdl(props, words)
+        qout = qmdl(props, words)
+        out_trained = mdl_trained.eval()(props, words)
+    assert torch.equal(out, out_trained)
+    assert qout.shape == out.shape
+    max_diff = (qout - out).abs().max().item()
+    print(f'int8 vs fp32 max abs diff {max_diff:.4f}, '
+          f'output scale {out.abs().max().item():.4f}')
+    assert max_diff < 0.1 * out.abs().max().item()
+    return max_diff
+
+
 class ImgGrnd_SEP(ConcSEP, ImgGrnd):
     pass
 
@@ -428,7 +579,8 @@ class VidGrnd(ImgGrnd):
                 n_heads=n_heads,
                 drop_ratio=attn_drop,
                 pe=False,
-                d_pe=5
+                d_pe=5,
+                checkpoint=self.cfg.mdl.obj_tx.checkpoint
             )
         else:
             self.obj_txf = Transformer(
@@ -438,6 +590,7 @@ class VidGrnd(ImgGrnd):
                 n_heads=n_heads,
                 drop_ratio=attn_drop,
                 pe=False,
+                checkpoint=self.cfg.mdl.obj_tx.checkpoint
             )
 
         if self.cfg.mdl.obj_tx.use_ddp:
@@ -489,10 +642,41 @@ class VidGrnd(ImgGrnd):
 
         return props_subt
 
+    def get_props_kpm(self, inp, tx_cfg, nprops):
+        """
+        Key padding mask for the transformers,
+        True for the padded proposals (index >= num_props)
+        output: B*ncmp x nprops or None
+        """
+        if not tx_cfg.use_kpm:
+            return None
+        return (inp['pad_props_msk'] == 0).view(-1, nprops)
+
+    def apply_txf(self, txf, x, x_pe, kpm, tx_cfg):
+        """
+        x: S x N x d, x_pe: S x N x N x nh
+        kpm: S x N or None
+        If n_buckets > 0, only the valid positions
+        are computed (see bucketed_forward)
+        """
+        def txf_fn(x1, kpm1, pe1):
+            if tx_cfg.use_rel:
+                return txf(x1, pe1, key_padding_mask=kpm1)
+            return txf(x1, key_padding_mask=kpm1)
+
+        if kpm is not None and tx_cfg.n_buckets > 0:
+            return bucketed_forward(
+                txf_fn, x, kpm,
+                x_pe if tx_cfg.use_rel else None,
+                n_buckets=tx_cfg.n_buckets
+            )
+        return txf_fn(x, kpm, x_pe)
+
     def simple_obj_interact(self, ps_feats, inp, ncmp, nfrm, nppf):
         B, num_cmp1, nprops, psdim = ps_feats.shape
         assert ncmp == num_cmp1
         assert nprops == nfrm * nppf
+        kpm = self.get_props_kpm(inp, self.cfg.mdl.obj_tx, nprops)
         if self.cfg.mdl.obj_tx.one_frm:
             props = inp['pad_proposals'][..., :5].clone().detach()
             pe_props = self.compute_pe(
@@ -502,6 +686,8 @@ class VidGrnd(ImgGrnd):
             ps_feats_pre = ps_feats.view(
                 B*ncmp*nfrm, nppf, psdim
             ).contiguous()
+            if kpm is not None:
+                kpm = kpm.view(B*ncmp*nfrm, nppf)
         else:
             props = inp['pad_proposals'][..., :5].clone().detach()
             pe_props = self.compute_pe(
@@ -512,10 +698,9 @@ class VidGrnd(ImgGrnd):
                 B*ncmp, nprops, psdim
             ).contiguous()
 
-        if self.cfg.mdl.obj_tx.use_rel:
-            ps_feats_sa = self.obj_txf(ps_feats_pre, pe_props)
-        else:
-            ps_feats_sa = self.obj_txf(ps_feats_pre)
+        ps_feats_sa = self.apply_txf(
+            self.obj_txf, ps_feats_pre, pe_props, kpm, self.cfg.mdl.obj_tx
+        )
         prop_seg_feats = ps_feats_sa.view(
             B, ncmp, nprops, psdim
         )
@@ -543,6 +728,9 @@ class VOGNet(VidGrnd):
     def set_args_mdl(self):
         VidGrnd.set_args_mdl(self)
         self.conc_encode_item = getattr(self, 'conc_encode_sa')
+        # srl-args interact in the multi-modal transformer
+        self.conc_pointwise = False
+        self.conc_mem_mult = 6
 
     def build_conc_model(self):
         VidGrnd.build_conc_model(self)
@@ -559,7 +747,8 @@ class VOGNet(VidGrnd):
                     n_heads=n_heads,
                     drop_ratio=attn_drop,
                     pe=False,
-                    d_pe=5
+                    d_pe=5,
+                    checkpoint=self.cfg.mdl.mul_tx.checkpoint
                 )
             )
         else:
@@ -570,7 +759,8 @@ class VOGNet(VidGrnd):
                     n_layers=n_layers,
                     n_heads=n_heads,
                     drop_ratio=attn_drop,
-                    pe=False
+                    pe=False,
+                    checkpoint=self.cfg.mdl.mul_tx.checkpoint
                 )
             )
 
@@ -610,25 +800,17 @@ class VOGNet(VidGrnd):
             out_t = (out_t1 + out_t2) / 2
             return out_t
 
-        def unpack_t(inp_t):
-            out_t = torch.cat(
-                [inp_t[:, :, 0, ...], inp_t[:, [-1], 0, ...]],
-                dim=1
-            )
-            return out_t
-
-            # return out_t.view(B, ncmp, nsrl, nfrm*nppf, vldim)
-
         assert self.cfg.mdl.mul_tx.one_frm or self.cfg.mdl.mul_tx.cross_frm
 
         pe_props = inp['pad_proposals'][..., :5].clone().detach()
+        kpm = self.get_props_kpm(inp, self.cfg.mdl.mul_tx, nfrm*nppf)
         if self.cfg.mdl.mul_tx.one_frm:
             out_dict_pfrm = self.conc_encode2(
                 conc_feats, inp, nfrm, nppf, ncmp, pe_props,
-                int_pfrm=True
+                int_pfrm=True, kpm=kpm
             )
         else:
-            out_dict_pfrm = {'conc_feats_out': 0, 'conc_temp_out': 0}
+            out_dict_pfrm = {'conc_feats_out': 0}
 
         if self.cfg.mdl.mul_tx.cross_frm:
             B, ncmp1, nsrl, nprop, vldim = conc_feats.shape
@@ -643,32 +825,32 @@ class VOGNet(VidGrnd):
 
             pe_cross = pe_props.view(B, ncmp, nfrm, nppf, 5)
             p1 = torch.cat([pe_cross[:, :, :-1], pe_cross[:, :, 1:]], dim=3)
-            if ncmp == 1:
+            # compute_pe expects B x ncmp x nprops x 5 for SEP,
+            # also when ncmp == 1 (svsq, or one packed video)
+            if ncmp == 1 and self.cfg.ds.conc_type in ['spat', 'temp']:
                 p1 = p1.view(B, (nfrm-1) * 2*nppf, 5)
             else:
                 p1 = p1.view(B, ncmp, (nfrm-1) * 2*nppf, 5)
 
+            k1 = None
+            if kpm is not None:
+                k_cross = kpm.view(B*ncmp, nfrm, nppf)
+                k1 = torch.cat([k_cross[:, :-1], k_cross[:, 1:]], dim=2)
+                k1 = k1.view(B*ncmp, (nfrm-1)*2*nppf)
+
             out_dict1 = self.conc_encode2(
-                c1, inp, nfrm-1, 2*nppf, ncmp, p1, int_pfrm=True
+                c1, inp, nfrm-1, 2*nppf, ncmp, p1, int_pfrm=True, kpm=k1
             )
             c2 = unpack(
                 out_dict1['conc_feats_out'].view(
                     B*ncmp*nsrl, nfrm-1, 2, nppf, vldim)
             ).view(B, ncmp, nsrl, nfrm*nppf, vldim)
-
-            t2 = unpack_t(
-                out_dict1['conc_temp_out'].view(
-                    B*ncmp*nsrl, nfrm-1, 1, 1, vldim
-                )
-            ).view(B, ncmp, nsrl, nfrm, vldim)
             out_dict_cfrm = {
                 'conc_feats_out': c2,
-                # 'conc_temp_out': t2
             }
         else:
             out_dict_cfrm = {
                 'conc_feats_out': 0,
-                # 'conc_temp_out': 0
             }
 
         out_dict = {}
@@ -679,9 +861,10 @@ class VOGNet(VidGrnd):
         return out_dict
 
     def conc_encode2(self, conc_feats, inp, nfrm, nppf,
-                     ncmp, pe_props, int_pfrm):
+                     ncmp, pe_props, int_pfrm, kpm=None):
         """
         conc_feats: B x 6 x 5 x 1000 x 6144
+        kpm: B*6 x 1000 (True for padded proposals) or None
         output: B x 6 x 5 x 1000 x 1
         """
 
@@ -697,11 +880,20 @@ class VOGNet(VidGrnd):
                 B * ncmp * nfrm,
                 nsrl * nppf, vldim
             ).contiguous()
+            if kpm is not None:
+                # same layout as conc_feats_sa_pre
+                kpm = kpm.view(B * ncmp, 1, nfrm, nppf).expand(
+                    B * ncmp, nsrl, nfrm, nppf
+                ).transpose(1, 2).reshape(B * ncmp * nfrm, nsrl * nppf)
 
         else:
             conc_feats_sa_pre = conc_feats.view(
                 B * ncmp, nsrl * nprop, vldim
             ).contiguous()
+            if kpm is not None:
+                kpm = kpm.view(B * ncmp, 1, nprop).expand(
+                    B * ncmp, nsrl, nprop
+                ).reshape(B * ncmp, nsrl * nprop)
 
         # B*ncmp x nfrm x nsrl*nppf x 5
         # pe = self.pe_enc(self.compute_pe(
@@ -715,10 +907,9 @@ class VOGNet(VidGrnd):
         # Perform self-attn
         # B*ncmp x nfrm x nsrl*nppf x vldim
         # conc_feats_sa_pre += pe
-        if self.cfg.mdl.mul_tx.use_rel:
-            conc_feats_sa = self.mult_txf(conc_feats_sa_pre, pe)
-        else:
-            conc_feats_sa = self.mult_txf(conc_feats_sa_pre)
+        conc_feats_sa = self.apply_txf(
+            self.mult_txf, conc_feats_sa_pre, pe, kpm, self.cfg.mdl.mul_tx
+        )
         # conc_feats_sa = self.obj_lang_interact(conc_feats_sa_pre)
 
         if int_pfrm:
@@ -754,3 +945,7 @@ class VOG_TEMP(ConcTEMP, VOGNet):
 
 class VOG_SPAT(ConcSPAT, VOGNet):
     pass
+
+
+if __name__ == '__main__':
+    check_quantize_dynamic()
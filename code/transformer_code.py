@@ -6,6 +6,7 @@ import torch
 import math
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint as checkpoint_fn
 
 INF = 1e10
 
@@ -18,6 +19,66 @@ def matmul(x, y):
     return torch.matmul(x, y.unsqueeze(-2)).squeeze(-2)
 
 
+def unmask_all_padded(key_padding_mask):
+    """
+    Sequences which are fully padded (like padded videos)
+    would give nan in softmax, attend everywhere for those
+    """
+    if key_padding_mask is None:
+        return None
+    return key_padding_mask & ~key_padding_mask.all(dim=-1, keepdim=True)
+
+
+def bucketed_forward(txf_fn, x, key_padding_mask, x_pe=None, n_buckets=1):
+    """
+    Runs txf_fn only on the valid positions of each sequence.
+    Valid positions are moved to the front (keeping their order),
+    sequences are grouped into n_buckets of similar lengths
+    and each bucket is trimmed to its longest sequence.
+    txf_fn(x, key_padding_mask, x_pe) -> output like x
+    x: S x N x d
+    key_padding_mask: S x N, True for padded positions
+    x_pe: S x N x N x nh or None
+    output: S x N x d, zeros at padded positions
+    """
+    S, N, d = x.shape
+    # keys are unique, so valid positions move to
+    # the front and keep their order
+    pos = torch.arange(N, device=x.device)
+    order = (key_padding_mask.long() * N + pos).argsort(dim=-1)
+    order_inv = order.argsort(dim=-1)
+    lens = (~key_padding_mask).sum(dim=-1)
+
+    x_sorted = x.gather(1, order.unsqueeze(-1).expand(S, N, d))
+    kpm_sorted = key_padding_mask.gather(1, order)
+    if x_pe is not None:
+        nh = x_pe.size(-1)
+        x_pe = x_pe.gather(
+            1, order.view(S, N, 1, 1).expand(S, N, N, nh)
+        ).gather(
+            2, order.view(S, 1, N, 1).expand(S, N, N, nh)
+        )
+
+    out_sorted = x.new_zeros(S, N, d)
+    for bucket in lens.argsort().chunk(n_buckets):
+        blen = max(lens[bucket].max().item(), 1)
+        pe_b = None if x_pe is None else x_pe[bucket, :blen, :blen]
+        out_sorted[bucket, :blen] = txf_fn(
+            x_sorted[bucket, :blen], kpm_sorted[bucket, :blen], pe_b
+        )
+
+    return out_sorted.gather(1, order_inv.unsqueeze(-1).expand(S, N, d))
+
+
+def use_checkpoint(encoder, x):
+    """
+    Checkpointing only pays off when a backward
+    pass follows, i.e. training with grad enabled
+    """
+    return (encoder.checkpoint and encoder.training and
+            torch.is_grad_enabled() and x.requires_grad)
+
+
 class ResidualBlock(nn.Module):
 
     def __init__(self, layer, d_model, drop_ratio):
@@ -27,8 +88,8 @@ class ResidualBlock(nn.Module):
         # self.layernorm = LayerNorm(d_model)
         self.layernorm = nn.LayerNorm(d_model)
 
-    def forward(self, *x):
-        return self.layernorm(x[0] + self.dropout(self.layer(*x)))
+    def forward(self, *x, **kwargs):
+        return self.layernorm(x[0] + self.dropout(self.layer(*x, **kwargs)))
 
 
 class Attention(nn.Module):
@@ -39,7 +100,10 @@ class Attention(nn.Module):
         self.dropout = nn.Dropout(drop_ratio)
         self.causal = causal
 
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, key_padding_mask=None):
+        """
+        key_padding_mask: B x N, True for padded keys
+        """
         dot_products = matmul(query, key.transpose(1, 2))
         if query.dim() == 3 and (self is None or self.causal):
             tri = torch.ones(key.size(1), key.size(1)).triu(1) * INF
@@ -47,6 +111,12 @@ class Attention(nn.Module):
                 tri = tri.cuda(key.get_device())
             dot_products.data.sub_(tri.unsqueeze(0))
 
+        if key_padding_mask is not None:
+            # -INF does not fit in fp16 (train.amp)
+            dot_products = dot_products.masked_fill(
+                key_padding_mask.unsqueeze(1),
+                torch.finfo(dot_products.dtype).min)
+
         return matmul(self.dropout(F.softmax(dot_products / self.scale, dim=-1)), value)
 
 
@@ -61,12 +131,12 @@ class MultiHead(nn.Module):
         self.wo = nn.Linear(d_value, d_key, bias=False)
         self.n_heads = n_heads
 
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, key_padding_mask=None):
         query, key, value = self.wq(query), self.wk(key), self.wv(value)
 
         query, key, value = (
             x.chunk(self.n_heads, -1) for x in (query, key, value))
-        return self.wo(torch.cat([self.attention(q, k, v)
+        return self.wo(torch.cat([self.attention(q, k, v, key_padding_mask)
                                   for q, k, v in zip(query, key, value)], -1))
 
 
@@ -91,14 +161,15 @@ class EncoderLayer(nn.Module):
         self.feedforward = ResidualBlock(FeedForward(d_model, d_hidden),
                                          d_model, drop_ratio)
 
-    def forward(self, x):
-        return self.feedforward(self.selfattn(x, x, x))
+    def forward(self, x, key_padding_mask=None):
+        return self.feedforward(
+            self.selfattn(x, x, x, key_padding_mask=key_padding_mask))
 
 
 class Encoder(nn.Module):
 
     def __init__(self, d_model, d_hidden, n_vocab, n_layers, n_heads,
-                 drop_ratio, pe):
+                 drop_ratio, pe, checkpoint=False):
         super(Encoder, self).__init__()
         # self.linear = nn.Linear(d_model*2, d_model)
         self.layers = nn.ModuleList(
@@ -106,8 +177,10 @@ class Encoder(nn.Module):
              for i in range(n_layers)])
         self.dropout = nn.Dropout(drop_ratio)
         self.pe = pe
+        # recompute layer activations in backward
+        self.checkpoint = checkpoint
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, key_padding_mask=None):
         # x = self.linear(x)
         if self.pe:
             # spatial configuration is already encoded
@@ -116,9 +189,15 @@ class Encoder(nn.Module):
         # x = self.dropout(x) # dropout is already in the pool_embed layer
         if mask is not None:
             x = x*mask
+        key_padding_mask = unmask_all_padded(key_padding_mask)
         encoding = []
         for layer in self.layers:
-            x = layer(x)
+            if use_checkpoint(self, x):
+                def layer_fn(x1, layer=layer):
+                    return layer(x1, key_padding_mask=key_padding_mask)
+                x = checkpoint_fn(layer_fn, x)
+            else:
+                x = layer(x, key_padding_mask=key_padding_mask)
             if mask is not None:
                 x = x*mask
             encoding.append(x)
@@ -133,10 +212,11 @@ class RelAttention(nn.Module):
         self.dropout = nn.Dropout(drop_ratio)
         self.causal = causal
 
-    def forward(self, query, key, value, pe_k, pe_v):
+    def forward(self, query, key, value, pe_k, pe_v, key_padding_mask=None):
         """
         query, key, value: B x N x 214
         pe_k: B x N x N x 214
+        key_padding_mask: B x N, True for padded keys
         """
         dot_products = matmul(query, key.transpose(1, 2))
         if query.dim() == 3 and (self is None or self.causal):
@@ -149,6 +229,10 @@ class RelAttention(nn.Module):
         new_dp = pe_k.squeeze(-1)
         assert new_dp.shape == dot_products.shape
         new_dot_prods = (dot_products + new_dp) / self.scale
+        if key_padding_mask is not None:
+            new_dot_prods = new_dot_prods.masked_fill(
+                key_padding_mask.unsqueeze(1),
+                torch.finfo(new_dot_prods.dtype).min)
 
         attn = self.dropout(F.softmax(new_dot_prods, dim=-1))
 
@@ -173,7 +257,7 @@ class RelMultiHead(nn.Module):
         # self.wpk = nn.Linear(d_pe, self.n_heads, bias=False)
         # self.wpv = nn.Linear(d_pe, self.n_heads, bias=False)
 
-    def forward(self, query, key, value, pe=None):
+    def forward(self, query, key, value, pe=None, key_padding_mask=None):
         """
         pe is B x N x N x 1 position difference
         """
@@ -181,7 +265,8 @@ class RelMultiHead(nn.Module):
         pe_k, pe_v = pe, pe
         query, key, value, pe_k, pe_v = (
             x.chunk(self.n_heads, -1) for x in (query, key, value, pe_k, pe_v))
-        return self.wo(torch.cat([self.attention(q, k, v, pk, pv)
+        return self.wo(torch.cat([self.attention(q, k, v, pk, pv,
+                                                 key_padding_mask)
                                   for q, k, v, pk, pv in
                                   zip(query, key, value, pe_k, pe_v)], -1))
 
@@ -198,9 +283,10 @@ class RelEncoderLayer(nn.Module):
                                          d_model, drop_ratio)
         self.sa = sa
 
-    def forward(self, x, pe=None):
+    def forward(self, x, pe=None, key_padding_mask=None):
         if not isinstance(x, dict):
-            return self.feedforward(self.selfattn(x, x, x, pe))
+            return self.feedforward(self.selfattn(
+                x, x, x, pe, key_padding_mask=key_padding_mask))
         else:
             assert not self.sa
             assert isinstance(x, dict)
@@ -208,14 +294,15 @@ class RelEncoderLayer(nn.Module):
             assert 'key' in x
             assert 'value' in x
             return self.feedforward(
-                self.selfattn(x['query'], x['key'], x['value'], pe)
+                self.selfattn(x['query'], x['key'], x['value'], pe,
+                              key_padding_mask=key_padding_mask)
             )
 
 
 class RelEncoder(nn.Module):
 
     def __init__(self, d_model, d_hidden, n_vocab, n_layers, n_heads,
-                 drop_ratio, pe, d_pe, sa=True):
+                 drop_ratio, pe, d_pe, sa=True, checkpoint=False):
         super().__init__()
         # self.linear = nn.Linear(d_model*2, d_model)
         self.layers = nn.ModuleList(
@@ -223,8 +310,9 @@ class RelEncoder(nn.Module):
              for i in range(n_layers)])
         self.dropout = nn.Dropout(drop_ratio)
         self.pe = pe
+        self.checkpoint = checkpoint
 
-    def forward(self, x, x_pe, mask=None):
+    def forward(self, x, x_pe, mask=None, key_padding_mask=None):
         # x = self.linear(x)
         if self.pe:
             # spatial configuration is already encoded
@@ -232,9 +320,18 @@ class RelEncoder(nn.Module):
         # x = self.dropout(x) # dropout is already in the pool_embed layer
         if mask is not None:
             x = x*mask
+        key_padding_mask = unmask_all_padded(key_padding_mask)
         encoding = []
         for layer in self.layers:
-            x = layer(x, pe=x_pe)
+            if use_checkpoint(self, x):
+                # x_pe is passed as an input so that its
+                # gradient is computed in the recomputation
+                def layer_fn(x1, pe1, layer=layer):
+                    return layer(x1, pe=pe1,
+                                 key_padding_mask=key_padding_mask)
+                x = checkpoint_fn(layer_fn, x, x_pe)
+            else:
+                x = layer(x, pe=x_pe, key_padding_mask=key_padding_mask)
             if mask is not None:
                 x = x*mask
             encoding.append(x)
@@ -244,13 +341,14 @@ class RelEncoder(nn.Module):
 class Transformer(nn.Module):
 
     def __init__(self, d_model, n_vocab_src, vocab_trg, d_hidden=2048,
-                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False):
+                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False,
+                 checkpoint=False):
         super(Transformer, self).__init__()
         self.encoder = Encoder(d_model, d_hidden, n_vocab_src, n_layers,
-                               n_heads, drop_ratio, pe)
+                               n_heads, drop_ratio, pe, checkpoint=checkpoint)
 
-    def forward(self, x):
-        encoding = self.encoder(x)
+    def forward(self, x, key_padding_mask=None):
+        encoding = self.encoder(x, key_padding_mask=key_padding_mask)
         return encoding[-1]
         # return encoding[-1], encoding
         # return torch.cat(encoding, 2)
@@ -263,13 +361,15 @@ class Transformer(nn.Module):
 class RelTransformer(nn.Module):
 
     def __init__(self, d_model, n_vocab_src, vocab_trg, d_hidden=2048,
-                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False, d_pe=None):
+                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False, d_pe=None,
+                 checkpoint=False):
         super().__init__()
         self.encoder = RelEncoder(d_model, d_hidden, n_vocab_src, n_layers,
-                                  n_heads, drop_ratio, pe, d_pe=d_pe)
+                                  n_heads, drop_ratio, pe, d_pe=d_pe,
+                                  checkpoint=checkpoint)
 
-    def forward(self, x, x_pe):
-        encoding = self.encoder(x, x_pe)
+    def forward(self, x, x_pe, key_padding_mask=None):
+        encoding = self.encoder(x, x_pe, key_padding_mask=key_padding_mask)
         return encoding[-1]
         # return encoding[-1], encoding
         # return torch.cat(encoding, 2)
@@ -277,3 +377,107 @@ class RelTransformer(nn.Module):
     def all_outputs(self, x):
         encoding = self.encoder(x)
         return encoding
+
+
+def check_checkpoint_parity(drop_ratio=0., seed=0, tol=1e-6):
+    """
+    Encoder and RelEncoder (via Transformer, RelTransformer)
+    with and without activation checkpointing give the
+    same outputs and gradients (input, pe and weights)
+    for the same weights, inputs and seed
+    """
+    S, N, d_model, n_heads = 3, 12, 24, 3
+    torch.manual_seed(seed)
+    x = torch.randn(S, N, d_model)
+    x_pe = torch.randn(S, N, N, n_heads)
+    kpm = torch.arange(N).view(1, N) >= torch.tensor([N, 7, 0]).view(S, 1)
+
+    for txf_cls in [Transformer, RelTransformer]:
+        outs = {}
+        for ckpt in [False, True]:
+            torch.manual_seed(seed)
+            txf = txf_cls(d_model, 0, 0, d_hidden=2 * d_model, n_layers=2,
+                          n_heads=n_heads, drop_ratio=drop_ratio,
+                          checkpoint=ckpt)
+            txf.train()
+            x1 = x.clone().requires_grad_()
+            inps = [x1]
+            if txf_cls is RelTransformer:
+                inps.append(x_pe.clone().requires_grad_())
+            # same dropout masks
+            torch.manual_seed(seed + 1)
+            out = txf(*inps, key_padding_mask=kpm)
+            out.pow(2).sum().backward()
+            outs[ckpt] = [out] + [inp.grad for inp in inps] + [
+                p.grad for p in txf.parameters()]
+
+        for ix, (out, out_ckpt) in enumerate(zip(outs[False], outs[True])):
+            assert torch.allclose(out, out_ckpt, rtol=0, atol=tol), (
+                txf_cls.__name__, ix, (out - out_ckpt).abs().max())
+        print(f'{txf_cls.__name__}: same outputs and '
+              f'{len(outs[False]) - 1} gradients with checkpointing')
+
+
+def bench_checkpoint():
+    """
+    throughput vs max batch size with and without
+    activation checkpointing, at the default cfg sizes
+    """
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    nfrm, nppf, nsrl, ncmp = 10, 100, 5, 4
+    # name: (d_model, seq_len, sequences per video)
+    settings = {
+        # obj_txf: one sequence of nfrm*nppf proposals per video
+        'obj_tx': (512, nfrm * nppf, 1),
+        # mult_txf (one_frm): nsrl*nppf per frame
+        'mul_tx': (768, nsrl * nppf, nfrm),
+    }
+
+    def step(txf, nvid, d_model, seq_len, nseq):
+        x = torch.randn(nvid * nseq, seq_len, d_model,
+                        device=device, requires_grad=True)
+        txf(x).sum().backward()
+
+    def throughput(txf, nvid, d_model, seq_len, nseq, n_it=5):
+        step(txf, nvid, d_model, seq_len, nseq)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        st = time.time()
+        for _ in range(n_it):
+            step(txf, nvid, d_model, seq_len, nseq)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return n_it * nvid / (time.time() - st)
+
+    def max_batch(txf, d_model, seq_len, nseq, cap=1024):
+        nvid = 1
+        while nvid <= cap:
+            try:
+                step(txf, nvid, d_model, seq_len, nseq)
+            except RuntimeError as e:
+                if 'out of memory' not in str(e):
+                    raise e
+                torch.cuda.empty_cache()
+                break
+            nvid *= 2
+        return nvid // 2
+
+    for name, (d_model, seq_len, nseq) in settings.items():
+        for ckpt in [False, True]:
+            txf = Transformer(
+                d_model, 0, 0, d_hidden=d_model // 2, n_layers=2,
+                n_heads=3, drop_ratio=0.2, checkpoint=ckpt
+            ).to(device)
+            txf.train()
+            nvid_max = (max_batch(txf, d_model, seq_len, nseq)
+                        if device.type == 'cuda' else float('nan'))
+            vids_per_s = throughput(txf, ncmp, d_model, seq_len, nseq)
+            print(f'{name} checkpoint={ckpt}: {vids_per_s:.1f} videos/s '
+                  f'at {ncmp} videos, max batch {nvid_max} videos')
+
+
+if __name__ == '__main__':
+    check_checkpoint_parity()
+    check_checkpoint_parity(drop_ratio=0.2)
+    bench_checkpoint()
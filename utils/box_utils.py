@@ -4,6 +4,7 @@ Adapted from
 https://github.com/facebookresearch/maskrcnn-benchmark/
 blob/master/maskrcnn_benchmark/structures/boxlist_ops.py
 """
+import time
 import torch
 
 TO_REMOVE = 0
@@ -51,6 +52,27 @@ def box_iou(box1, box2):
     return iou
 
 
+def box_iou_aligned(box1, box2):
+    """
+    box1: [N, 4]
+    box2: [N, 4]
+    IoU of box1[i] with box2[i], same
+    ops as box_iou
+    output: [N]
+    """
+    area1 = get_area(box1)
+    area2 = get_area(box2)
+
+    lt = torch.max(box1[:, :2], box2[:, :2])  # [N,2]
+    rb = torch.min(box1[:, 2:], box2[:, 2:])  # [N,2]
+
+    wh = (rb - lt + TO_REMOVE).clamp(min=0)  # [N,2]
+    inter = wh[:, 0] * wh[:, 1]  # [N]
+
+    iou = inter / (area1 + area2 - inter)
+    return iou
+
+
 def bbox_overlaps(rois, gt_box, frm_mask):
 
     overlaps = bbox_overlaps_batch(rois[:, :, :5], gt_box[:, :, :5], frm_mask)
@@ -74,8 +96,9 @@ def bbox_overlaps_batch(anchors, gt_boxes, frm_mask=None):
     N = anchors.size(1)
     K = gt_boxes.size(1)
 
-    anchors = anchors[:, :, :5].contiguous()
-    gt_boxes = gt_boxes[:, :, :5].contiguous()
+    # IoU is always computed in fp32 (also under autocast)
+    anchors = anchors[:, :, :5].float().contiguous()
+    gt_boxes = gt_boxes[:, :, :5].float().contiguous()
 
     gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
     gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
@@ -116,3 +139,252 @@ def bbox_overlaps_batch(anchors, gt_boxes, frm_mask=None):
             batch_size, N, 1).expand(batch_size, N, K), -1)
 
     return overlaps
+
+
+def bbox_overlaps_frm(anchors, gt_boxes, num_frms=None):
+    """
+    Same as bbox_overlaps_batch, but the overlaps are computed
+    only between boxes of the same frame (frame index is at 4).
+    Proposals only look at the gt boxes of their frame,
+    so output is compact (M is max gt boxes in a frame)
+    anchors: (b, N, 5)
+    gt_boxes: (b, K, 5), padded gt boxes have zero area
+    num_frms: max frame index + 1, computed if None
+
+    overlaps: (b, N, M) overlap of the proposal and the gt box
+    gt_inds: (b, N, M) index (in K) of the gt box, -1 if no gt box
+    """
+    batch_size = gt_boxes.size(0)
+    N = anchors.size(1)
+    K = gt_boxes.size(1)
+
+    # IoU is always computed in fp32 (also under autocast)
+    anchors = anchors[:, :, :5].float().contiguous()
+    gt_boxes = gt_boxes[:, :, :5].float().contiguous()
+
+    if num_frms is None:
+        num_frms = int(max(anchors[..., 4].max().item(),
+                           gt_boxes[..., 4].max().item())) + 1
+
+    gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
+    gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
+    gt_valid = ~((gt_boxes_x == 1) & (gt_boxes_y == 1))
+
+    anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
+    anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+
+    # bucket the gt boxes by frame:
+    # b x K x num_frms, 1 for the frame of the gt box
+    gt_frm = gt_boxes[:, :, 4].long().clamp(0, num_frms - 1)
+    frm_onehot = (
+        gt_frm.unsqueeze(-1) == torch.arange(
+            num_frms, device=gt_frm.device).view(1, 1, num_frms)
+    ) & gt_valid.unsqueeze(-1)
+    frm_onehot = frm_onehot.long()
+    M = max(frm_onehot.sum(dim=1).max().item(), 1)
+    # position of the gt box within its frame
+    gt_rank = (frm_onehot.cumsum(dim=1) - 1).gather(
+        2, gt_frm.unsqueeze(-1)).squeeze(-1)
+    # invalid gt boxes are written to the last (dump) slot
+    gt_slot = gt_frm * M + gt_rank
+    gt_slot[~gt_valid] = num_frms * M
+    gt_table = gt_frm.new_full((batch_size, num_frms * M + 1), -1)
+    gt_table.scatter_(
+        1, gt_slot,
+        torch.arange(K, device=gt_frm.device).view(
+            1, K).expand(batch_size, K)
+    )
+    gt_table = gt_table[:, :num_frms * M].view(batch_size, num_frms, M)
+
+    # b x N x M
+    anc_frm = anchors[:, :, 4].long().clamp(0, num_frms - 1)
+    gt_inds = gt_table.gather(
+        1, anc_frm.unsqueeze(-1).expand(batch_size, N, M))
+    query_boxes = gt_boxes.gather(
+        1, gt_inds.clamp(min=0).view(batch_size, N * M, 1).expand(
+            batch_size, N * M, 5)
+    ).view(batch_size, N, M, 5)
+    boxes = anchors.view(batch_size, N, 1, 5)
+
+    iw = (torch.min(boxes[..., 2], query_boxes[..., 2]) -
+          torch.max(boxes[..., 0], query_boxes[..., 0]) + 1).clamp(min=0)
+    ih = (torch.min(boxes[..., 3], query_boxes[..., 3]) -
+          torch.max(boxes[..., 1], query_boxes[..., 1]) + 1).clamp(min=0)
+
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
+    query_area = ((query_boxes[..., 2] - query_boxes[..., 0] + 1) *
+                  (query_boxes[..., 3] - query_boxes[..., 1] + 1))
+    ua = anchors_area + query_area - (iw * ih)
+
+    overlaps = iw * ih / ua
+    overlaps.masked_fill_(gt_inds < 0, 0)
+    overlaps.masked_fill_(anchors_area_zero.view(
+        batch_size, N, 1).expand(batch_size, N, M), -1)
+
+    return overlaps, gt_inds
+
+
+def get_targets_from_frm_overlaps(overlaps, gt_inds, srl_boxes,
+                                  srl_boxes_lens, thresh=0.5):
+    """
+    Targets from the output of bbox_overlaps_frm
+    overlaps, gt_inds: (b, N, M)
+    srl_boxes: (b, nv, nsrl, nbox) gt box indices for each srl
+    srl_boxes_lens: (b, nv, nsrl, nbox) 1 if the gt box is used
+
+    targets: (b, nv, nsrl, N) 1 if the proposal overlaps
+    (> thresh) with one of the gt boxes of the srl
+    """
+    batch_size, N, M = overlaps.shape
+    _, nv, nsrl, nbox = srl_boxes.shape
+    K = max(gt_inds.max().item(), srl_boxes.max().item()) + 1
+
+    # b x nv x nsrl x K, 1 if gt box is in srl
+    srl_gt_msk = srl_boxes.new_zeros(batch_size, nv, nsrl, K)
+    srl_gt_msk.scatter_add_(3, srl_boxes, srl_boxes_lens.long())
+
+    # b x nv x nsrl x N x M
+    in_srl = srl_gt_msk.gather(
+        3, gt_inds.clamp(min=0).view(batch_size, 1, 1, N * M).expand(
+            batch_size, nv, nsrl, N * M)
+    ).view(batch_size, nv, nsrl, N, M) > 0
+    is_pos = (overlaps > thresh).view(batch_size, 1, 1, N, M)
+
+    return (in_srl & is_pos).sum(dim=-1) > 0
+
+
+def get_targets_from_iou_pairs(iou_pairs, srl_boxes, srl_boxes_lens,
+                               num_props):
+    """
+    Targets from precomputed (proposal, gt box) pairs
+    with iou > 0.5 (see AnetEntDataset.get_iou_pairs)
+    iou_pairs: (b, P, 2), -1 for padding
+    srl_boxes: (b, nv, nsrl, nbox) gt box indices for each srl
+    srl_boxes_lens: (b, nv, nsrl, nbox) 1 if the gt box is used
+
+    targets: (b, nv, nsrl, num_props)
+    """
+    batch_size, P, _ = iou_pairs.shape
+    _, nv, nsrl, nbox = srl_boxes.shape
+    prop_ix = iou_pairs[..., 0]
+    gt_ix = iou_pairs[..., 1]
+    valid = prop_ix >= 0
+    K = max(gt_ix.max().item(), srl_boxes.max().item()) + 1
+
+    # b x nv x nsrl x K, 1 if gt box is in srl
+    srl_gt_msk = srl_boxes.new_zeros(batch_size, nv, nsrl, K)
+    srl_gt_msk.scatter_add_(3, srl_boxes, srl_boxes_lens.long())
+
+    # b x nv x nsrl x P
+    in_srl = srl_gt_msk.gather(
+        3, gt_ix.clamp(min=0).view(batch_size, 1, 1, P).expand(
+            batch_size, nv, nsrl, P)
+    ) * valid.long().view(batch_size, 1, 1, P)
+
+    # padded pairs are written to the last (dump) proposal
+    prop_ix = prop_ix.masked_fill(~valid, num_props)
+    targets = srl_gt_msk.new_zeros(batch_size, nv, nsrl, num_props + 1)
+    targets.scatter_add_(
+        3, prop_ix.view(batch_size, 1, 1, P).expand(
+            batch_size, nv, nsrl, P),
+        (in_srl > 0).long()
+    )
+    return targets[..., :num_props] > 0
+
+
+def check_frm_parity(B=4, nfrm=10, nppf=100, K=100, nsrl=5, seed=0):
+    """
+    bbox_overlaps_frm + get_targets_from_frm_overlaps against
+    bbox_overlaps_batch with a same-frame mask, on random boxes.
+    The gt boxes are jittered proposals, so many pairs overlap,
+    the last gt boxes are padding (zero area).
+    """
+    g = torch.Generator().manual_seed(seed)
+    N = nfrm * nppf
+    xy = torch.rand(B, N, 2, generator=g) * 300
+    wh = torch.rand(B, N, 2, generator=g) * 200 + 1
+    frm = torch.arange(nfrm).repeat_interleave(nppf).float()
+    props = torch.cat([xy, xy + wh, frm.view(1, N, 1).expand(B, N, 1)],
+                      dim=-1)
+
+    prop_ix = torch.randint(0, N, (B, K), generator=g)
+    gts = props.gather(1, prop_ix.unsqueeze(-1).expand(B, K, 5)).clone()
+    gts[..., :4] += torch.randn(B, K, 4, generator=g) * 10
+    gts[..., 2:4] = torch.max(gts[..., 2:4], gts[..., :2] + 1)
+    # last few gt boxes are padding
+    gts[:, -10:] = 0
+    srl_boxes = torch.randint(0, K - 10, (B, 1, nsrl, 4), generator=g)
+    srl_boxes_lens = torch.randint(0, 2, (B, 1, nsrl, 4), generator=g)
+
+    same_frm = props[..., 4].unsqueeze(-1) == gts[..., 4].unsqueeze(-2)
+    ovl_dense = bbox_overlaps_batch(props, gts, same_frm)
+    ovl, gt_inds = bbox_overlaps_frm(props, gts)
+
+    # same overlaps for every (proposal, same frame gt box)
+    valid = gt_inds >= 0
+    gt_area_zero = (gts[..., 2] - gts[..., 0] + 1 == 1) & (
+        gts[..., 3] - gts[..., 1] + 1 == 1)
+    num_pairs = (same_frm & ~gt_area_zero.unsqueeze(1)).sum().item()
+    assert valid.sum().item() == num_pairs
+    ovl_dense_frm = ovl_dense.gather(2, gt_inds.clamp(min=0))
+    assert torch.allclose(ovl[valid], ovl_dense_frm[valid], atol=1e-6)
+
+    # same targets
+    ovl_srl = ovl_dense.view(B, 1, 1, N, K).expand(B, 1, nsrl, N, K)
+    ovl_srl = torch.gather(ovl_srl, -1, srl_boxes.unsqueeze(-2).expand(
+        B, 1, nsrl, N, 4))
+    ovl_srl = ovl_srl * srl_boxes_lens.float().unsqueeze(-2)
+    targs_dense = ovl_srl.max(dim=-1)[0] > 0.5
+    targs_frm = get_targets_from_frm_overlaps(
+        ovl, gt_inds, srl_boxes, srl_boxes_lens)
+    assert torch.equal(targs_dense, targs_frm)
+    print(f'Parity OK: {num_pairs} same frame pairs, '
+          f'{targs_frm.sum().item()} targets')
+    return targs_frm
+
+
+def bench_frm(B=4, nfrm=10, nppf=100, K=100, num_its=10):
+    """
+    Time (and peak cuda memory) of the dense and frm overlaps
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    N = nfrm * nppf
+    xy = torch.rand(B, N, 2, device=device) * 300
+    props = torch.cat([
+        xy, xy + torch.rand(B, N, 2, device=device) * 200 + 1,
+        torch.arange(nfrm, device=device).repeat_interleave(
+            nppf).float().view(1, N, 1).expand(B, N, 1)], dim=-1)
+    xy = torch.rand(B, K, 2, device=device) * 300
+    gts = torch.cat([
+        xy, xy + torch.rand(B, K, 2, device=device) * 200 + 1,
+        torch.randint(0, nfrm, (B, K, 1), device=device).float()], dim=-1)
+
+    def dense_fn():
+        same_frm = props[..., 4].unsqueeze(-1) == gts[..., 4].unsqueeze(-2)
+        return bbox_overlaps_batch(props, gts, same_frm)
+
+    def frm_fn():
+        return bbox_overlaps_frm(props, gts)[0]
+
+    for name, fn in [('dense', dense_fn), ('frm', frm_fn)]:
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_max_memory_allocated()
+        st_time = time.time()
+        for _ in range(num_its):
+            out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        tot_time = (time.time() - st_time) / num_its
+        mem = (torch.cuda.max_memory_allocated() / 2**20
+               if device.type == 'cuda' else float('nan'))
+        print(f'{name}: {tot_time * 1000:.2f} ms, overlaps '
+              f'{tuple(out.shape)}, peak memory {mem:.1f} MB')
+
+
+if __name__ == '__main__':
+    for seed in range(3):
+        check_frm_parity(seed=seed)
+    bench_frm()
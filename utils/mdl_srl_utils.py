@@ -1,6 +1,7 @@
 """
 Some helpful functions/classes are defined
 """
+import contextlib
 import torch
 from torch import nn
 # from fairseq.models import FairseqEncoder
@@ -27,6 +28,48 @@ def uncombine_first_ax(inp_tensor, s0):
         s0, s1, *inp_shape[1:])
 
 
+def fp32_region(inp_tensor):
+    """
+    Context which disables autocast (if active) for
+    numerically sensitive parts. Inputs to the region
+    should be cast with .float()
+    """
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(inp_tensor.device.type, enabled=False)
+    return contextlib.suppress()
+
+
+def is_tracing():
+    """
+    True while the model is being traced (mdl_export)
+    """
+    return torch._C._get_tracing_state() is not None
+
+
+def pack_by_mask(inp_tensor, msk):
+    """
+    Gathers the valid rows of inp_tensor
+    inp_tensor: B x ncmp x ...
+    msk: B x ncmp (bool), 1 where the row is valid
+    output: num_valid x ...
+    """
+    assert inp_tensor.shape[:msk.dim()] == msk.shape
+    return inp_tensor[msk]
+
+
+def unpack_by_mask(packed_tensor, msk, fill=0.):
+    """
+    Inverse of pack_by_mask, padded rows are set to fill
+    packed_tensor: num_valid x ...
+    msk: B x ncmp (bool)
+    output: B x ncmp x ...
+    """
+    out_tensor = packed_tensor.new_full(
+        (*msk.shape, *packed_tensor.shape[1:]), fill)
+    out_tensor[msk] = packed_tensor
+    return out_tensor
+
+
 def do_cross(x1, x2=None, dim1=1, op='add'):
     """
     if x2 is none do x1(row) + x1(col)
@@ -132,7 +175,7 @@ class LSTMEncoder(nn.Module):
 
         # pack embedded source tokens into a PackedSequence
         packed_x = nn.utils.rnn.pack_padded_sequence(
-            x, src_lengths.data.tolist(), enforce_sorted=False)
+            x, src_lengths.cpu(), enforce_sorted=False)
 
         # apply LSTM
         if self.bidirectional:
@@ -146,7 +189,8 @@ class LSTMEncoder(nn.Module):
 
         # unpack outputs and apply dropout
         x, _ = nn.utils.rnn.pad_packed_sequence(
-            packed_outs, padding_value=self.padding_value)
+            packed_outs, padding_value=self.padding_value,
+            total_length=seqlen)
         x = F.dropout(x, p=self.dropout_out, training=self.training)
         assert list(x.size()) == [seqlen, bsz, self.output_units]
 
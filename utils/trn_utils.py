@@ -16,10 +16,12 @@ from collections import Counter
 from tqdm import tqdm
 import time
 import shutil
+import copy
 import json
 from fastprogress.fastprogress import master_bar, progress_bar
 import logging
 import pickle
+import contextlib
 from torch.utils.tensorboard import SummaryWriter
 from torch import distributed as dist
 from torch.distributed import ReduceOp
@@ -63,6 +65,81 @@ def synchronize():
     dist.barrier()
 
 
+def all_gather(data):
+    """
+    Gather picklable data from all ranks, as a list over ranks.
+    Adapted from maskrcnn-benchmark, tensors are on cuda for
+    nccl and on cpu otherwise (gloo)
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [data]
+    device = torch.device(
+        'cuda' if dist.get_backend() == 'nccl' else 'cpu')
+
+    # serialized to a Tensor
+    buffer = pickle.dumps(data)
+    storage = torch.ByteStorage.from_buffer(buffer)
+    tensor = torch.ByteTensor(storage).to(device)
+
+    # obtain Tensor size of each rank
+    local_size = torch.LongTensor([tensor.numel()]).to(device)
+    size_list = [torch.LongTensor([0]).to(device)
+                 for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    # padded to the max size, all_gather needs same shapes
+    tensor_list = [torch.ByteTensor(size=(max_size,)).to(device)
+                   for _ in size_list]
+    if tensor.numel() != max_size:
+        padding = torch.ByteTensor(
+            size=(max_size - tensor.numel(),)).to(device)
+        tensor = torch.cat((tensor, padding), dim=0)
+    dist.all_gather(tensor_list, tensor)
+
+    data_list = []
+    for size, tensor in zip(size_list, tensor_list):
+        buffer = tensor.cpu().numpy().tobytes()[:size]
+        data_list.append(pickle.loads(buffer))
+    return data_list
+
+
+def get_amp_dtype(cfg):
+    """
+    dtype used by autocast, None if mixed precision is off
+    """
+    if not cfg.train.amp:
+        return None
+    if not hasattr(torch, 'autocast'):
+        raise NotImplementedError(
+            'train.amp requires torch.autocast (torch>=1.10)')
+    amp_dtypes = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+    assert cfg.train.amp_dtype in amp_dtypes
+    return amp_dtypes[cfg.train.amp_dtype]
+
+
+def get_autocast(device, amp_dtype):
+    """
+    Autocast context for the device, no-op if amp_dtype is None.
+    On cpu only bf16 is supported
+    """
+    if amp_dtype is None:
+        return contextlib.suppress()
+    return torch.autocast(device_type=device.type, dtype=amp_dtype)
+
+
+def sync_time(device: torch.device) -> float:
+    """
+    time.time() once the queued cuda work is done, so that
+    a window of steps is timed by its kernels, not its launches
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.time()
+
+
 def reduce_dict(input_dict, average=False):
     """
     Args:
@@ -82,16 +159,17 @@ def reduce_dict(input_dict, average=False):
         for k in sorted(input_dict.keys()):
             names.append(k)
             values.append(input_dict[k])
-            values = torch.stack(values, dim=0)
-            dist.reduce(values, dst=0)
-            # if dist.get_rank() == 0:
-            # only main process gets accumulated, so only divide by
-            # world_size in this case
-            # values /= world_size
+        # one collective for all the keys
+        values = torch.stack(values, dim=0)
+        dist.reduce(values, dst=0)
+        # if dist.get_rank() == 0:
+        # only main process gets accumulated, so only divide by
+        # world_size in this case
+        # values /= world_size
         if average:
             values /= world_size
-            reduced_dict = {
-                k: v for k, v in zip(names, values)}
+        reduced_dict = {
+            k: v for k, v in zip(names, values)}
     return reduced_dict
 
 
@@ -122,6 +200,7 @@ class DataWrap:
     train_dl: DataLoader
     valid_dl: DataLoader
     test_dl: Optional[Union[DataLoader, Dict]] = None
+    valid_subset_dl: Optional[DataLoader] = None
 
 
 class NewDistributedSampler(DistributedSampler):
@@ -156,8 +235,36 @@ class NewDistributedSampler(DistributedSampler):
         return iter(indices)
 
 
+class EvalDistributedSampler(Sampler):
+    """
+    Distributed sampler for validation/testing.
+    Each rank gets a contiguous disjoint shard of the dataset,
+    without the padding of NewDistributedSampler, so
+    the shards can differ in length by one item.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start = len(dataset) * rank // num_replicas
+        self.end = len(dataset) * (rank + 1) // num_replicas
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
 def make_data_sampler(dataset: Dataset, shuffle: bool,
-                      distributed: bool) -> Sampler:
+                      distributed: bool, is_train: bool = True) -> Sampler:
+    if distributed and not is_train:
+        return EvalDistributedSampler(dataset)
     if distributed:
         return NewDistributedSampler(dataset, shuffle=shuffle)
     if shuffle:
@@ -187,10 +294,10 @@ def get_dataloader(cfg, dataset: Dataset, is_train: bool,
     if is_train:
         shuffle = True
     else:
-        shuffle = False if not is_distributed else True
+        shuffle = False
         # shuffle = False
 
-    sampler = make_data_sampler(dataset, shuffle, is_distributed)
+    sampler = make_data_sampler(dataset, shuffle, is_distributed, is_train)
     # if ((cfg.ds.ds4_type == 'sigmoid' or cfg.ds.ds4_type == 'sigmoid_single_q')
     #         and cfg.ds.ds4_screen == 'screen_sep'):
     #     collator = BatchCollatorDS4(cfg)
@@ -263,6 +370,128 @@ def compute_avg_dict(inp: Dict[str, List],
     return out_dict
 
 
+class MetricAccumulator:
+    """
+    Running sums of scalar metrics, kept on the device so
+    that adding a value does not sync with the host.
+    sync() all-reduces all the sums in one collective and
+    returns the averages since the previous sync.
+    """
+
+    def __init__(self, keys: List[str], device: torch.device):
+        self.keys = keys
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        # last one is the number of steps
+        self.sums = torch.zeros(len(self.keys) + 1, device=self.device)
+
+    def add_value(self, val: Dict[str, torch.tensor]):
+        self.sums[:-1] += torch.stack(
+            [val[k].detach().float().mean() for k in self.keys])
+        self.sums[-1] += 1
+
+    def sync(self) -> Dict[str, float]:
+        sums = self.sums
+        if get_world_size() > 1:
+            dist.all_reduce(sums)
+        sums = sums.cpu()
+        self.reset()
+        return {k: sums[ix].item() / max(sums[-1].item(), 1)
+                for ix, k in enumerate(self.keys)}
+
+
+def _check_dist_worker(rank: int, world_size: int, init_file: str):
+    dist.init_process_group(
+        'gloo', init_method=f'file://{init_file}',
+        rank=rank, world_size=world_size)
+    try:
+        keys = ['loss', 'acc', 'b_loss']
+        # rank r runs r+2 steps, value of key ix at step s is
+        # 10*ix + r + s (mean of a 2-element tensor)
+        run_met = MetricAccumulator(keys, torch.device('cpu'))
+        for s in range(rank + 2):
+            run_met.add_value({
+                k: torch.tensor([10. * ix + rank + s - 1,
+                                 10. * ix + rank + s + 1])
+                for ix, k in enumerate(keys)})
+        run_avg = run_met.sync()
+        steps = [(r, s) for r in range(world_size) for s in range(r + 2)]
+        for ix, k in enumerate(keys):
+            exp = sum(10. * ix + r + s for r, s in steps) / len(steps)
+            assert abs(run_avg[k] - exp) < 1e-5, (rank, k, run_avg[k], exp)
+        # sync resets the sums: only the new step is averaged
+        run_met.add_value({k: torch.tensor(float(ix))
+                           for ix, k in enumerate(keys)})
+        run_avg = run_met.sync()
+        assert all(abs(run_avg[k] - ix) < 1e-5
+                   for ix, k in enumerate(keys)), (rank, run_avg)
+
+        # keys inserted in a different order on each rank
+        order = keys if rank % 2 == 0 else keys[::-1]
+        for average in [False, True]:
+            red = reduce_dict(
+                {k: torch.tensor(10. * keys.index(k) + rank)
+                 for k in order}, average=average)
+            if rank == 0:
+                assert sorted(red.keys()) == sorted(keys)
+                for ix, k in enumerate(keys):
+                    exp = sum(10. * ix + r for r in range(world_size))
+                    if average:
+                        exp /= world_size
+                    assert abs(red[k].item() - exp) < 1e-5, (
+                        average, k, red[k], exp)
+    finally:
+        dist.destroy_process_group()
+
+
+def check_dist_reduce(world_size: int = 2):
+    """
+    MetricAccumulator.sync (average over steps and ranks)
+    and reduce_dict (several keys, sum and average) on
+    world_size cpu processes (gloo)
+    """
+    import tempfile
+    import torch.multiprocessing as mp
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(_check_dist_worker,
+                 args=(world_size, str(Path(tmp_dir) / 'init')),
+                 nprocs=world_size)
+    print(f'MetricAccumulator/reduce_dict ok on {world_size} processes')
+
+
+def bench_deb_it(deb_its=(1, 20), num_steps: int = 200,
+                 device: str = 'cuda', bs: int = 64, dim: int = 512):
+    """
+    Step time of a small mlp with the train_epoch logging
+    (MetricAccumulator, sync every deb_it steps), windows
+    timed with sync_time
+    """
+    device = torch.device(device if torch.cuda.is_available() else 'cpu')
+    mdl = nn.Sequential(nn.Linear(dim, dim), nn.ReLU(),
+                        nn.Linear(dim, 1)).to(device)
+    opt = torch.optim.SGD(mdl.parameters(), lr=1e-3)
+    inp = torch.randn(bs, dim, device=device)
+    tgt = torch.randn(bs, 1, device=device)
+    for deb_it in deb_its:
+        run_met = MetricAccumulator(['loss'], device)
+        step_times = []
+        st_time = sync_time(device)
+        for it in range(1, num_steps + 1):
+            opt.zero_grad()
+            loss = (mdl(inp) - tgt).pow(2).mean()
+            loss.backward()
+            opt.step()
+            run_met.add_value({'loss': loss})
+            if it % deb_it == 0:
+                run_met.sync()
+                step_times.append((sync_time(device) - st_time) / deb_it)
+                st_time = sync_time(device)
+        print(f'{device.type} deb_it {deb_it}: '
+              f'step {np.mean(step_times) * 1000:.3f}ms')
+
+
 def good_format_stats(names, stats) -> str:
     "Format stats before printing."
     str_stats = []
@@ -282,7 +511,8 @@ class Learner:
     cfg: Dict
     eval_fn: nn.Module
     opt_fn: Callable
-    device: torch.device = torch.device('cuda')
+    device: torch.device = torch.device(
+        'cuda' if torch.cuda.is_available() else 'cpu')
 
     def __post_init__(self):
         "Setup log file, load model if required"
@@ -294,6 +524,10 @@ class Learner:
 
         self.prepare_log_keys()
 
+        self.set_mdl_out_keys()
+
+        self.set_amp()
+
         self.prepare_log_file()
 
         self.logger = self.init_logger()
@@ -368,6 +602,29 @@ class Learner:
 
         self.create_log_dirs()
 
+    def set_mdl_out_keys(self):
+        """
+        Model outputs to compute: the loss in training
+        (plus the evaluator if trn_met), both in eval
+        """
+        loss_out_keys = self.loss_fn.mdl_out_keys
+        eval_out_keys = loss_out_keys + self.eval_fn.mdl_out_keys
+        trn_out_keys = eval_out_keys if self.trn_met else loss_out_keys
+        mdl = getattr(self.mdl, 'module', self.mdl)
+        mdl.set_out_keys_req(trn_out_keys, eval_out_keys)
+
+    def set_amp(self):
+        """
+        Mixed precision (train.amp). Grad scaling is
+        only needed for fp16, bf16 has the fp32 range
+        """
+        self.amp_dtype = get_amp_dtype(self.cfg)
+        self.eval_fn.amp_dtype = self.amp_dtype
+        self.scaler = None
+        if self.amp_dtype == torch.float16:
+            assert self.device.type == 'cuda'
+            self.scaler = torch.cuda.amp.GradScaler()
+
     @exec_func_if_main_proc
     def create_log_dirs(self):
         """
@@ -412,6 +669,12 @@ class Learner:
             ['val']
         )
         self.log_keys += self.val_log_keys[1:]
+        # subset validation is logged in its own columns
+        if self.data.valid_subset_dl is not None:
+            self.log_keys += _prepare_log_keys(
+                [self.loss_keys, self.met_keys],
+                ['vsub']
+            )
         self.test_log_keys = ['epochs'] + _prepare_log_keys(
             [self.met_keys],
             ['test']
@@ -457,9 +720,12 @@ class Learner:
             dl_name = list(db.keys())[0]
             dl = db[dl_name]
         # if is_main_process():
+        # DDP forward syncs buffers across ranks, but the
+        # validation shards of the ranks can differ in length
+        mdl = getattr(self.mdl, 'module', self.mdl)
         with torch.no_grad():
             out_loss, out_acc = self.eval_fn(
-                self.mdl,
+                mdl,
                 self.loss_fn,
                 dl, dl_name,
                 rank=get_rank(),
@@ -482,47 +748,85 @@ class Learner:
 
         return out_loss, out_acc, {}
 
+    def train_step(self, batch):
+        "Forward, backward and optimizer step on one batch"
+        for b in batch.keys():
+            batch[b] = batch[b].to(self.device)
+        self.optimizer.zero_grad()
+        with get_autocast(self.device, self.amp_dtype):
+            out = self.mdl(batch)
+            out_loss = self.loss_fn(out, batch)
+        loss = out_loss[self.loss_keys[0]]
+        loss = loss.mean()
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            loss.backward()
+            self.optimizer.step()
+        return out, out_loss, loss
+
     def train_epoch(self, mb) -> List[torch.tensor]:
         "One epoch used for training"
         self.mdl.train()
+        mdl = getattr(self.mdl, 'module', self.mdl)
+        if hasattr(mdl, 'reset_pack_stats'):
+            mdl.reset_pack_stats()
         # trn_loss = SmoothenValue(0.9)
         trn_loss = SmoothenDict(self.loss_keys, 0.9)
         trn_acc = SmoothenDict(self.met_keys, 0.9)
+        # averaged over ranks every log.deb_it iterations,
+        # the only host syncs for logging
+        run_keys = self.loss_keys + (self.met_keys if self.trn_met else [])
+        run_met = MetricAccumulator(run_keys, self.device)
+        st_time = sync_time(self.device)
 
         for batch_id, batch in enumerate(progress_bar(
                 self.data.train_dl, parent=mb)):
 
             # Increment number of iterations
             self.num_it += 1
-            for b in batch.keys():
-                batch[b] = batch[b].to(self.device)
-            self.optimizer.zero_grad()
-            out = self.mdl(batch)
-            out_loss = self.loss_fn(out, batch)
-            loss = out_loss[self.loss_keys[0]]
-            loss = loss.mean()
-            loss.backward()
-            self.optimizer.step()
+            out, out_loss, loss = self.train_step(batch)
 
             # Returns original dictionary if not distributed parallel
             # loss_reduced = reduce_dict(out_loss, average=True)
             # metric_reduced = reduce_dict(metric, average=True)
             trn_loss.add_value(out_loss)
 
-            comment_to_print = f'LossB {loss: .4f} | SmLossB {trn_loss.smooth1: .4f}'
             if self.trn_met:
                 metric = self.eval_fn(out, batch)
                 trn_acc.add_value(metric)
-                comment_to_print += f' | AccB {trn_acc.smooth1: .4f}'
-            mb.child.comment = comment_to_print
+                run_met.add_value({**out_loss, **metric})
+            else:
+                run_met.add_value(out_loss)
             if self.num_it % self.cfg.log.deb_it == 0:
+                run_avg = run_met.sync()
+                step_time = (sync_time(self.device) - st_time) / \
+                    self.cfg.log.deb_it
+                st_time = sync_time(self.device)
+                comment_to_print = (
+                    f'LossB {run_avg[self.loss_keys[0]]: .4f} | '
+                    f'Step {step_time * 1000: .1f}ms')
+                if self.trn_met:
+                    comment_to_print += (
+                        f' | AccB {run_avg[self.met_keys[0]]: .4f}')
+                mb.child.comment = comment_to_print
                 self.logger.debug(
-                    f'Num_it {self.num_it} {trn_loss.tostring()}')
+                    f'Num_it {self.num_it} ' + '  '.join(
+                        f'{k}: {v:.4f}' for k, v in run_avg.items()) +
+                    f' step_time: {step_time:.4f}')
             del out_loss
             del loss
             # print(f'Done {batch_id}')
         del batch
         self.optimizer.zero_grad()
+        mdl = getattr(self.mdl, 'module', self.mdl)
+        if ((self.cfg.mdl.packed or self.cfg.ds.dedup_vids) and
+                hasattr(mdl, 'packed_flop_savings')):
+            self.logger.info(
+                f'Packed/dedup mode, fraction of FLOPs saved '
+                f'this epoch {mdl.packed_flop_savings()}')
         out_loss = reduce_dict(trn_loss.smooth, average=True)
         if self.trn_met:
             out_met = reduce_dict(trn_acc.smooth, average=True)
@@ -531,6 +835,98 @@ class Learner:
         # return trn_loss.smooth, trn_acc.smooth
         return out_loss, out_met
 
+    def check_amp_parity(self, db=None):
+        """
+        Accuracy parity of the autocast mode (train.amp)
+        against fp32, using the GroundEval metrics
+        """
+        assert self.amp_dtype is not None, 'set train.amp to compare'
+        val_accs = {}
+        for name, amp_dtype in [('fp32', None),
+                                (self.cfg.train.amp_dtype, self.amp_dtype)]:
+            self.eval_fn.amp_dtype = amp_dtype
+            _, val_accs[name], _ = self.validate(db=db)
+        self.eval_fn.amp_dtype = self.amp_dtype
+        if is_main_process():
+            amp_acc = val_accs[self.cfg.train.amp_dtype]
+            for k, v in val_accs['fp32'].items():
+                self.logger.info(
+                    f'{k}: fp32 {float(v):.4f} | '
+                    f'{self.cfg.train.amp_dtype} {float(amp_acc[k]):.4f} | '
+                    f'diff {float(amp_acc[k]) - float(v):.4f}')
+        return val_accs
+
+    def validate_ckpts(self, ckpt_files: List[str],
+                       db: Dict[str, DataLoader] = None):
+        """
+        Evaluate several checkpoints of the same config in one
+        pass over the validation data (eval_fn.forward_multi).
+        Predictions of the i-th checkpoint are saved as
+        {dl_name}_ckpt{i}, its metrics are logged in its own table
+        """
+        if db is None:
+            db = {'valid': self.data.valid_dl}
+        assert len(db) == 1
+        dl_name = list(db.keys())[0]
+        dl = db[dl_name]
+
+        mdl_orig = self.mdl
+        mdls = []
+        for ckpt_file in ckpt_files:
+            assert Path(ckpt_file).exists(), f'{ckpt_file} not found'
+            self.mdl = copy.deepcopy(getattr(mdl_orig, 'module', mdl_orig))
+            self.load_model_dict(resume_path=ckpt_file, load_opt=False)
+            mdls.append(self.mdl)
+        self.mdl = mdl_orig
+
+        torch.cuda.empty_cache()
+        mdl_names = [f'ckpt{ix}' for ix in range(len(ckpt_files))]
+        with torch.no_grad():
+            outs = self.eval_fn.forward_multi(
+                mdls, self.loss_fn, dl, dl_name,
+                rank=get_rank(),
+                pred_path=self.predictions_dir,
+                mdl_names=mdl_names)
+
+        synchronize()
+        if is_main_process():
+            header = '  '.join(self.val_log_keys) + '\n'
+            for mdl_name, ckpt_file, (out_loss, out_acc) in zip(
+                    mdl_names, ckpt_files, outs):
+                out_list = [self.num_epoch]
+                out_list += [out_loss[k] for k in self.loss_keys]
+                out_list += [out_acc[k] for k in self.met_keys]
+                out_str = f'{mdl_name}: {ckpt_file}\n' + header
+                out_str += good_format_stats(self.val_log_keys, out_list)
+                self.update_log_file(out_str)
+                self.logger.info(out_str)
+        return outs
+
+    def check_quant_parity(self, quant_fn, db=None):
+        """
+        Compare the metrics (and time) of the fp32 model
+        against its quantized version given by quant_fn
+        """
+        mdl_fp32 = self.mdl
+        val_accs = {}
+        for name in ['fp32', 'int8']:
+            if name == 'int8':
+                self.mdl = quant_fn(mdl_fp32)
+            st_time = time.time()
+            _, val_accs[name], _ = self.validate(db=db)
+            if is_main_process():
+                self.logger.info(
+                    f'{name} validation took {time.time() - st_time:.1f}s')
+        self.mdl = mdl_fp32
+        if is_main_process():
+            for k in self.met_keys:
+                fp32_v = float(val_accs['fp32'][k])
+                int8_v = float(val_accs['int8'][k])
+                self.logger.info(
+                    f'{k}: fp32 {fp32_v:.4f} | int8 {int8_v:.4f} | '
+                    f'diff {int8_v - fp32_v:.4f}')
+        return val_accs
+
     def load_model_dict(self, resume_path: Optional[str] = None, load_opt: bool = False):
         "Load the model and/or optimizer"
         def check_if_mgpu_state_dict(state_dict):
@@ -550,7 +946,8 @@ class Learner:
                 f'No existing model in {mfile}, starting from scratch')
             return
         try:
-            checkpoint = torch.load(open(mfile, 'rb'))
+            # tensors are copied to the model's device on loading
+            checkpoint = torch.load(open(mfile, 'rb'), map_location='cpu')
             self.logger.info(f'Loaded model from {mfile} Correctly')
         except OSError as e:
             self.logger.error(
@@ -566,6 +963,19 @@ class Learner:
             mdl_state_dict_to_load = checkpoint['model_state_dict']
             mdl_state_dict_to_load = {
                 update_k(k): v for k, v in mdl_state_dict_to_load.items()}
+            # Drop weights of heads the current model does not build
+            pruned_modules = getattr(
+                self.mdl, 'module', self.mdl).pruned_modules
+            pruned_keys = [
+                k for k in mdl_state_dict_to_load
+                if set(k.split('.')[:2]) & set(pruned_modules)
+            ]
+            if len(pruned_keys) > 0:
+                self.logger.info(
+                    f'Dropping {len(pruned_keys)} weights of pruned modules')
+            mdl_state_dict_to_load = {
+                k: v for k, v in mdl_state_dict_to_load.items()
+                if k not in pruned_keys}
             curr_mdl_state_dict = self.mdl.state_dict()
             checkp_mdl_mgpu = check_if_mgpu_state_dict(mdl_state_dict_to_load)
             curr_mdl_mgpu = check_if_mgpu_state_dict(curr_mdl_state_dict)
@@ -612,6 +1022,8 @@ class Learner:
                 self.lr_scheduler = self.prepare_scheduler()
                 self.lr_scheduler.load_state_dict(
                     checkpoint['scheduler_state_dict'])
+            if self.scaler is not None and 'scaler_state_dict' in checkpoint:
+                self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
 
     @exec_func_if_main_proc
     def save_model_dict(self):
@@ -626,6 +1038,8 @@ class Learner:
             'cfgtxt': json.dumps(self.cfg),
             'best_met': self.best_met
         }
+        if self.scaler is not None:
+            checkpoint['scaler_state_dict'] = self.scaler.state_dict()
         torch.save(checkpoint, self.model_file.open('wb'))
 
     # @exec_func_if_main_proc
@@ -665,7 +1079,9 @@ class Learner:
             train_acc: Dict[str, torch.tensor],
             val_loss: Dict[str, torch.tensor] = None,
             val_acc: Dict[str, torch.tensor] = None,
-            key_list: List[str] = None
+            key_list: List[str] = None,
+            val_sub_loss: Dict[str, torch.tensor] = None,
+            val_sub_acc: Dict[str, torch.tensor] = None
     ) -> List[torch.tensor]:
         if key_list is None:
             key_list = self.log_keys
@@ -683,6 +1099,12 @@ class Learner:
         if val_acc is not None:
             out_list += [val_acc[k] for k in self.met_keys]
 
+        # validation subset
+        if val_sub_loss is not None:
+            out_list += [val_sub_loss[k] for k in self.loss_keys]
+        if val_sub_acc is not None:
+            out_list += [val_sub_acc[k] for k in self.met_keys]
+
         assert len(out_list) == len(key_list)
         return out_list
 
@@ -718,6 +1140,8 @@ class Learner:
         self.master_bar_write(mb, line=self.log_keys, table=True)
         exception = False
         met_to_use = None
+        val_subset_dl = self.data.valid_subset_dl
+        full_val_every = self.cfg.train.full_val_every
         # Keep record of time until exit
         st_time = time.time()
         try:
@@ -726,25 +1150,48 @@ class Learner:
                 self.num_epoch += 1
                 train_loss, train_acc = self.train_epoch(mb)
                 synchronize()
-                valid_loss, valid_acc, _ = self.validate(
-                    self.data.valid_dl, mb)
-                synchronize()
-                valid_acc_to_use = valid_acc[self.met_keys[0]]
-                # Depending on type
-                self.scheduler_step(valid_acc_to_use)
-
-                # Now only need main process
-                # Decide to save or not
-                met_to_use = valid_acc[self.met_keys[0]].cpu()
-                if self.best_met < met_to_use:
-                    self.best_met = met_to_use
-                    self.save_model_dict()
+                if val_subset_dl is not None:
+                    sub_loss, sub_acc, _ = self.validate(
+                        {'valid_subset': val_subset_dl}, mb)
+                    synchronize()
+                # Full validation every full_val_every epochs
+                # and at the end, otherwise only the subset
+                do_full_val = (
+                    val_subset_dl is None or
+                    self.num_epoch % full_val_every == 0 or
+                    epoch == epochs - 1
+                )
+                if do_full_val:
+                    valid_loss, valid_acc, _ = self.validate(
+                        self.data.valid_dl, mb)
+                    synchronize()
+                    valid_acc_to_use = valid_acc[self.met_keys[0]]
+                    # Depending on type
+                    self.scheduler_step(valid_acc_to_use)
+
+                    # Now only need main process
+                    # Decide to save or not
+                    # best model only from full validation
+                    met_to_use = valid_acc[self.met_keys[0]].cpu()
+                    if self.best_met < met_to_use:
+                        self.best_met = met_to_use
+                        self.save_model_dict()
+                else:
+                    valid_loss = {k: torch.tensor(float('nan'))
+                                  for k in self.loss_keys}
+                    valid_acc = {k: torch.tensor(float('nan'))
+                                 for k in self.met_keys}
+                    if not self.sched_using_val_metric:
+                        self.scheduler_step(None)
 
                 synchronize()
                 # Prepare what all to write
+                if val_subset_dl is None:
+                    sub_loss, sub_acc = None, None
                 to_write = self.prepare_to_write(
                     train_loss, None,
-                    valid_loss, valid_acc
+                    valid_loss, valid_acc,
+                    val_sub_loss=sub_loss, val_sub_acc=sub_acc
                 )
                 synchronize()
                 # Display on terminal
@@ -858,3 +1305,8 @@ class Learner:
             self.logger.debug(out_str)
             print(out_str)
             # print(f'Iter {i} | loss {loss: 0.4f} | acc {met: 0.4f}')
+
+
+if __name__ == '__main__':
+    check_dist_reduce()
+    bench_deb_it()